@@ -0,0 +1,392 @@
+# -----------------------------------------------------------------------------
+# resident configuration service and its command line client
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# CfgDaemon.py --serve keeps the compiled templates and one warm ssh master
+# connection per device, and handles render/push jobs received on a local
+# Unix socket. Without --serve, CfgDaemon.py is a thin client which sends
+# jobs to the daemon and prints the results as they come back.
+#
+# Protocol: json lines in both directions. A job is an inventory record
+# (see FleetCfg) with a few more keys:
+#    { "op": "push" | "render" | "reload", "host", "username", "template", "data",
+#      "model", "engine", "delay", "activate_at", "incremental", "state_db", "force", "budget", "id" }
+# each job gets one result line:
+#    { "id", "host", "status": ok|failed|timeout|skipped, "duration", "stderr", "config" (render) }
+# The client closes its side of the socket once all the jobs are sent.
+# The same SSH_ASKPASS and DISPLAY settings than CiscoCfg are required by the daemon.
+# ----------------------------------------------------------------------------
+
+import optparse
+import json
+import os
+import time
+import socket
+import signal
+import tempfile
+import threading
+import collections
+import asyncio
+
+import activation
+import aiotransport
+import cfgcommon
+import deadlines
+import FleetCfg
+import jsonstream
+import retrypolicy
+import sshmux
+
+# default location of the job socket
+DAEMON_SOCKET = os.environ.get('CFG_DAEMON_SOCKET',
+                               os.path.join(os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir()),
+                                            'cfgdaemon.sock'))
+# number of jobs handled at the same time
+DAEMON_WORKERS = 64
+# a master connection without job during this number of seconds is closed
+SESSION_IDLE = 300
+# the job keys given as is to aiotransport.ssh_cfg
+JOB_OPTIONS = ('engine', 'delay', 'activate_at', 'incremental', 'state_db', 'force')
+
+
+class SessionPool:
+    """ warm ssh master connections (sshmux), one per device and username """
+
+    def __init__(self, idle=SESSION_IDLE):
+        self.idle = idle
+        self.sessions = {}     # (dest, username) -> [ control path, last use, jobs using it ]
+        self.locks = collections.defaultdict(asyncio.Lock)
+
+    async def acquire(self, dest, username):
+        """ return the control path of the master connection to dest, open it if needed """
+        key = (dest, username)
+        async with self.locks[key]:
+            session = self.sessions.get(key)
+            if session is None:
+                control_path = await asyncio.to_thread(sshmux.open_session, dest, username, sshmux.SSH_OPTIONS)
+                session = self.sessions[key] = [ control_path, time.monotonic(), 0 ]
+            session[2] += 1
+            return session[0]
+
+    async def release(self, dest, username, broken=False):
+        """ the job is done with the connection, a broken connection is closed once unused """
+        session = self.sessions[(dest, username)]
+        session[1] = time.monotonic()
+        session[2] -= 1
+        if broken and session[2] == 0:
+            await self.close(dest, username)
+
+    async def close(self, dest, username):
+        """ close the master connection to dest """
+        session = self.sessions.pop((dest, username), None)
+        self.locks.pop((dest, username), None)
+        if session:
+            await asyncio.to_thread(sshmux.close_session, dest, session[0], username)
+
+    async def expire(self):
+        """ close the idle connections, runs until cancelled """
+        while True:
+            await asyncio.sleep(min(self.idle, 30))
+            now = time.monotonic()
+            for (dest, username), session in list(self.sessions.items()):
+                if session[2] == 0 and now - session[1] > self.idle:
+                    await self.close(dest, username)
+
+    async def close_all(self):
+        for dest, username in list(self.sessions):
+            await self.close(dest, username)
+
+
+class CfgDaemon:
+    """ handle the jobs received on the Unix socket """
+
+    def __init__(self, workers=DAEMON_WORKERS, idle=SESSION_IDLE):
+        self.workers = workers
+        self.slots = asyncio.Semaphore(workers)
+        self.sessions = SessionPool(idle)
+        self.templates = {}    # template path -> { path: mtime } of the template and its includes when compiled
+
+    def reload(self):
+        """ forget the compiled templates """
+        import tipyte
+        tipyte.compile_template.cache_clear()
+        tipyte.resolve_include.cache_clear()
+        tipyte.template_dependencies.cache_clear()
+        if tipyte.TEMPLATE_MEMO is not None:
+            tipyte.TEMPLATE_MEMO.clear()
+        self.templates.clear()
+
+    @staticmethod
+    def file_mtime(path):
+        """ the modification time of path, None once it is removed """
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def check_template(self, tmpl_name):
+        """ recompile the templates when one of them, or a file they include, changed on disk
+            since it was compiled. tmpl_name is a template or a list of templates (ekinops
+            scripts run in order) """
+        import tipyte
+        for name in tmpl_name if isinstance(tmpl_name, list) else [ tmpl_name ]:
+            os.stat(name)           # a missing template fails the job
+            path = os.path.abspath(name)
+            files = self.templates.get(path)
+            if files is not None and all(self.file_mtime(f) == mtime for f, mtime in files.items()):
+                continue
+            if files is not None:
+                self.reload()
+            self.templates[path] = { f: self.file_mtime(f) for f in tipyte.included_files(path) }
+
+    async def run_job(self, job):
+        """ render or push the configuration of one job, return its result """
+        op = job.get('op', 'push')
+        host = job.get('host')
+        result = { 'id': job.get('id'), 'host': host, 'status': 'ok', 'duration': 0.0, 'stderr': '' }
+        if op == 'reload':
+            self.reload()
+            return result
+        if not host or job.get('skip'):
+            result['status'] = 'skipped'
+            return result
+        username = job.get('username', '')
+        model = job.get('model', 'cisco')
+        tmpl_name = job.get('template')
+        start = time.time()
+        async with self.slots:
+            control_path = None
+            try:
+                if op not in ('push', 'render'):
+                    raise ValueError("Unknown job operation " + str(op))
+                self.check_template(tmpl_name)
+                if op == 'render':
+                    FleetCfg.get_driver(model)        # check model
+                    names = tmpl_name if isinstance(tmpl_name, list) else [ tmpl_name ]
+                    # rendered off the event loop, the other jobs go on meanwhile
+                    result['config'] = ''.join(await asyncio.to_thread(
+                        lambda: [ cfgcommon.resolve_template(name, job.get('data', {}), job.get('engine', 'string'))
+                                  for name in names ]))
+                else:
+                    with deadlines.device_budget(job.get('budget')):
+                        control_path = await self.sessions.acquire(host, username)
+                        sent = await aiotransport.ssh_cfg (dest         = host,
+                                                           tmpl_name    = tmpl_name,
+                                                           data         = job.get('data', {}),
+                                                           username     = username,
+                                                           model        = model,
+                                                           control_path = control_path,
+                                                           **{ key: job[key] for key in JOB_OPTIONS if key in job })
+                    result['status'] = 'skipped' if sent is False else 'ok'
+            except Exception as e:     # one failed job must not stop the daemon
+                result['status'] = FleetCfg.failure_status(e)
+                result['stderr'] = str(e)
+            finally:
+                if control_path:
+                    await self.sessions.release(host, username, broken=result['status'] in ('failed', 'timeout'))
+        result['duration'] = time.time() - start
+        return result
+
+    async def handle(self, reader, writer):
+        """ read the jobs of a client, send back each result as soon as it is known """
+        async def reply(job):
+            result = await self.run_job(job)
+            try:
+                writer.write(json.dumps(result).encode() + b'\n')
+                await writer.drain()
+            except ConnectionError:     # the client went away, the job is done anyway
+                pass
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    job = json.loads(line)
+                except ValueError as e:
+                    writer.write(json.dumps({ 'id': None, 'host': None, 'status': 'failed', 'duration': 0.0,
+                                              'stderr': 'invalid job: ' + str(e) }).encode() + b'\n')
+                    continue
+                pending.add(asyncio.ensure_future(reply(job)))
+                if len(pending) >= self.workers:   # stop reading while the workers are busy
+                    _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=DAEMON_SOCKET):
+        """ listen on socket_path until SIGINT or SIGTERM """
+        if os.path.exists(socket_path):
+            if daemon_running(socket_path):
+                raise OSError("a daemon already listens on " + socket_path)
+            os.remove(socket_path)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        umask = os.umask(0o077)    # only the owner may send jobs
+        try:
+            server = await asyncio.start_unix_server(self.handle, path=socket_path)
+        finally:
+            os.umask(umask)
+        expire = asyncio.ensure_future(self.sessions.expire())
+        print ("listening on", socket_path, flush=True)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            expire.cancel()
+            await self.sessions.close_all()
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+def daemon_running(socket_path=DAEMON_SOCKET):
+    """ True if a daemon accepts connections on socket_path """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+def submit(jobs, socket_path=DAEMON_SOCKET):
+    """ send the jobs (an iterable of dictionnaries) to the daemon, yield the results as they come """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    def send():
+        # the jobs are sent from a thread so the results are read while the jobs are written
+        try:
+            for job in jobs:
+                sock.sendall(json.dumps(job).encode() + b'\n')
+        finally:
+            sock.shutdown(socket.SHUT_WR)
+    sender = threading.Thread(target=send, daemon=True)
+    sender.start()
+    try:
+        with sock.makefile('rb') as stream:
+            for line in stream:
+                yield json.loads(line)
+    finally:
+        sock.close()
+    sender.join()
+
+
+if __name__ == "__main__":
+    def read_command_line ():
+        """ handle command line """
+        parser = optparse.OptionParser()
+        # configure option parsing with default destination (longnames)
+        parser.add_option('--serve',          action="store_true", default=False,
+                                              help="run the daemon instead of sending jobs to it")
+        parser.add_option('-s', '--socket',   help='Unix socket of the daemon', default=DAEMON_SOCKET)
+        parser.add_option('-j', '--workers',  help="with --serve, number of jobs handled at once",
+                                              type="int", default=DAEMON_WORKERS)
+        parser.add_option('--idle',           help="with --serve, close the ssh connections unused for n seconds",
+                                              type="int", default=SESSION_IDLE)
+        parser.add_option('--retries',        help="with --serve, retries of a session which failed for a transient reason",
+                                              type="int", default=retrypolicy.RETRIES)
+        parser.add_option('--login-rate',     help="with --serve, at most n new ssh logins per second (0: no limit)",
+                                              type="float", default=0.0)
+        parser.add_option('--connect-timeout', help="with --serve, seconds to establish a ssh session (0: no limit)",
+                                              type="float", default=deadlines.CONNECT_TIMEOUT)
+        parser.add_option('--transfer-timeout', help="with --serve, seconds a file transfer may last once connected (0: no limit)",
+                                              type="float", default=deadlines.TRANSFER_TIMEOUT)
+        parser.add_option('--exec-timeout',   help="with --serve, seconds a remote command may last once connected (0: no limit)",
+                                              type="float", default=deadlines.EXEC_TIMEOUT)
+        parser.add_option('--budget',         help="seconds each device may take, retries included, activation wait excluded (0: no limit)",
+                                              type="float", default=0.0)
+        parser.add_option('-Z', '--memoize',  action="store_true", default=False,
+                                              help="with --serve, render only once the tipyte templates and includes reading the same values")
+        parser.add_option('--metrics',        help="with --serve, append the timing of each phase to this json lines file (optional)")
+        parser.add_option('--prometheus',     help="with --serve, write the phase totals to this Prometheus textfile (optional)")
+        parser.add_option('-i', '--inventory', help='json list or json lines file of the devices to configure, - for stdin')
+        parser.add_option('-a', '--address',  help='DNS hostname or current ip admin address')
+        parser.add_option('-m', '--model',    help='device model [cisco, ekinops]', default='cisco')
+        parser.add_option('-u', '--username', help='username to be used for configuring devices', default='')
+        parser.add_option('-t', '--template', help='The template to be applied')
+        parser.add_option('-d', '--data',     help="The template's variables in a json object, @file to read them from a file (optional)",
+                                              default = '{}')
+        parser.add_option('-w', '--wait',     help="wait n seconds before applying template (optional)",
+                                              type="int", default=0)
+        parser.add_option('--at',             help="apply the configurations at this time instead of -w: epoch, ISO date or HH:MM[:SS]")
+        parser.add_option('-E', '--engine',   help="Template engine [string, tipyte]", default='string')
+        parser.add_option('-I', '--incremental', action="store_true", default=False,
+                                              help="only send what differs from the running-config (cisco)")
+        parser.add_option('-S', '--state',    help="database of the configurations already pushed (optional)")
+        parser.add_option('-F', '--force',    action="store_true", default=False,
+                                              help="send the configurations even if they were already pushed")
+        parser.add_option('-R', '--reload',   action="store_true", default=False,
+                                              help="ask the daemon to recompile the templates")
+        parser.add_option('-D', '--dryrun',   action="store_true", default=False,
+                                              help="Only resolve the templates, do not send to hosts")
+        # Parse the argument
+        args,_ = parser.parse_args()
+        if args.incremental and args.model!='cisco':
+            parser.error("-I is only supported by cisco devices")
+        return args
+
+
+    def iter_jobs(args):
+        """ the jobs described by the command line """
+        if args.reload:
+            yield { 'op': 'reload' }
+        defaults = { 'op': 'render' if args.dryrun else 'push', 'model': args.model, 'engine': args.engine,
+                     'delay': args.wait, 'username': args.username, 'template': args.template and
+                     os.path.abspath(args.template) }
+        if args.at:
+            defaults['activate_at'] = activation.parse_time(args.at)
+        if args.incremental:
+            defaults['incremental'] = True
+        if args.state:
+            defaults['state_db'] = os.path.abspath(args.state)
+        if args.force:
+            defaults['force'] = True
+        if args.budget:
+            defaults['budget'] = args.budget
+        if args.inventory:
+            devices = jsonstream.read_records(args.inventory)
+        elif args.address:
+            if args.data.startswith('@'):
+                with open(args.data[1:], 'r') as f:
+                    data = json.load(f)
+            else:
+                data = json.loads(args.data)
+            devices = [ { 'host': args.address, 'data': data } ]
+        else:
+            devices = []
+        for index, device in enumerate(devices):
+            job = dict(defaults, id=index)
+            job.update(device)
+            if isinstance(device.get('template'), list):   # relative to the client, not to the daemon
+                job['template'] = [ os.path.abspath(name) for name in device['template'] ]
+            elif 'template' in device:
+                job['template'] = os.path.abspath(device['template'])
+            yield job
+
+
+    args = read_command_line()                     # parse command line
+    retrypolicy.configure(args.retries, args.login_rate)
+    deadlines.configure(args.connect_timeout, args.transfer_timeout, args.exec_timeout, args.budget)
+    if args.serve:
+        import cfgmetrics
+        if args.memoize:
+            import tipyte
+            tipyte.enable_render_memo()
+        with cfgmetrics.recording(args.metrics, args.prometheus):
+            asyncio.run(CfgDaemon(args.workers, args.idle).serve(args.socket))
+    else:
+        failed = 0
+        for r in submit(iter_jobs(args), args.socket):
+            if 'config' in r:
+                print (r['config'])
+            if r['host'] is not None or r['status']!='ok':
+                print ("{:<30} {:<8} {:>8.1f}s  {}".format(str(r['host']), r['status'], r['duration'],
+                                                           r['stderr'].replace('\n', ' ')), flush=True)
+            failed += r['status'] in ('failed', 'timeout')
+        raise SystemExit(1 if failed else 0)
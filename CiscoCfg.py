@@ -9,18 +9,34 @@
 
 import optparse
 import json
-import string
 import os
-import tempfile
+import sys
 import subprocess
+import activation
+import cfgcommon
+import cfgflow
+import deadlines
+import cfgmetrics
+import jsonstream
+import retrypolicy
+import re
 
 # disable prompt for new ssh connections (setsid may not behave correctly)
 SSH_OPTIONS = '-o StrictHostKeyChecking=no'
 SETSID_OPTIONS = '-w'
+# the device model of this driver (cfgflow)
+MODEL = 'cisco'
 
 # Cisco location to store file before putting it in runing-config
 CISCO_FILESYSTEM  =   "bootflash:/"
 RUNNING_CONFIG    =   "running-config"
+# name of the file staged on the device, id is the md5 of its content so an identical
+# file already staged (retry, new run) is not sent again
+STAGED_FILE       =   "CiscoCfg-{id}.cfg"
+# listing of the staged files: "   12  -rw-   1234  Mar 1 2022 10:00:00 +00:00  CiscoCfg-<md5>.cfg"
+LIST_STAGED       =   "dir " + CISCO_FILESYSTEM
+STAGED_REGEX      =   re.compile(r'^\s*\d+\s+\S+\s+(\d+)\s.*\s(CiscoCfg-[0-9a-f]{32}\.cfg)\s*$', re.M)
+SHOW_RUNNING      =   "show running-config"
 EEM_TEMPLATE      =   """
 event manager applet CiscoCfgRUN authorization bypass
   event timer countdown time {wait} maxrun 60
@@ -28,39 +44,21 @@ event manager applet CiscoCfgRUN authorization bypass
   action 1.0 cli command "copy bootflash:/{file} running-config" pattern "running-config"
   action 1.1 cli command "running-config"
   action 2.0 syslog msg "Configuration upload done by CiscoCfg.py"
-  action 3.0 cli command "configure terminal"
+{cleanup}  action 3.0 cli command "configure terminal"
   action 3.1 cli command "no event manager applet CiscoCfgRUN"
   action 3.2 cli command "end"
 end
 """
 
 
-def render_template(tmpl_name, out_file, data, engine):
-   """ read the 'template' and resolve it with safe_substitute """
-   if engine=="string":
-       with open(tmpl_name, 'r') as f:
-           src = string.Template(f.read())
-           result = src.safe_substitute(data)
-   elif engine=="tipyte":
-       import tipyte
-       def nothing(a):
-          return a
-       render_inbox = tipyte.template_to_function(tmpl_name, escaper=nothing)
-       result = render_inbox(data)  # do not use kwargs syntax data=data
-   else:
-       raise AttributeError("Unknown template engine")
-   # write result in a file
-   with open (out_file, 'w') as w:
-       w.write(result)
-
-
-def scp_file(filename, username, dest, path):
+@retrypolicy.retried
+def scp_file(filename, username, dest, path, ssh_options=None, pass_fds=()):
     """ download the config file to the device """
     os_scp_tmpl_cmd = ( [
                         'setsid', ]		# <-- first magic to skip ssh from asking password
                       + SETSID_OPTIONS.split() + [
                         'scp', ] 
-                      + SSH_OPTIONS.split() + [
+                      + (ssh_options or SSH_OPTIONS).split() + [
                         '{file}',
                         '{username}{at}{dest}:{path}',
                         ] )
@@ -73,53 +71,124 @@ def scp_file(filename, username, dest, path):
                                     path=path )
                      )
     print ("starting upload with cmd: ", os_cmd)
-    p = subprocess.Popen(os_cmd, shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    p = subprocess.Popen(deadlines.command(os_cmd, dest), shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, pass_fds=pass_fds)
     p.stdin.write(b"\n")   # <-- second magic happens here for sending copy confirmation to the device 
-    out, err = p.communicate()
+    out, err = deadlines.communicate(p, None, 'transfer', dest)
     if p.returncode!=0:
        print ("Error: subprocess return:\n{err}".format(err=err))
-       raise OSError("Error during file transfer")
+       error = OSError("Error during file transfer: " + err.decode(errors="replace").strip())
+       error.returncode = p.returncode
+       raise error
     print (out)
     return err 
 
 
-def load_file_delayed(filename, dest, username, wait):
-    """ activate the configuration file via EEM """
-    with tempfile.NamedTemporaryFile() as temp:
-         eem_cfg = EEM_TEMPLATE.format(wait=wait, file=os.path.basename(filename))
-         temp.write(eem_cfg)
-         temp.flush()
-         rc = scp_file(temp.name, username, dest, RUNNING_CONFIG)
-         return rc
+@retrypolicy.retried_before_login
+def copy_running_config(filename, username, dest, ssh_options=None, pass_fds=()):
+    """ scp_file into the running-config: the lines are applied as they are received, so a
+        session which failed once logged in is not retried, part of them may have been applied """
+    return scp_file.__wrapped__(filename, username, dest, RUNNING_CONFIG, ssh_options, pass_fds)
+
+
+@retrypolicy.retried
+def ssh_cmd(username, dest, cmd, ssh_options=None):
+    """ launch a command on remote device, return its output """
+    os_ssh_tmpl_cmd = ( [
+                        'setsid', ] # <-- first magic to skip ssh from asking password
+                        + SETSID_OPTIONS.split() + [
+                        'ssh', 
+                        ] 
+                      + (ssh_options or SSH_OPTIONS).split() + [
+                        '{username}{at}{dest}',
+                        '{cmd}'
+                        ] )
+    os_cmd = []
+    for word in os_ssh_tmpl_cmd:
+       os_cmd.append ( word.format( cmd=cmd,
+                                    username=username, 
+                                    dest=dest, 
+                                    at ='@' if username!='' else '') 
+                     )
+    print ("starting remote command with cmd: ", os_cmd)
+    p = subprocess.Popen(deadlines.command(os_cmd, dest), shell=False, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    out, err = deadlines.communicate(p, None, 'exec', dest)
+    if p.returncode!=0:
+       print ("Error: subprocess return:\n{err}".format(err=err))
+       error = OSError("Error during remote ssh command: " + err.decode(errors="replace").strip())
+       error.returncode = p.returncode
+       raise error
+    print ("done, {n} bytes received".format(n=len(out)))
+    return out.decode(errors="replace")
+
+# the name of the step in cfgflow, as in EkinopsCfg
+fetch_output = ssh_cmd
+
+
+def parse_staged(listing):
+    """ the files staged by CiscoCfg in the output of LIST_STAGED: { name: size } """
+    return { name: int(size) for size, name in STAGED_REGEX.findall(listing) }
+
+
+def list_staged(username, dest, ssh_options=None):
+    """ the files staged on the device, empty if they can not be listed """
+    try:
+        return parse_staged(ssh_cmd(username, dest, LIST_STAGED, ssh_options))
+    except OSError as e:
+        print ("{dest}: staged files not listed: {e}".format(dest=dest, e=e))
+        return {}
+
+
+def eem_applet(filename, wait, stale=()):
+    """ the EEM applet which loads the staged file after wait seconds, then deletes the stale staged files """
+    cleanup = ''.join('  action 2.{n} cli command "delete /force {fs}{file}"\n'.format(
+                      n=n, fs=CISCO_FILESYSTEM, file=name) for n, name in enumerate(stale, 1))
+    return EEM_TEMPLATE.format(wait=wait, file=os.path.basename(filename), cleanup=cleanup)
+
+
+def load_file_delayed(filename, dest, username, wait, ssh_options=None, stale=(), activate_at=None):
+    """ activate the configuration file via EEM, after wait seconds or at the epoch time activate_at:
+        the countdown is then computed as each attempt renders the applet, so neither the
+        logins before it nor the retries delay the activation. As copy_running_config, the applet
+        is only sent again if the session failed before the login """
+    @retrypolicy.retried_before_login
+    def send_applet(dest, ssh_options):
+        countdown = activation.countdown(activate_at, dest) if activate_at is not None else wait
+        with cfgcommon.memory_file(eem_applet(filename, countdown, stale)) as (path, fds):
+            return scp_file.__wrapped__(path, username, dest, RUNNING_CONFIG, ssh_options, fds)
+    return send_applet(dest, ssh_options)
 
 
 # The global API
-def ssh_cfg (dest, tmpl_name, out_file, data=None, engine='string', username='', delay=0, dryrun=False):
+def ssh_cfg (dest, tmpl_name, out_file=None, data=None, engine='string', username='', delay=0, dryrun=False, multiplex=False,
+             incremental=False, state_db=None, force=False, activate_at=None):
     """ render a template and send it to a remote cisco device 
 
     Keywords arguments:
        dest:      the Cisco device where to push the configuration
        tmpl_name: the filename of the configuration template
-       out_file:  the name of the file used to render the template, mais be /dev/stdout for dryrun
+       out_file:  keep a copy of the resolved template in this file (optional),
+                  the configuration is otherwise only kept in memory
        data:      a dictinnary which contains the data
        engine:    the template engine used, default is standard string Template, 
                   may be pitype for Jinja2 like templating
        username:  the user used to log the device
        delay:     differ the execution of the configuration by delay seconds
        dryrun:    test mode, do no send the configuration to the device
+       multiplex: reuse a single ssh master connection for all the transfers
+       incremental: fetch the running-config and only send the sections which differ
+       state_db:  sqlite database recording the configurations already pushed (optional),
+                  the device is skipped if it already received the same configuration
+       force:     send the configuration even if the state_db says it was already pushed
+       activate_at: apply the configuration at this epoch time instead of after delay, the EEM countdown
+                  is what remains of it once the upload is done (see activation.py)
+    returns False if nothing was sent because the device already has the configuration
     """
-    render_template (tmpl_name, out_file, data, engine)  # resolve template
-    if dryrun:
-        print ("template resolved into {out_file}".format(out_file=out_file))
-    else:
-        if delay==0:
-            rc = scp_file (out_file, username, dest, RUNNING_CONFIG)
-        else:
-            # send resolved template to device as a file, then use EEM to load it into running-config after countdown
-            rc = scp_file (out_file, username, dest, CISCO_FILESYSTEM+os.path.basename(out_file))
-            load_file_delayed(out_file, dest, username, delay)
-        os.remove(out_file)
-
+    return cfgflow.run(cfgflow.config_flow(sys.modules[__name__], dest, tmpl_name, out_file, data, engine, username,
+                                           delay, dryrun, multiplex, incremental, state_db, force,
+                                           activate_at=activate_at),
+                       cfgflow.Blocking(sys.modules[__name__]))
 
 if __name__ == "__main__":
     def read_command_line ():
@@ -129,13 +198,37 @@ if __name__ == "__main__":
         parser.add_option('-a', '--address',  help='DNS hostname or current ip admin address')
         parser.add_option('-u', '--username', help='username to be used for configuring device', default='')
         parser.add_option('-t', '--template', help='The template to be applied')
-        parser.add_option('-d', '--data',     help="The template's variables in a json object (optional)", 
+        parser.add_option('-d', '--data',     help="The template's variables in a json object, @file to read them from a file (optional)", 
                                               default = '{}')
-        parser.add_option('-o', '--output',   help='The output file (optional)',                           
-                                              default=tempfile.NamedTemporaryFile().name)
+        parser.add_option('-o', '--output',   help='Keep the resolved template in this file, in this directory for a record file (optional)')
         parser.add_option('-w', '--wait',     help="wait n seconds before applying template (optional)",   
                                               type="int", default=0)
+        parser.add_option('--at',             help="apply the configuration at this time instead of -w: epoch, ISO date or HH:MM[:SS]")
         parser.add_option('-E', '--engine',   help="Template engine [string, tipyte]", default='string')
+        parser.add_option('-K', '--pack',     help="tipyte templates pre-compiled by PackTemplates.py, used instead of the template files (optional)")
+        parser.add_option('-M', '--multiplex', action="store_true", default=False,
+                                              help="open a single ssh connection to the device")
+        parser.add_option('-I', '--incremental', action="store_true", default=False,
+                                              help="only send what differs from the running-config")
+        parser.add_option('-S', '--state',    help="database of the configurations already pushed (optional)")
+        parser.add_option('-F', '--force',    action="store_true", default=False,
+                                              help="send the configuration even if it was already pushed")
+        parser.add_option('--retries',        help="retries of a session which failed for a transient reason",
+                                              type="int", default=retrypolicy.RETRIES)
+        parser.add_option('--login-rate',     help="at most n new ssh logins per second (0: no limit)",
+                                              type="float", default=0.0)
+        parser.add_option('--connect-timeout', help="seconds to establish a ssh session (0: no limit)",
+                                              type="float", default=deadlines.CONNECT_TIMEOUT)
+        parser.add_option('--transfer-timeout', help="seconds a file transfer may last once connected (0: no limit)",
+                                              type="float", default=deadlines.TRANSFER_TIMEOUT)
+        parser.add_option('--exec-timeout',   help="seconds a remote command may last once connected (0: no limit)",
+                                              type="float", default=deadlines.EXEC_TIMEOUT)
+        parser.add_option('--budget',         help="seconds the device may take, retries included, activation wait excluded (0: no limit)",
+                                              type="float", default=0.0)
+        parser.add_option('--metrics',        help="append the timing of each phase to this json lines file (optional)")
+        parser.add_option('--prometheus',     help="write the phase totals to this Prometheus textfile (optional)")
+        parser.add_option('-j', '--workers',  help="with -d @records, number of devices configured at once",
+                                              type="int", default=1)
         parser.add_option('-D', '--dryrun',   action="store_true", default=False,
                                               help="Only resolve the template, do not send to host")
         # Parse the argument
@@ -144,21 +237,54 @@ if __name__ == "__main__":
 
 
     args = read_command_line()                     # parse command line
-    # deserialize data 
-    if args.data.startswith('@'): # if args.data starts with '@' it points to a file otherwise it is the data
-        with open(args.data[1:], 'r') as f:
-              data = json.load(f)
+    retrypolicy.configure(args.retries, args.login_rate)
+    deadlines.configure(args.connect_timeout, args.transfer_timeout, args.exec_timeout, args.budget)
+    activate_at = activation.parse_time(args.at) if args.at else None
+    if args.pack:                                  # templates pre-compiled by PackTemplates.py
+        import tipyte
+        tipyte.load_template_pack(args.pack)
+    if args.data.startswith('@') and jsonstream.is_record_file(args.data[1:]):
+        # json list or json lines: one { host, username, data, template } record per device,
+        # read one at a time so the size of the file does not matter
+        import FleetCfg
+        with cfgmetrics.recording(args.metrics, args.prometheus):
+            FleetCfg.print_results(FleetCfg.iter_fleet_cfg (
+                                   devices   = jsonstream.read_records(args.data[1:]),
+                                   tmpl_name = args.template,
+                                   model     = MODEL,
+                                   out_dir   = args.output,
+                                   workers   = args.workers,
+                                   username  = args.username,
+                                   engine    = args.engine,
+                                   delay     = args.wait,
+                                   activate_at = activate_at,
+                                   dryrun    = args.dryrun,
+                                   state_db  = args.state,
+                                   force     = args.force,
+                                   multiplex = args.multiplex,
+                                   incremental = args.incremental))
     else:
-              data = json.loads(args.data)
-    # Call main API
-    ssh_cfg (dest      = args.address, 
-             tmpl_name = args.template,
-             out_file  = args.output,
-             data      = data,
-             engine    = args.engine,
-             username  = args.username, 
-             delay     = args.wait,
-             dryrun    = args.dryrun)
+        # deserialize data 
+        if args.data.startswith('@'): # if args.data starts with '@' it points to a file otherwise it is the data
+            with open(args.data[1:], 'r') as f:
+                  data = json.load(f)
+        else:
+                  data = json.loads(args.data)
+        # Call main API
+        with cfgmetrics.recording(args.metrics, args.prometheus), deadlines.device_budget():
+            ssh_cfg (dest      = args.address, 
+                     tmpl_name = args.template,
+                     out_file  = args.output,
+                     data      = data,
+                     engine    = args.engine,
+                     username  = args.username, 
+                     delay     = args.wait,
+                     activate_at = activate_at,
+                     dryrun    = args.dryrun,
+                     state_db  = args.state,
+                     force     = args.force,
+                     multiplex = args.multiplex,
+                     incremental = args.incremental)
 
 
 
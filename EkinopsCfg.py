@@ -9,47 +9,54 @@
 
 import optparse
 import json
-import string
 import os
-import tempfile
+import sys
 import subprocess
-import time
+import activation
+import cfgcommon
+import cfgflow
+import deadlines
+import cfgmetrics
+import jsonstream
+import retrypolicy
+import hashlib
+import re
 
 # disable prompt for new ssh connections (setsid may not behave correctly)
 SSH_OPTIONS = '-o StrictHostKeyChecking=no'
 SETSID_OPTIONS = '-w'
+# the device model of this driver (cfgflow)
+MODEL = 'ekinops'
 
 # Ekinops location to store file before putting it in runing-config
 # This directory must have been created before !!
 EKINOPS_FILESYSTEM  =   "/BSA/scripts/"
+# name of the script staged on the device, id is the md5 of its content so an identical
+# script already staged (retry, new run) is not sent again
+STAGED_FILE         =   "EkinopsCfg-{id}.cfg"
+# listing of the staged scripts: "-rw-r--r--  1 root root  1234 Mar  1 10:00 EkinopsCfg-<md5>.cfg"
+LIST_STAGED         =   "ls -l " + EKINOPS_FILESYSTEM
+STAGED_REGEX        =   re.compile(r'^\S+\s+\d+\s+\S+\s+\S+\s+(\d+)\s.*\s(EkinopsCfg-[0-9a-f]{32}\.cfg)\s*$', re.M)
+# removal of the stale staged scripts
+DELETE_STAGED       =   "rm {paths}"
+# !! -echo seems to be mandatory
+EXEC_COMMAND        =   "exec -echo {path}"
+# batched execs: the commands are read by one ssh session, BATCH_SYNC is sent after each
+# script and the line it prints marks the end of the script output. An output line
+# matching BATCH_ERROR_REGEX stops the batch before the next script
+BATCH_SYNC          =   "echo {marker}"
+BATCH_MARKER        =   "EkinopsCfg-step-{n}-done"
+BATCH_ERROR_REGEX   =   re.compile(r'^\s*(%|Error|ERROR|Invalid input|Unknown command).*$', re.M)
 
 
-def render_template(tmpl_name, out_file, data, engine):
-   """ read the 'template' and resolve it with safe_substitute """
-   if engine=="string":
-       with open(tmpl_name, 'r') as f:
-           src = string.Template(f.read())
-           result = src.safe_substitute(data)
-   elif engine=="tipyte":
-       import tipyte
-       def nothing(a):
-          return a
-       render_inbox = tipyte.template_to_function(tmpl_name, escaper=nothing)
-       result = render_inbox(data)  # do not use kwargs syntax data=data
-   else:
-       raise AttributeError("Unknown template engine")
-   # write result in a file
-   with open (out_file, 'w') as w:
-       w.write(result)
-
-
-def scp_file(filename, username, dest, path):
+@retrypolicy.retried
+def scp_file(filename, username, dest, path, ssh_options=None, pass_fds=()):
     """ download the config file to the device """
     os_scp_tmpl_cmd = ( [
                         'setsid', ]		# <-- first magic to skip ssh from asking password
                       + SETSID_OPTIONS.split() + [
                         'scp', ] 
-                      + SSH_OPTIONS.split() + [
+                      + (ssh_options or SSH_OPTIONS).split() + [
                         '{file}',
                         '{username}{at}{dest}:{path}',
                         ] )
@@ -62,23 +69,27 @@ def scp_file(filename, username, dest, path):
                                     path=path )
                      )
     print ("starting upload with cmd: ", os_cmd)
-    p = subprocess.Popen(os_cmd, shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = p.communicate()
+    p = subprocess.Popen(deadlines.command(os_cmd, dest), shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, pass_fds=pass_fds)
+    out, err = deadlines.communicate(p, None, 'transfer', dest)
     if p.returncode!=0:
        print ("Error: subprocess return:\n{err}".format(err=err))
-       raise OSError("Error during file transfer")
+       error = OSError("Error during file transfer: " + err.decode(errors="replace").strip())
+       error.returncode = p.returncode
+       raise error
     print (out)
     return err 
 
 
-def ssh_cmd(username, dest, cmd):
+@retrypolicy.retried
+def ssh_cmd(username, dest, cmd, ssh_options=None):
     """ launch a command on remote device """
     os_ssh_tmpl_cmd = ( [
                         'setsid', ] # <-- first magic to skip ssh from asking password
                         + SETSID_OPTIONS.split() + [
                         'ssh', 
                         ] 
-                      + SSH_OPTIONS.split() + [
+                      + (ssh_options or SSH_OPTIONS).split() + [
                         '{username}{at}{dest}',
                         '{cmd}'
                         ] )
@@ -90,41 +101,232 @@ def ssh_cmd(username, dest, cmd):
                                     at ='@' if username!='' else '') 
                      )
     print ("starting upload with cmd: ", os_cmd)
-    p = subprocess.Popen(os_cmd, shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    p.stdin.write (cmd)
-    out, err = p.communicate()
+    p = subprocess.Popen(deadlines.command(os_cmd, dest), shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    out, err = deadlines.communicate(p, cmd.encode(), 'exec', dest)
     if p.returncode!=0:
        print ("Error: subprocess return:\n{err}".format(err=err))
-       raise OSError("Error during remote ssh command")
+       error = OSError("Error during remote ssh command: " + err.decode(errors="replace").strip())
+       error.returncode = p.returncode
+       raise error
     print ("done, output was:", out)
     return err 
 
 
+@retrypolicy.retried_before_login
+def exec_cmd(username, dest, cmd, ssh_options=None):
+    """ ssh_cmd for a command which must not run twice: a session which failed
+        once logged in is not retried, part of the script may have been applied """
+    return ssh_cmd.__wrapped__(username, dest, cmd, ssh_options)
+
+
+@retrypolicy.retried
+def fetch_output(username, dest, cmd, ssh_options=None):
+    """ launch a command on remote device, return its output """
+    at = '@' if username!='' else ''
+    os_cmd = ( [ 'setsid', ] + SETSID_OPTIONS.split() + [ 'ssh', ]
+               + (ssh_options or SSH_OPTIONS).split()
+               + [ '{username}{at}{dest}'.format(username=username, at=at, dest=dest), cmd ] )
+    print ("starting remote command with cmd: ", os_cmd)
+    p = subprocess.Popen(deadlines.command(os_cmd, dest), shell=False, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    out, err = deadlines.communicate(p, None, 'exec', dest)
+    if p.returncode!=0:
+       print ("Error: subprocess return:\n{err}".format(err=err))
+       error = OSError("Error during remote ssh command: " + err.decode(errors="replace").strip())
+       error.returncode = p.returncode
+       raise error
+    print ("done, {n} bytes received".format(n=len(out)))
+    return out.decode(errors="replace")
+
+
+def parse_staged(listing):
+    """ the scripts staged by EkinopsCfg in the output of LIST_STAGED: { name: size } """
+    return { name: int(size) for size, name in STAGED_REGEX.findall(listing) }
+
+
+def list_staged(username, dest, ssh_options=None):
+    """ the scripts staged on the device, empty if they can not be listed """
+    try:
+        return parse_staged(fetch_output(username, dest, LIST_STAGED, ssh_options))
+    except OSError as e:
+        print ("{dest}: staged files not listed: {e}".format(dest=dest, e=e))
+        return {}
+
+
+def delete_staged(username, dest, names, ssh_options=None):
+    """ remove stale staged scripts, a failure is only reported """
+    if not names:
+        return
+    try:
+        ssh_cmd (username, dest, DELETE_STAGED.format(paths=' '.join(EKINOPS_FILESYSTEM + name for name in names)),
+                 ssh_options)
+    except OSError as e:
+        print ("{dest}: stale staged files not deleted: {e}".format(dest=dest, e=e))
+
+
+def exec_file(username, dest, filename, ssh_options=None, stale=()):
+    """ run the configuration file staged in EKINOPS_FILESYSTEM, then delete the stale staged files """
+    with cfgmetrics.phase('exec', dest):
+        rc = exec_cmd (username, dest, EXEC_COMMAND.format(path=EKINOPS_FILESYSTEM + filename), ssh_options)
+    delete_staged(username, dest, stale, ssh_options)
+    return rc
+
+
+@retrypolicy.retried
+def scp_files(filenames, username, dest, path, ssh_options=None):
+    """ download several files into the directory path of the device with a single session """
+    at = '@' if username!='' else ''
+    os_cmd = ( [ 'setsid', ] + SETSID_OPTIONS.split() + [ 'scp', ]
+               + (ssh_options or SSH_OPTIONS).split() + list(filenames)
+               + [ '{username}{at}{dest}:{path}'.format(username=username, at=at, dest=dest, path=path) ] )
+    print ("starting upload with cmd: ", os_cmd)
+    p = subprocess.Popen(deadlines.command(os_cmd, dest), shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    out, err = deadlines.communicate(p, None, 'transfer', dest)
+    if p.returncode!=0:
+       print ("Error: subprocess return:\n{err}".format(err=err))
+       error = OSError("Error during file transfer: " + err.decode(errors="replace").strip())
+       error.returncode = p.returncode
+       raise error
+    print (out)
+    return err
+
+
+def render_scripts(tmpl_names, data, engine, directory):
+    """ resolve each template into a file of directory named by the hash of its content (STAGED_FILE),
+        return the (template, name, size) of the scripts in order """
+    scripts = []
+    for tmpl_name in tmpl_names:
+        content = cfgcommon.resolve_template(tmpl_name, data, engine).encode('utf-8')
+        name = STAGED_FILE.format(id=hashlib.md5(content).hexdigest())
+        with open(os.path.join(directory, name), 'wb') as w:
+            w.write(content)
+        scripts.append((tmpl_name, name, len(content)))
+    return scripts
+
+
+def read_step(stream, marker):
+    """ read the output of a step up to its marker line, return the output and
+        False if the session ended before the marker """
+    lines = []
+    for line in iter(stream.readline, b''):
+        line = line.decode(errors="replace")
+        if line.strip() == marker:
+            return ''.join(lines), True
+        lines.append(line)
+    return ''.join(lines), False
+
+
+def step_error(n, tmpl_name, output, complete, err=b''):
+    """ the OSError which stops a batch at step n, None if the step went well """
+    if not complete:
+        message = "session closed: " + err.decode(errors="replace").strip()
+    else:
+        failure = BATCH_ERROR_REGEX.search(output)
+        if failure is None:
+            return None
+        message = failure.group(0).strip()
+    error = OSError("Error during batch step {n} ({tmpl}): {message}".format(n=n, tmpl=tmpl_name, message=message))
+    error.returncode = 1
+    return error
+
+
+def exec_batch(username, dest, filenames, tmpl_names, ssh_options=None, stale=()):
+    """ run the scripts staged in EKINOPS_FILESYSTEM in order within a single ssh session, stop at the
+        first one whose output shows an error, then delete the stale staged files.
+        Not retried: the scripts already run would be run again """
+    at = '@' if username!='' else ''
+    os_cmd = ( [ 'setsid', ] + SETSID_OPTIONS.split() + [ 'ssh', ]
+               + (ssh_options or SSH_OPTIONS).split()
+               + [ '-T', '{username}{at}{dest}'.format(username=username, at=at, dest=dest) ] )
+    commands = [ EXEC_COMMAND.format(path=EKINOPS_FILESYSTEM + name) for name in filenames ]
+    if stale:
+        commands.append(DELETE_STAGED.format(paths=' '.join(EKINOPS_FILESYSTEM + name for name in stale)))
+    print ("starting batch session with cmd: ", os_cmd)
+    error, n, output, complete = None, 0, '', True
+    with cfgmetrics.phase('exec', dest), \
+         subprocess.Popen(deadlines.command(os_cmd, dest), shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE) as p, \
+         deadlines.watchdog(p, 'exec', dest):
+        for n, command in enumerate(commands, 1):
+            marker = BATCH_MARKER.format(n=n)
+            try:
+                p.stdin.write((command + '\n' + BATCH_SYNC.format(marker=marker) + '\n').encode())
+                p.stdin.flush()
+                output, complete = read_step(p.stdout, marker)
+            except BrokenPipeError:
+                output, complete = '', False
+            print (output, end='')
+            if n > len(filenames):          # removal of the stale scripts, a failure is only reported
+                if not complete or BATCH_ERROR_REGEX.search(output):
+                    print ("{dest}: stale staged files not deleted".format(dest=dest))
+                break
+            if not complete:
+                break
+            error = step_error(n, tmpl_names[n-1], output, True)
+            if error is not None:
+                break
+            print ("{dest}: step {n}/{count} done".format(dest=dest, n=n, count=len(filenames)))
+        try:
+            p.stdin.close()         # end of the session
+        except BrokenPipeError:
+            pass
+        err = p.stderr.read()
+        p.wait()
+        if error is None and not complete and n <= len(filenames):
+            error = step_error(n, tmpl_names[n-1], output, False, err)
+            error.returncode = p.returncode or 1
+    if error is not None:
+        print ("Error: {e}".format(e=error))
+        raise error
+    return err
+
+
+def ssh_cfg_batch (dest, tmpl_names, out_file=None, data=None, engine='string', username='', delay=0, dryrun=False,
+                   multiplex=False, state_db=None, force=False, activate_at=None, deferred=False):
+    """ render several templates and run the scripts in order on a remote ekinops device,
+        the arguments are those of ssh_cfg. The scripts missing on the device are staged by
+        a single scp and all of them are run by a single ssh session, so the number of logins
+        does not depend on the number of scripts. The session stops at the first script whose
+        output shows an error (BATCH_ERROR_REGEX), the next ones are not run.
+    returns False if nothing was sent because the device already has the configuration
+    """
+    return cfgflow.run(cfgflow.batch_flow(sys.modules[__name__], dest, tmpl_names, out_file, data, engine, username,
+                                          delay, dryrun, multiplex, state_db, force, activate_at=activate_at,
+                                          deferred=deferred),
+                       cfgflow.Blocking(sys.modules[__name__]))
+
 # The global API
-def ssh_cfg (dest, tmpl_name, out_file, data=None, engine='string', username='', delay=0, dryrun=False):
+def ssh_cfg (dest, tmpl_name, out_file=None, data=None, engine='string', username='', delay=0, dryrun=False, multiplex=False,
+             state_db=None, force=False, activate_at=None, deferred=False):
     """ render a template and send it to a remote cisco device 
 
     Keywords arguments:
        dest:      the Cisco device where to push the configuration
-       tmpl_name: the filename of the configuration template
-       out_file:  the name of the file used to render the template, mais be /dev/stdout for dryrun
+       tmpl_name: the filename of the configuration template, a list of filenames runs
+                  the scripts in order within one session (see ssh_cfg_batch)
+       out_file:  keep a copy of the resolved template in this file (optional),
+                  the configuration is otherwise only kept in memory
        data:      a dictinnary which contains the data
        engine:    the template engine used, default is standard string Template, 
                   may be pitype for Jinja2 like templating
        username:  the user used to log the device
        delay:     differ the execution of the configuration by delay seconds
        dryrun:    test mode, do no send the configuration to the device
+       multiplex: reuse a single ssh master connection for all the transfers
+       state_db:  sqlite database recording the configurations already pushed (optional),
+                  the device is skipped if it already received the same configuration
+       force:     send the configuration even if the state_db says it was already pushed
+       activate_at: exec the configuration at this epoch time instead of after delay (see activation.py)
+       deferred:  do not wait for the exec, return the concurrent.futures.Future of the exec instead,
+                  which runs on its own ssh session
+    returns False if nothing was sent because the device already has the configuration
     """
-    render_template (tmpl_name, out_file, data, engine)  # resolve template
-    if dryrun:
-        print ("template resolved into {out_file}".format(out_file=out_file))
-    else:
-        rc = scp_file (out_file, username, dest, EKINOPS_FILESYSTEM + os.path.basename(out_file))
-        time.sleep (delay)
-        # !! -echo seems to be mandatory
-        rc = ssh_cmd (username, dest, "exec -echo " + EKINOPS_FILESYSTEM + os.path.basename(out_file))
-        os.remove(out_file)
-
+    return cfgflow.run(cfgflow.config_flow(sys.modules[__name__], dest, tmpl_name, out_file, data, engine, username,
+                                           delay, dryrun, multiplex, state_db=state_db, force=force,
+                                           activate_at=activate_at, deferred=deferred),
+                       cfgflow.Blocking(sys.modules[__name__]))
 
 if __name__ == "__main__":
     def read_command_line ():
@@ -133,14 +335,37 @@ if __name__ == "__main__":
         # configure option parsing with default destination (longnames)
         parser.add_option('-a', '--address',  help='DNS hostname or current ip admin address')
         parser.add_option('-u', '--username', help='username to be used for configuring device', default='')
-        parser.add_option('-t', '--template', help='The template to be applied')
-        parser.add_option('-d', '--data',     help="The template's variables in a json object (optional)", 
+        parser.add_option('-t', '--template', help='The template to be applied, repeat -t to run several scripts in order within one session',
+                                              action='append')
+        parser.add_option('-d', '--data',     help="The template's variables in a json object, @file to read them from a file (optional)", 
                                               default = '{}')
-        parser.add_option('-o', '--output',   help='The output file (optional)',                           
-                                              default=tempfile.NamedTemporaryFile().name)
+        parser.add_option('-o', '--output',   help='Keep the resolved template in this file, in this directory for a record file (optional)')
         parser.add_option('-w', '--wait',     help="wait n seconds before applying template (optional)",   
                                               type="int", default=0)
+        parser.add_option('--at',             help="apply the configuration at this time instead of -w: epoch, ISO date or HH:MM[:SS]")
         parser.add_option('-E', '--engine',   help="Template engine [string, tipyte]", default='string')
+        parser.add_option('-K', '--pack',     help="tipyte templates pre-compiled by PackTemplates.py, used instead of the template files (optional)")
+        parser.add_option('-M', '--multiplex', action="store_true", default=False,
+                                              help="open a single ssh connection to the device")
+        parser.add_option('-S', '--state',    help="database of the configurations already pushed (optional)")
+        parser.add_option('-F', '--force',    action="store_true", default=False,
+                                              help="send the configuration even if it was already pushed")
+        parser.add_option('--retries',        help="retries of a session which failed for a transient reason",
+                                              type="int", default=retrypolicy.RETRIES)
+        parser.add_option('--login-rate',     help="at most n new ssh logins per second (0: no limit)",
+                                              type="float", default=0.0)
+        parser.add_option('--connect-timeout', help="seconds to establish a ssh session (0: no limit)",
+                                              type="float", default=deadlines.CONNECT_TIMEOUT)
+        parser.add_option('--transfer-timeout', help="seconds a file transfer may last once connected (0: no limit)",
+                                              type="float", default=deadlines.TRANSFER_TIMEOUT)
+        parser.add_option('--exec-timeout',   help="seconds a remote command may last once connected (0: no limit)",
+                                              type="float", default=deadlines.EXEC_TIMEOUT)
+        parser.add_option('--budget',         help="seconds the device may take, retries included, activation wait excluded (0: no limit)",
+                                              type="float", default=0.0)
+        parser.add_option('--metrics',        help="append the timing of each phase to this json lines file (optional)")
+        parser.add_option('--prometheus',     help="write the phase totals to this Prometheus textfile (optional)")
+        parser.add_option('-j', '--workers',  help="with -d @records, number of devices configured at once",
+                                              type="int", default=1)
         parser.add_option('-D', '--dryrun',   action="store_true", default=False,
                                               help="Only resolve the template, do not send to host")
         # Parse the argument
@@ -149,21 +374,54 @@ if __name__ == "__main__":
 
 
     args = read_command_line()                     # parse command line
-    # deserialize data 
-    if args.data.startswith('@'): # if args.data starts with '@' it points to a file otherwise it is the data
-        with open(args.data[1:], 'r') as f:
-              data = json.load(f)
+    retrypolicy.configure(args.retries, args.login_rate)
+    deadlines.configure(args.connect_timeout, args.transfer_timeout, args.exec_timeout, args.budget)
+    if args.template and len(args.template)==1:
+        args.template = args.template[0]
+    activate_at = activation.parse_time(args.at) if args.at else None
+    if args.pack:                                  # templates pre-compiled by PackTemplates.py
+        import tipyte
+        tipyte.load_template_pack(args.pack)
+    if args.data.startswith('@') and jsonstream.is_record_file(args.data[1:]):
+        # json list or json lines: one { host, username, data, template } record per device,
+        # read one at a time so the size of the file does not matter
+        import FleetCfg
+        with cfgmetrics.recording(args.metrics, args.prometheus):
+            FleetCfg.print_results(FleetCfg.iter_fleet_cfg (
+                                   devices   = jsonstream.read_records(args.data[1:]),
+                                   tmpl_name = args.template,
+                                   model     = MODEL,
+                                   out_dir   = args.output,
+                                   workers   = args.workers,
+                                   username  = args.username,
+                                   engine    = args.engine,
+                                   delay     = args.wait,
+                                   activate_at = activate_at,
+                                   dryrun    = args.dryrun,
+                                   state_db  = args.state,
+                                   force     = args.force,
+                                   multiplex = args.multiplex))
     else:
-              data = json.loads(args.data)
-    # Call main API
-    ssh_cfg (dest      = args.address, 
-             tmpl_name = args.template,
-             out_file  = args.output,
-             data      = data,
-             engine    = args.engine,
-             username  = args.username, 
-             delay     = args.wait,
-             dryrun    = args.dryrun)
+        # deserialize data 
+        if args.data.startswith('@'): # if args.data starts with '@' it points to a file otherwise it is the data
+            with open(args.data[1:], 'r') as f:
+                  data = json.load(f)
+        else:
+                  data = json.loads(args.data)
+        # Call main API
+        with cfgmetrics.recording(args.metrics, args.prometheus), deadlines.device_budget():
+            ssh_cfg (dest      = args.address, 
+                     tmpl_name = args.template,
+                     out_file  = args.output,
+                     data      = data,
+                     engine    = args.engine,
+                     username  = args.username, 
+                     delay     = args.wait,
+                     activate_at = activate_at,
+                     dryrun    = args.dryrun,
+                     state_db  = args.state,
+                     force     = args.force,
+                     multiplex = args.multiplex)
 
 
 
@@ -0,0 +1,534 @@
+# -----------------------------------------------------------------------------
+# resolve a template and send the configuration to a fleet of devices
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# Each device of the inventory is processed by ssh_cfg from CiscoCfg or
+# EkinopsCfg, several devices are handled at once by a bounded worker pool.
+# The same SSH_ASKPASS and DISPLAY settings than CiscoCfg are required.
+# ----------------------------------------------------------------------------
+
+import optparse
+import os
+import time
+import string
+import marshal
+import itertools
+import collections
+import asyncio
+import threading
+import queue
+import concurrent.futures
+import contextlib
+
+import activation
+import cfgarchive
+import cfgjournal
+import cfgmetrics
+import deadlines
+import jsonstream
+import retrypolicy
+
+# the modules which know how to configure a device
+DRIVERS = { 'cisco': 'CiscoCfg', 'ekinops': 'EkinopsCfg' }
+# default number of devices configured at the same time
+FLEET_WORKERS = 16
+# number of devices rendered by a single task of render_batch
+BATCH_CHUNK_SIZE = 64
+
+
+def get_driver(model):
+    """ return the module (CiscoCfg or EkinopsCfg) which handles the model """
+    if model not in DRIVERS:
+        raise AttributeError("Unknown device model")
+    return __import__(DRIVERS[model])
+
+
+def iter_inventory(inventory):
+    """ yield the devices of the inventory one at a time: a json list or json lines (NDJSON)
+        of { host, username, data, template } objects, '-' reads the standard input """
+    return jsonstream.read_records(inventory)
+
+
+def prepare_device(device, out_dir=None):
+    """ return the initial result of a device and the file which will keep its configuration (if any) """
+    host   = device.get('host')
+    skip   = not host or device.get('skip')
+    result = { 'host': host, 'status': 'skipped' if skip else 'pending', 'duration': 0.0, 'stderr': '' }
+    if skip:
+        return result, None
+    out_file = os.path.join(out_dir, host + '.cfg') if out_dir is not None else None
+    return result, out_file
+
+
+def failure_status(error):
+    """ the status of a device whose configuration raised error: timeout or failed """
+    return 'timeout' if isinstance(error, deadlines.SessionTimeout) else 'failed'
+
+
+def configure_device(driver, device, tmpl_name, out_dir=None, username='', **options):
+    """ configure one device of the inventory with driver.ssh_cfg, return its result as a dictionary,
+        options are given as is to ssh_cfg """
+    result, out_file = prepare_device(device, out_dir)
+    if result['status']=='skipped':
+        return result
+    start = time.time()
+    try:
+        with deadlines.device_budget():
+            sent = driver.ssh_cfg (dest      = result['host'],
+                                   tmpl_name = device.get('template', tmpl_name),
+                                   out_file  = out_file,
+                                   data      = device.get('data', {}),
+                                   username  = device.get('username', username),
+                                   **options)
+        if isinstance(sent, concurrent.futures.Future):
+            result['status'] = 'staged'
+            result['activation'] = sent         # deferred exec, see activated
+            result['start'] = start
+        else:
+            result['status'] = 'skipped' if sent is False else 'ok'
+    except Exception as e:     # one failed device must not stop the fleet
+        result['status'] = failure_status(e)
+        result['stderr'] = str(e)
+    result['duration'] = time.time() - start
+    return result
+
+
+async def configure_device_async(model, device, tmpl_name, out_dir=None, username='', **options):
+    """ coroutine version of configure_device """
+    import aiotransport
+    result, out_file = prepare_device(device, out_dir)
+    if result['status']=='skipped':
+        return result
+    start = time.time()
+    try:
+        with deadlines.device_budget():
+            sent = await aiotransport.ssh_cfg (dest      = result['host'],
+                                               tmpl_name = device.get('template', tmpl_name),
+                                               out_file  = out_file,
+                                               data      = device.get('data', {}),
+                                               username  = device.get('username', username),
+                                               model     = model,
+                                               **options)
+        if isinstance(sent, asyncio.Future):
+            result['status'] = 'staged'
+            result['activation'] = sent         # deferred exec, see activated
+            result['start'] = start
+        else:
+            result['status'] = 'skipped' if sent is False else 'ok'
+    except Exception as e:     # one failed device must not stop the fleet
+        result['status'] = failure_status(e)
+        result['stderr'] = str(e)
+    result['duration'] = time.time() - start
+    return result
+
+
+def activated(result, error=None):
+    """ complete the result of a device once its deferred exec is done,
+        its duration then goes from the start of its staging to the end of the exec """
+    result['status'] = failure_status(error) if error else 'ok'
+    result['stderr'] = str(error) if error else ''
+    result['duration'] = time.time() - result.pop('start')
+    return result
+
+
+def defer_activations(model, options):
+    """ the ekinops execs run later (see activation.py) instead of holding a worker during the delay """
+    if model=='ekinops' and (options.get('delay') or options.get('activate_at') is not None):
+        options.setdefault('deferred', True)
+
+
+async def fleet_cfg_async (devices, tmpl_name, model='cisco', out_dir=None, workers=FLEET_WORKERS,
+                           username='', on_result=None, **options):
+    """ coroutine version of fleet_cfg: one event loop drives all the transfers,
+        at most workers devices are read from devices and handled at once.
+        Each result is given to on_result as soon as the device is done,
+        returns the list of results when on_result is not set """
+    get_driver(model)        # check model
+    defer_activations(model, options)
+    results = []
+    if on_result is None:
+        on_result = results.append
+    staged = {}              # deferred exec -> result of its device
+    def finished(result):
+        if 'activation' in result:
+            staged[result.pop('activation')] = result
+        else:
+            on_result(result)
+    pending = set()
+    for device in devices:
+        pending.add(asyncio.ensure_future(configure_device_async(model, device, tmpl_name, out_dir,
+                                                                 username, **options)))
+        if len(pending) >= workers:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                finished(task.result())
+    for task in asyncio.as_completed(pending):
+        finished(await task)
+    while staged:
+        done, _ = await asyncio.wait(staged, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            on_result(activated(staged.pop(task), task.exception()))
+    return results
+
+
+def iter_fleet_cfg_async (devices, tmpl_name, model='cisco', out_dir=None, workers=FLEET_WORKERS,
+                          username='', **options):
+    """ run fleet_cfg_async in a thread and yield its results as they come """
+    results = queue.Queue(maxsize=workers)
+    done = object()
+    failure = []
+    def run():
+        try:
+            asyncio.run(fleet_cfg_async(devices, tmpl_name, model, out_dir, workers, username,
+                                        on_result=results.put, **options))
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            results.put(done)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    for result in iter(results.get, done):
+        yield result
+    thread.join()
+    if failure:
+        raise failure[0]
+
+
+def iter_fleet_cfg (devices, tmpl_name, model='cisco', out_dir=None, workers=FLEET_WORKERS, use_asyncio=False,
+                    username='', **options):
+    """ generator version of fleet_cfg: yields the per device results as soon as they are done.
+        devices may be any iterable (see iter_inventory), it is read as the workers get free,
+        so the memory used does not depend on the size of the inventory """
+    if use_asyncio:
+        yield from iter_fleet_cfg_async(devices, tmpl_name, model, out_dir, workers, username, **options)
+        return
+    driver = get_driver(model)
+    defer_activations(model, options)
+    staged = {}              # deferred exec -> result of its device
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # keep a bounded number of devices in flight
+        max_pending = 2 * workers
+        pending = set()
+        for device in devices:
+            pending.add(pool.submit(configure_device, driver, device, tmpl_name, out_dir, username, **options))
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if 'activation' in result:
+                        staged[result.pop('activation')] = result
+                    else:
+                        yield result
+        for future in concurrent.futures.as_completed(pending):
+            result = future.result()
+            if 'activation' in result:
+                staged[result.pop('activation')] = result
+            else:
+                yield result
+    for future in concurrent.futures.as_completed(staged):
+        yield activated(staged[future], future.exception())
+
+
+# The global API
+def fleet_cfg (devices, tmpl_name, model='cisco', out_dir=None, workers=FLEET_WORKERS, use_asyncio=False,
+               username='', **options):
+    """ render a template and send it to every device of an inventory
+
+    Keywords arguments:
+       devices:   an iterable of dictionnaries with keys host, username (optional),
+                  data (optional), template (optional) and skip (optional)
+       tmpl_name: the default template, used when a device does not give its own
+       model:     the kind of devices [cisco, ekinops]
+       out_dir:   the directory where resolved templates are kept (optional)
+       workers:   the number of devices configured at the same time
+       use_asyncio: drive the transfers from one asyncio event loop instead of a thread pool
+       username:  the default user used to log the devices
+    the other keyword arguments (engine, delay, activate_at, dryrun, multiplex, incremental, state_db,
+    force...) are given to the ssh_cfg function of the model. The ekinops devices staged for a delayed
+    activation free their worker, their results come once their exec is done
+    returns the list of per device results in the order the devices were done,
+    use iter_fleet_cfg to handle them one at a time
+    """
+    return list(iter_fleet_cfg(devices, tmpl_name, model, out_dir, workers, use_asyncio, username, **options))
+
+
+def compile_for_batch(tmpl_name, engine):
+    """ compile the template once, return it in a form which can be sent to worker processes """
+    if engine=="string":
+        with open(tmpl_name, 'r') as f:
+            return f.read()
+    elif engine=="tipyte":
+        import tipyte
+        return marshal.dumps(tipyte.compile_template(os.path.abspath(tmpl_name)))
+    else:
+        raise AttributeError("Unknown template engine")
+
+
+def make_renderer(tmpl_name, engine, compiled=None):
+    """ return a function which resolves the template with a data dictionnary """
+    if compiled is None:
+        compiled = compile_for_batch(tmpl_name, engine)
+    if engine=="string":
+        return string.Template(compiled).safe_substitute
+    elif engine=="tipyte":
+        import tipyte
+        return tipyte.template_to_function(tmpl_name, escaper=tipyte.no_escape,
+                                           compiled_template=marshal.loads(compiled))
+    else:
+        raise AttributeError("Unknown template engine")
+
+
+# state of a render_batch worker process: the engine and a renderer per template
+_batch_engine = None
+_batch_renderers = {}
+
+def _init_batch_worker(engine, memoize=False):
+    """ worker initializer """
+    global _batch_engine
+    _batch_engine = engine
+    if memoize and engine=="tipyte":
+        import tipyte
+        tipyte.enable_render_memo()
+    _batch_renderers.clear()
+
+
+def _render_chunk(task):
+    """ worker task: resolve a list of (host, template, data) with the compiled forms of their templates,
+        return the list of (host, output). A list of templates (ekinops batch) gives the outputs of
+        its templates one after the other """
+    chunk, compiled = task
+    results = []
+    for host, tmpl_name, data in chunk:
+        try:
+            output = ''
+            for name in tmpl_name if isinstance(tmpl_name, list) else [ tmpl_name ]:
+                if name not in _batch_renderers:    # first device of this worker with this template
+                    if isinstance(compiled[name], Exception):
+                        raise compiled[name]
+                    _batch_renderers[name] = make_renderer(name, _batch_engine, compiled[name])
+                output += _batch_renderers[name](data)
+            results.append((host, output))
+        except Exception as e:
+            results.append((host, e))
+    return results
+
+
+def compile_chunk(chunk, engine, compiled):
+    """ the task of a chunk of devices for _render_chunk: compile the templates it uses which are
+        not in compiled yet (a template which does not compile gives its exception, sent instead) """
+    used = {}
+    for _, tmpl_name, _ in chunk:
+        for name in tmpl_name if isinstance(tmpl_name, list) else [ tmpl_name ]:
+            if name not in compiled:
+                try:
+                    if name is None:
+                        raise ValueError("No template for this device: give -t or a template in its record")
+                    compiled[name] = compile_for_batch(name, engine)
+                except Exception as e:
+                    compiled[name] = e
+            used[name] = compiled[name]
+    return chunk, used
+
+
+def render_batch(tmpl_name, devices, engine='string', processes=None, chunk_size=BATCH_CHUNK_SIZE,
+                 memoize=False, ordered=False):
+    """ resolve the template for every device of an inventory using all the cores
+
+    Each distinct template (tmpl_name, the default, or the template of a device) is
+    compiled once, then sent with the chunks of devices which use it to a pool of
+    worker processes.
+    Yields (host, output) as soon as they are rendered, in no particular order
+    unless ordered is set (then in the order of devices, at the cost of waiting
+    for the slowest chunk in flight);
+    output is the exception raised when the rendering of a device failed.
+    Devices without host or with skip set are ignored.
+    With memoize, each worker renders only once the templates and includes whose
+    variables have the same values (tipyte.RenderMemo).
+    """
+    compiled = {}
+    if tmpl_name is not None:           # a default template which does not compile stops the batch
+        compiled[tmpl_name] = compile_for_batch(tmpl_name, engine)
+    tasks = ( compile_chunk([ (device['host'], device.get('template', tmpl_name), device.get('data', {}))
+                              for device in chunk ], engine, compiled)
+              for chunk in iter_chunks((device for device in devices
+                                        if device.get('host') and not device.get('skip')), chunk_size) )
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=_init_batch_worker,
+                                                initargs=(engine, memoize)) as pool:
+        # keep a bounded number of chunks in flight, so huge inventories are not loaded at once
+        max_pending = 2 * (processes or os.cpu_count() or 1)
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(pool.submit(_render_chunk, task))
+            if len(pending) >= max_pending and ordered:
+                yield from pending.popleft().result()
+            elif len(pending) >= max_pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield from future.result()
+        for future in pending if ordered else concurrent.futures.as_completed(pending):
+            yield from future.result()
+
+
+def iter_chunks(iterable, size):
+    """ yield lists of at most size items of iterable """
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+def render_fleet(devices, tmpl_name, engine='string', out_dir=None, processes=None, memoize=False,
+                 archive=None):
+    """ dryrun of a whole inventory with render_batch, the outputs are written in out_dir,
+        in the archive file (tar, tar.gz, tar.xz or zip, in the inventory order, see cfgarchive.py)
+        or displayed, yields the per device results """
+    skipped = collections.deque()
+    def renderable(devices):
+        for device in devices:
+            result, _ = prepare_device(device)
+            if result['status']=='skipped':
+                skipped.append(result)
+            else:
+                yield device
+    with cfgarchive.ConfigArchive(archive) if archive else contextlib.nullcontext() as sink:
+        for host, output in render_batch(tmpl_name, renderable(devices), engine, processes, memoize=memoize,
+                                         ordered=sink is not None):
+            while skipped:
+                yield skipped.popleft()
+            result = { 'host': host, 'status': 'ok', 'duration': 0.0, 'stderr': '' }
+            if isinstance(output, Exception):
+                result['status'] = 'failed'
+                result['stderr'] = str(output)
+            elif sink is not None:
+                sink.add(host + '.cfg', output)
+            elif out_dir is not None:
+                with open(os.path.join(out_dir, host + '.cfg'), 'w') as w:
+                    w.write(output)
+            else:
+                print (output)
+            yield result
+    yield from skipped
+
+
+def print_results(results):
+    """ display the per device result table, a line as soon as each result comes """
+    print ("{:<30} {:<8} {:>9}  {}".format('host', 'status', 'duration', 'stderr'))
+    counts = { 'ok': 0, 'failed': 0, 'timeout': 0, 'skipped': 0 }
+    for r in results:
+        print ("{:<30} {:<8} {:>8.1f}s  {}".format(str(r['host']), r['status'], r['duration'],
+                                                   r['stderr'].replace('\n', ' ')), flush=True)
+        counts[r['status']] = counts.get(r['status'], 0) + 1
+    print ("{ok} ok, {failed} failed, {timeout} timeout, {skipped} skipped".format(**counts))
+
+
+if __name__ == "__main__":
+    def read_command_line ():
+        """ handle command line """
+        parser = optparse.OptionParser()
+        # configure option parsing with default destination (longnames)
+        parser.add_option('-i', '--inventory', help='json list or json lines file of the devices to configure, - for stdin')
+        parser.add_option('-m', '--model',    help='device model [cisco, ekinops]', default='cisco')
+        parser.add_option('-u', '--username', help='default username to be used for configuring devices',
+                                              default='')
+        parser.add_option('-t', '--template', help='The default template to be applied')
+        parser.add_option('-o', '--outdir',   help='keep the resolved templates into this directory (optional)')
+        parser.add_option('-O', '--archive',  help="with -D, write the resolved templates into this .tar, .tar.gz, .tar.xz or .zip file")
+        parser.add_option('-w', '--wait',     help="wait n seconds before applying template (optional)",
+                                              type="int", default=0)
+        parser.add_option('--at',             help="apply the configurations at this time instead of -w: epoch, ISO date or HH:MM[:SS]")
+        parser.add_option('-E', '--engine',   help="Template engine [string, tipyte]", default='string')
+        parser.add_option('-Z', '--memoize',  action="store_true", default=False,
+                                              help="tipyte: render only once the templates and includes reading the same values")
+        parser.add_option('-K', '--pack',     help="tipyte templates pre-compiled by PackTemplates.py, used instead of the template files (optional)")
+        parser.add_option('-j', '--workers',  help="number of devices configured at once",
+                                              type="int", default=FLEET_WORKERS)
+        parser.add_option('-A', '--asyncio',  action="store_true", default=False,
+                                              help="use the asyncio transport instead of a thread pool")
+        parser.add_option('-M', '--multiplex', action="store_true", default=False,
+                                              help="open a single ssh connection per device")
+        parser.add_option('-I', '--incremental', action="store_true", default=False,
+                                              help="only send what differs from the running-config (cisco)")
+        parser.add_option('-S', '--state',    help="database of the configurations already pushed (optional)")
+        parser.add_option('-F', '--force',    action="store_true", default=False,
+                                              help="send the configurations even if they were already pushed")
+        parser.add_option('--retries',        help="retries of a session which failed for a transient reason",
+                                              type="int", default=retrypolicy.RETRIES)
+        parser.add_option('--login-rate',     help="at most n new ssh logins per second (0: no limit)",
+                                              type="float", default=0.0)
+        parser.add_option('--connect-timeout', help="seconds to establish a ssh session (0: no limit)",
+                                              type="float", default=deadlines.CONNECT_TIMEOUT)
+        parser.add_option('--transfer-timeout', help="seconds a file transfer may last once connected (0: no limit)",
+                                              type="float", default=deadlines.TRANSFER_TIMEOUT)
+        parser.add_option('--exec-timeout',   help="seconds a remote command may last once connected (0: no limit)",
+                                              type="float", default=deadlines.EXEC_TIMEOUT)
+        parser.add_option('--budget',         help="seconds each device may take, retries included, activation wait excluded (0: no limit)",
+                                              type="float", default=0.0)
+        parser.add_option('--journal',        help="append the state of each device to this journal file (optional)")
+        parser.add_option('--resume',         action="store_true", default=False,
+                                              help="with --journal, only configure the devices not done in the journal")
+        parser.add_option('--metrics',        help="append the timing of each phase to this json lines file (optional)")
+        parser.add_option('--prometheus',     help="write the phase totals to this Prometheus textfile (optional)")
+        parser.add_option('-D', '--dryrun',   action="store_true", default=False,
+                                              help="Only resolve the templates, do not send to hosts")
+        parser.add_option('-P', '--processes', type="int", default=0,
+                                              help="with -D, resolve the templates on n processes (0: one per core)")
+        # Parse the argument
+        args,_ = parser.parse_args()
+        if args.incremental and args.model!='cisco':
+            parser.error("-I is only supported by cisco devices")
+        return args
+
+
+    args = read_command_line()                     # parse command line
+    if args.resume and not args.journal:
+        raise SystemExit("--resume needs the --journal of the run to resume")
+    retrypolicy.configure(args.retries, args.login_rate)
+    deadlines.configure(args.connect_timeout, args.transfer_timeout, args.exec_timeout, args.budget)
+    activate_at = activation.parse_time(args.at) if args.at else None
+    if args.pack:                                  # templates pre-compiled by PackTemplates.py
+        import tipyte
+        tipyte.load_template_pack(args.pack)
+    if args.memoize and not args.dryrun:           # the -D workers have their own memo
+        import tipyte
+        tipyte.enable_render_memo()
+    if args.dryrun:
+        print_results(render_fleet (devices   = iter_inventory(args.inventory),
+                                    tmpl_name = args.template,
+                                    engine    = args.engine,
+                                    out_dir   = args.outdir,
+                                    processes = args.processes or None,
+                                    memoize   = args.memoize,
+                                    archive   = args.archive))
+    else:
+        options = {}
+        if args.incremental:
+            options['incremental'] = True
+        devices = iter_inventory(args.inventory)
+        if args.resume:
+            devices = cfgjournal.unfinished(devices, args.journal)
+        with cfgmetrics.recording(args.metrics, args.prometheus), \
+             cfgjournal.Journal(args.journal) if args.journal else contextlib.nullcontext() as journal:
+            results = iter_fleet_cfg (devices   = devices,
+                                      tmpl_name = args.template,
+                                      model     = args.model,
+                                      out_dir   = args.outdir,
+                                      workers   = args.workers,
+                                      use_asyncio = args.asyncio,
+                                      username  = args.username,
+                                      engine    = args.engine,
+                                      delay     = args.wait,
+                                      activate_at = activate_at,
+                                      multiplex = args.multiplex,
+                                      state_db  = args.state,
+                                      force     = args.force,
+                                      **options)
+            if journal is None:
+                print_results(results)
+            else:
+                cfgmetrics.add_hook(journal)
+                try:
+                    print_results(journal.results(results))
+                finally:
+                    cfgmetrics.remove_hook(journal)
@@ -0,0 +1,48 @@
+# -----------------------------------------------------------------------------
+# pre-compile a directory of tipyte templates into a single pack file
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# The pack holds the code of the templates, the files they include and their
+# line maps: CiscoCfg, EkinopsCfg and FleetCfg load it with -K and do not
+# transpile anything at run time, which matters on small appliances.
+# The pack is tied to the python version and to tipyte.py, build it on the
+# target (or an identical host) and again when one of them changes:
+#    python PackTemplates.py -t templates -o templates/templates.tpk
+#    python CiscoCfg.py -K templates/templates.tpk -t templates/loopbacks.j2 -E tipyte ...
+# ----------------------------------------------------------------------------
+
+import optparse
+import os
+
+import tipyte
+
+# extensions of the tipyte templates
+PACK_EXTENSIONS = '.j2'
+
+
+if __name__ == "__main__":
+    def read_command_line ():
+        """ handle command line """
+        parser = optparse.OptionParser()
+        # configure option parsing with default destination (longnames)
+        parser.add_option('-t', '--templates', help='directory of the templates to pre-compile', default='.')
+        parser.add_option('-o', '--output',   help='the pack file (default: templates.tpk in the templates directory)')
+        parser.add_option('-x', '--extensions', help="comma separated extensions of the templates", 
+                                              default=PACK_EXTENSIONS)
+        parser.add_option('-l', '--list',     action="store_true", default=False,
+                                              help="list the templates of an existing pack given by -o")
+        # Parse the argument
+        args,_ = parser.parse_args()
+        return args
+
+
+    args = read_command_line()                     # parse command line
+    pack_path = args.output or os.path.join(args.templates, 'templates.tpk')
+    if args.list:
+        pack = tipyte.load_template_pack(pack_path)
+    else:
+        pack = tipyte.build_template_pack(args.templates, pack_path, tuple(args.extensions.split(',')))
+        print ("{n} templates compiled into {pack}".format(n=len(pack['templates']), pack=pack_path))
+    for name in sorted(pack['includes']):
+        print ("  {name}{includes}".format(name=name,
+                 includes=' -> ' + ', '.join(pack['includes'][name]) if pack['includes'][name] else ''))
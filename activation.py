@@ -0,0 +1,105 @@
+# -----------------------------------------------------------------------------
+# activate the staged configurations of a fleet at the same wall clock time
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# The configurations are uploaded as fast as the network allows, each device
+# then gets the countdown which remains between the end of its own upload and
+# the activation time: the EEM applet countdown for Cisco, a deferred exec for
+# Ekinops. Deferred execs wait in a single scheduler thread, so the workers
+# which uploaded the files are free to stage the next devices.
+# ----------------------------------------------------------------------------
+
+import concurrent.futures
+import datetime
+import heapq
+import itertools
+import math
+import threading
+import time
+
+# number of deferred execs run at the same time once their time has come
+ACTIVATION_WORKERS = 64
+
+
+def parse_time(text):
+    """ the activation time as epoch seconds, text is epoch seconds, an ISO date and time
+        or HH:MM[:SS] (today, tomorrow if this time is already over) """
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        pass
+    for time_format in ('%H:%M:%S', '%H:%M'):
+        try:
+            clock = datetime.datetime.strptime(text, time_format).time()
+            break
+        except ValueError:
+            continue
+    else:
+        raise ValueError("Invalid activation time: " + text)
+    at = datetime.datetime.combine(datetime.date.today(), clock)
+    if at.timestamp() <= time.time():
+        at += datetime.timedelta(days=1)
+    return at.timestamp()
+
+
+def countdown(at, dest=None):
+    """ whole seconds from now to the activation time at, raise OSError if it is over:
+        the device would be activated alone, its configuration stays staged """
+    remaining = math.ceil(at - time.time())
+    if remaining < 1:
+        raise OSError("Activation time {at} missed, the configuration is only staged".format(
+                      at=time.ctime(at)))
+    print ("{dest}: activation in {n} seconds".format(dest=dest, n=remaining))
+    return remaining
+
+
+class DeferredExec:
+    """ run functions at a wall clock time: a single thread waits for all of them, then
+        each one runs on a pool of threads. submit returns a concurrent.futures.Future """
+
+    def __init__(self, workers=ACTIVATION_WORKERS):
+        self.workers = workers
+        self.pool = None
+        self.thread = None
+        self.jobs = []      # heap of (time, sequence, future, function, args, kwargs)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    def submit(self, at, function, *args, **kwargs):
+        """ run function(*args, **kwargs) at the epoch time at """
+        future = concurrent.futures.Future()
+        with self.condition:
+            heapq.heappush(self.jobs, (at, next(self.sequence), future, function, args, kwargs))
+            if self.thread is None:
+                self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return future
+
+    def run(self):
+        """ the scheduler thread """
+        while True:
+            with self.condition:
+                while not self.jobs or self.jobs[0][0] > time.time():
+                    self.condition.wait(self.jobs[0][0] - time.time() if self.jobs else None)
+                _, _, future, function, args, kwargs = heapq.heappop(self.jobs)
+            self.pool.submit(self.execute, future, function, args, kwargs)
+
+    @staticmethod
+    def execute(future, function, args, kwargs):
+        """ run a job and give its outcome to its future """
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(function(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+
+# shared by all the devices of the process
+SCHEDULER = DeferredExec()
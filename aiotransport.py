@@ -0,0 +1,292 @@
+# -----------------------------------------------------------------------------
+# asyncio versions of the scp/ssh transfers done by CiscoCfg and EkinopsCfg
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# The subprocesses are driven by the event loop (asyncio.create_subprocess_exec)
+# so a single thread can handle thousands of devices at the same time.
+# ssh_cfg runs the flow of the sync drivers (cfgflow), Steps does its steps.
+# The same SSH_ASKPASS and DISPLAY settings than CiscoCfg are required.
+# ----------------------------------------------------------------------------
+
+import asyncio
+import functools
+import time
+
+import activation
+import cfgcommon
+import cfgflow
+import cfgmetrics
+import CiscoCfg
+import deadlines
+import EkinopsCfg
+import retrypolicy
+import sshmux
+
+# disable prompt for new ssh connections (setsid may not behave correctly)
+SSH_OPTIONS = CiscoCfg.SSH_OPTIONS
+SETSID_OPTIONS = CiscoCfg.SETSID_OPTIONS
+
+
+def build_cmd(program, args, ssh_options=None):
+    """ return the command line: setsid [options] program [ssh options] args """
+    return ( [ 'setsid', ]		# <-- first magic to skip ssh from asking password
+             + SETSID_OPTIONS.split()
+             + [ program, ]
+             + (ssh_options or SSH_OPTIONS).split()
+             + args )
+
+
+async def in_thread(function, *args):
+    """ run a blocking function (the rendering of a template) off the event loop """
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args))
+
+
+async def run_cmd(os_cmd, stdin_data, error, pass_fds=(), phase='exec', dest=None):
+    """ run the command, feed it with stdin_data and raise OSError(error) if it fails,
+        SessionTimeout if it outlives the deadline of phase """
+    p = await asyncio.create_subprocess_exec(*deadlines.command(os_cmd, dest), stdin=asyncio.subprocess.PIPE,
+                                             stdout=asyncio.subprocess.PIPE,
+                                             stderr=asyncio.subprocess.PIPE,
+                                             pass_fds=pass_fds)
+    out, err = await deadlines.communicate_async(p, stdin_data, phase, dest)
+    if p.returncode!=0:
+       print ("Error: subprocess return:\n{err}".format(err=err))
+       error = OSError(error + ": " + err.decode(errors="replace").strip())
+       error.returncode = p.returncode
+       raise error
+    return out, err
+
+
+@retrypolicy.retried
+async def scp_file(filename, username, dest, path, confirm=True, ssh_options=None, pass_fds=()):
+    """ download the config file to the device, confirm the copy if asked (Cisco) """
+    at = '@' if username!='' else ''
+    os_cmd = build_cmd('scp', [ filename, '{username}{at}{dest}:{path}'.format(
+                                          username=username, at=at, dest=dest, path=path) ],
+                       ssh_options)
+    print ("starting upload with cmd: ", os_cmd)
+    # second magic: a new line sends the copy confirmation to the device
+    out, err = await run_cmd(os_cmd, b"\n" if confirm else b"", "Error during file transfer",
+                             pass_fds, 'transfer', dest)
+    print (out)
+    return err
+
+
+@retrypolicy.retried_before_login
+async def copy_running_config(filename, username, dest, ssh_options=None, pass_fds=()):
+    """ coroutine version of CiscoCfg.copy_running_config """
+    return await scp_file.__wrapped__(filename, username, dest, CiscoCfg.RUNNING_CONFIG,
+                                      ssh_options=ssh_options, pass_fds=pass_fds)
+
+
+@retrypolicy.retried
+async def ssh_cmd(username, dest, cmd, ssh_options=None):
+    """ launch a command on remote device """
+    at = '@' if username!='' else ''
+    os_cmd = build_cmd('ssh', [ '{username}{at}{dest}'.format(username=username, at=at, dest=dest),
+                                cmd ], ssh_options)
+    print ("starting upload with cmd: ", os_cmd)
+    out, err = await run_cmd(os_cmd, cmd.encode(), "Error during remote ssh command", dest=dest)
+    print ("done, output was:", out)
+    return err
+
+
+@retrypolicy.retried_before_login
+async def exec_cmd(username, dest, cmd, ssh_options=None):
+    """ coroutine version of EkinopsCfg.exec_cmd """
+    return await ssh_cmd.__wrapped__(username, dest, cmd, ssh_options)
+
+
+@retrypolicy.retried
+async def fetch_output(username, dest, cmd, ssh_options=None):
+    """ launch a command on remote device and return its output (CiscoCfg.ssh_cmd) """
+    at = '@' if username!='' else ''
+    os_cmd = build_cmd('ssh', [ '{username}{at}{dest}'.format(username=username, at=at, dest=dest),
+                                cmd ], ssh_options)
+    print ("starting remote command with cmd: ", os_cmd)
+    out, err = await run_cmd(os_cmd, b"", "Error during remote ssh command", dest=dest)
+    print ("done, {n} bytes received".format(n=len(out)))
+    return out.decode(errors="replace")
+
+
+async def list_staged(driver, username, dest, ssh_options=None):
+    """ the files staged on the device (driver.list_staged) """
+    try:
+        return driver.parse_staged(await fetch_output(username, dest, driver.LIST_STAGED, ssh_options))
+    except OSError as e:
+        print ("{dest}: staged files not listed: {e}".format(dest=dest, e=e))
+        return {}
+
+
+async def load_file_delayed(filename, dest, username, wait, ssh_options=None, stale=(), activate_at=None):
+    """ coroutine version of CiscoCfg.load_file_delayed """
+    @retrypolicy.retried_before_login
+    async def send_applet(dest, ssh_options):
+        countdown = activation.countdown(activate_at, dest) if activate_at is not None else wait
+        with cfgcommon.memory_file(CiscoCfg.eem_applet(filename, countdown, stale)) as (path, fds):
+            return await scp_file.__wrapped__(path, username, dest, CiscoCfg.RUNNING_CONFIG,
+                                              ssh_options=ssh_options, pass_fds=fds)
+    return await send_applet(dest, ssh_options)
+
+
+async def exec_file(username, dest, filename, ssh_options=None, stale=()):
+    """ run the configuration file staged on an ekinops device, then delete the stale staged files
+        (EkinopsCfg.exec_file) """
+    with cfgmetrics.phase('exec', dest):
+        # !! -echo seems to be mandatory
+        rc = await exec_cmd (username, dest, EkinopsCfg.EXEC_COMMAND.format(
+                                 path=EkinopsCfg.EKINOPS_FILESYSTEM + filename), ssh_options)
+    if stale:
+        paths = ' '.join(EkinopsCfg.EKINOPS_FILESYSTEM + name for name in stale)
+        try:
+            await ssh_cmd (username, dest, EkinopsCfg.DELETE_STAGED.format(paths=paths), ssh_options)
+        except OSError as e:
+            print ("{dest}: stale staged files not deleted: {e}".format(dest=dest, e=e))
+    return rc
+
+
+@retrypolicy.retried
+async def scp_files(filenames, username, dest, path, ssh_options=None):
+    """ download several files into the directory path of the device (EkinopsCfg.scp_files) """
+    at = '@' if username!='' else ''
+    os_cmd = build_cmd('scp', list(filenames) + [ '{username}{at}{dest}:{path}'.format(
+                                                  username=username, at=at, dest=dest, path=path) ],
+                       ssh_options)
+    print ("starting upload with cmd: ", os_cmd)
+    out, err = await run_cmd(os_cmd, b"", "Error during file transfer", phase='transfer', dest=dest)
+    print (out)
+    return err
+
+
+async def read_step(stream, marker):
+    """ coroutine version of EkinopsCfg.read_step """
+    lines = []
+    while True:
+        line = await stream.readline()
+        if not line:
+            return ''.join(lines), False
+        line = line.decode(errors="replace")
+        if line.strip() == marker:
+            return ''.join(lines), True
+        lines.append(line)
+
+
+async def exec_batch(username, dest, filenames, tmpl_names, ssh_options=None, stale=()):
+    """ run the staged scripts in order within a single ssh session (EkinopsCfg.exec_batch) """
+    at = '@' if username!='' else ''
+    os_cmd = build_cmd('ssh', [ '-T', '{username}{at}{dest}'.format(username=username, at=at, dest=dest) ],
+                       ssh_options)
+    commands = [ EkinopsCfg.EXEC_COMMAND.format(path=EkinopsCfg.EKINOPS_FILESYSTEM + name) for name in filenames ]
+    if stale:
+        commands.append(EkinopsCfg.DELETE_STAGED.format(
+                        paths=' '.join(EkinopsCfg.EKINOPS_FILESYSTEM + name for name in stale)))
+    print ("starting batch session with cmd: ", os_cmd)
+    error, n, output, complete = None, 0, '', True
+    with cfgmetrics.phase('exec', dest):
+        p = await asyncio.create_subprocess_exec(*deadlines.command(os_cmd, dest), stdin=asyncio.subprocess.PIPE,
+                                                 stdout=asyncio.subprocess.PIPE,
+                                                 stderr=asyncio.subprocess.PIPE)
+        with deadlines.watchdog(p, 'exec', dest):
+            for n, command in enumerate(commands, 1):
+                marker = EkinopsCfg.BATCH_MARKER.format(n=n)
+                try:
+                    p.stdin.write((command + '\n' + EkinopsCfg.BATCH_SYNC.format(marker=marker) + '\n').encode())
+                    await p.stdin.drain()
+                    output, complete = await read_step(p.stdout, marker)
+                except (BrokenPipeError, ConnectionResetError):
+                    output, complete = '', False
+                print (output, end='')
+                if n > len(filenames):          # removal of the stale scripts, a failure is only reported
+                    if not complete or EkinopsCfg.BATCH_ERROR_REGEX.search(output):
+                        print ("{dest}: stale staged files not deleted".format(dest=dest))
+                    break
+                if not complete:
+                    break
+                error = EkinopsCfg.step_error(n, tmpl_names[n-1], output, True)
+                if error is not None:
+                    break
+                print ("{dest}: step {n}/{count} done".format(dest=dest, n=n, count=len(filenames)))
+            p.stdin.close()             # end of the session
+            err = await p.stderr.read()
+            await p.wait()
+        if error is None and not complete and n <= len(filenames):
+            error = EkinopsCfg.step_error(n, tmpl_names[n-1], output, False, err)
+            error.returncode = p.returncode or 1
+    if error is not None:
+        print ("Error: {e}".format(e=error))
+        raise error
+    return err
+
+
+class Steps:
+    """ do the steps of a cfgflow flow with the coroutines of this module for driver (CiscoCfg or EkinopsCfg) """
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    async def call(self, function, *args):
+        return await in_thread(function, *args)
+
+    async def open_session(self, dest, username):
+        # the master connection is opened in a thread to keep the event loop running
+        return await asyncio.to_thread(sshmux.open_session, dest, username, SSH_OPTIONS)
+
+    async def close_session(self, dest, control_path, username):
+        await asyncio.to_thread(sshmux.close_session, dest, control_path, username)
+
+    async def fetch_output(self, username, dest, cmd, ssh_options):
+        return await fetch_output(username, dest, cmd, ssh_options)
+
+    async def list_staged(self, username, dest, ssh_options):
+        return await list_staged(self.driver, username, dest, ssh_options)
+
+    async def scp_file(self, filename, username, dest, path, ssh_options, pass_fds):
+        # only cisco asks to confirm the copy
+        return await scp_file(filename, username, dest, path, self.driver.MODEL=='cisco', ssh_options, pass_fds)
+
+    async def copy_running_config(self, filename, username, dest, ssh_options, pass_fds):
+        return await copy_running_config(filename, username, dest, ssh_options, pass_fds)
+
+    async def scp_files(self, filenames, username, dest, path, ssh_options):
+        return await scp_files(filenames, username, dest, path, ssh_options)
+
+    async def load_file_delayed(self, filename, dest, username, wait, ssh_options, stale, activate_at):
+        return await load_file_delayed(filename, dest, username, wait, ssh_options, stale, activate_at)
+
+    async def exec_file(self, username, dest, filename, ssh_options, stale):
+        return await exec_file(username, dest, filename, ssh_options, stale)
+
+    async def exec_batch(self, username, dest, filenames, tmpl_names, ssh_options, stale):
+        return await exec_batch(username, dest, filenames, tmpl_names, ssh_options, stale)
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    async def defer(self, at, flow):
+        """ run flow at the epoch time at in its own asyncio task, return the task """
+        async def activate():
+            deadlines.postpone (at - time.time())
+            await asyncio.sleep (at - time.time())
+            return await cfgflow.run_async(flow, self)
+        return asyncio.ensure_future(activate())
+
+
+# The global API
+async def ssh_cfg (dest, tmpl_name, out_file=None, data=None, engine='string', username='', delay=0,
+                   dryrun=False, model='cisco', multiplex=False, incremental=False, state_db=None, force=False,
+                   control_path=None, activate_at=None, deferred=False):
+    """ coroutine version of CiscoCfg.ssh_cfg / EkinopsCfg.ssh_cfg, selected by model [cisco, ekinops],
+        incremental is only supported by cisco, returns False if nothing was sent.
+        control_path is a master connection already opened by sshmux.open_session, it is
+        used instead of opening a new one and left open.
+        With deferred, the ekinops exec is not awaited: the asyncio task running it is returned """
+    if model=='cisco':
+        driver = CiscoCfg
+    elif model=='ekinops':
+        driver = EkinopsCfg
+    else:
+        raise AttributeError("Unknown device model")
+    return await cfgflow.run_async(cfgflow.config_flow(driver, dest, tmpl_name, out_file, data, engine, username,
+                                                       delay, dryrun, multiplex, incremental, state_db, force,
+                                                       control_path, activate_at, deferred),
+                                   Steps(driver))
@@ -0,0 +1,110 @@
+# -----------------------------------------------------------------------------
+# end to end benchmark of FleetCfg against simulated devices
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# sim/bin (fake setsid, scp and ssh) is put in front of the PATH, then a
+# fleet of N simulated devices is configured. The throughput and the tail
+# latency of the per device durations are reported and may be saved as json:
+#
+#    python bench_fleet.py -n 500 -j 64 --latency 0.2 --failure-rate 0.01 -o fleet.json
+# ----------------------------------------------------------------------------
+
+import optparse
+import json
+import os
+import sys
+import time
+import platform
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import FleetCfg
+
+TEMPLATE = os.path.join(ROOT, 'examples', 'loopbacks.j2')
+
+
+def percentile(values, ratio):
+    """ return the value below which ratio of the sorted values fall """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(ratio * len(values)))]
+
+
+def simulate(sim_root, latency=0.0, bandwidth=0.0, failure_rate=0.0, hang_rate=0.0, hang_seconds=3600.0):
+    """ make the next scp/ssh commands reach the simulated devices """
+    os.environ['PATH'] = os.path.join(ROOT, 'sim', 'bin') + os.pathsep + os.environ['PATH']
+    os.environ.update({ 'SIM_ROOT': sim_root,
+                        'SIM_LATENCY': str(latency),
+                        'SIM_BANDWIDTH': str(bandwidth),
+                        'SIM_FAILURE_RATE': str(failure_rate),
+                        'SIM_HANG_RATE': str(hang_rate),
+                        'SIM_HANG_SECONDS': str(hang_seconds) })
+
+
+def inventory(count, loopbacks):
+    """ return an inventory of count devices with loopbacks interfaces each """
+    return [ { 'host': 'sim{:05d}'.format(i),
+               'data': { 'loopbacks': [ { 'nb': j, 'ip_addr': '10.{}.{}.{}'.format(i >> 8 & 255, i & 255, j & 255) }
+                                        for j in range(loopbacks) ] } }
+             for i in range(count) ]
+
+
+def run(count, loopbacks, **options):
+    """ configure the simulated fleet, return the results document """
+    devices = inventory(count, loopbacks)
+    start = time.perf_counter()
+    results = FleetCfg.fleet_cfg(devices, TEMPLATE, engine='tipyte', **options)
+    elapsed = time.perf_counter() - start
+    durations = sorted(r['duration'] for r in results if r['status'] != 'skipped')
+    counts = { status: sum(1 for r in results if r['status']==status) for status in ('ok', 'failed', 'skipped') }
+    return { 'python': platform.python_version(),
+             'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+             'devices': count,
+             'options': { key: value for key, value in options.items() if key != 'devices' },
+             'elapsed_s': elapsed,
+             'devices_per_s': count / elapsed if elapsed else 0.0,
+             'p50_s': percentile(durations, 0.50),
+             'p95_s': percentile(durations, 0.95),
+             'p99_s': percentile(durations, 0.99),
+             'max_s': durations[-1] if durations else 0.0,
+             'counts': counts }
+
+
+if __name__ == "__main__":
+    def read_command_line ():
+        """ handle command line """
+        parser = optparse.OptionParser()
+        parser.add_option('-n', '--devices',  help='number of simulated devices', type="int", default=100)
+        parser.add_option('-l', '--loopbacks', help='loopbacks per device', type="int", default=10)
+        parser.add_option('-m', '--model',    help='device model [cisco, ekinops]', default='cisco')
+        parser.add_option('-j', '--workers',  help='number of devices configured at once', type="int",
+                                              default=FleetCfg.FLEET_WORKERS)
+        parser.add_option('-w', '--wait',     help='delay given to ssh_cfg', type="int", default=0)
+        parser.add_option('-A', '--asyncio',  action="store_true", default=False, help='use the asyncio transport')
+        parser.add_option('-M', '--multiplex', action="store_true", default=False, help='use ssh multiplexing')
+        parser.add_option('--latency',        help='handshake latency in seconds', type="float", default=0.0)
+        parser.add_option('--bandwidth',      help='bytes per second, 0 for unlimited', type="float", default=0.0)
+        parser.add_option('--failure-rate',   help='probability of a failing session', type="float", default=0.0)
+        parser.add_option('--hang-rate',      help='probability of a hanging session', type="float", default=0.0)
+        parser.add_option('--hang-seconds',   help='duration of a hang', type="float", default=3600.0)
+        parser.add_option('-o', '--output',   help='save the results in this json file (optional)')
+        args,_ = parser.parse_args()
+        return args
+
+
+    args = read_command_line()
+    with tempfile.TemporaryDirectory() as sim_root:
+        simulate(sim_root, args.latency, args.bandwidth, args.failure_rate, args.hang_rate, args.hang_seconds)
+        document = run(args.devices, args.loopbacks,
+                       model       = args.model,
+                       workers     = args.workers,
+                       use_asyncio = args.asyncio,
+                       delay       = args.wait,
+                       multiplex   = args.multiplex)
+    print ("{devices} devices in {elapsed_s:.1f}s: {devices_per_s:.1f} devices/s, "
+           "p50 {p50_s:.2f}s p95 {p95_s:.2f}s p99 {p99_s:.2f}s max {max_s:.2f}s".format(**document))
+    print ("{ok} ok, {failed} failed, {skipped} skipped".format(**document['counts']))
+    if args.output:
+        with open(args.output, 'w') as w:
+            json.dump(document, w, indent=2)
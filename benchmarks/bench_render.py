@@ -0,0 +1,211 @@
+# -----------------------------------------------------------------------------
+# micro benchmarks of the template engines used by CiscoCfg and EkinopsCfg
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# Synthetic templates (loopbacks, ACL lines, nested loops, includes) are
+# generated at several sizes, then for each engine the compile time, the
+# render throughput, the peak memory and the number of allocated blocks are
+# measured. Results are saved as json and may be compared with a baseline:
+#
+#    python bench_render.py -o new.json -c baseline.json
+# ----------------------------------------------------------------------------
+
+import optparse
+import json
+import os
+import sys
+import time
+import string
+import platform
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('TIPYTE_CACHE_DIR', '')      # measure the real compilation
+import tipyte
+
+SIZES = [ 10, 100, 1000, 10000, 100000 ]
+# a scenario slower than the baseline by this ratio is reported as a regression
+REGRESSION_THRESHOLD = 1.20
+
+
+def nothing(a):
+    return a
+
+
+# synthetic scenarios: name -> function(size, directory) returning (engine, template path, data)
+def loopbacks_tipyte(size, directory):
+    """ the loopbacks.j2 example with size loopbacks """
+    path = os.path.join(directory, 'loopbacks.j2')
+    with open(path, 'w') as w:
+        w.write("{% for loop in loopbacks %}\n"
+                "interface Loopback {{ loop['nb'] }}\n"
+                "  ip address {{ loop['ip_addr'] }} 255.255.255.255\n"
+                "{% endfor %}\n"
+                "end\n")
+    data = { 'loopbacks': [ { 'nb': i, 'ip_addr': '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255) }
+                            for i in range(size) ] }
+    return 'tipyte', path, data
+
+
+def loopbacks_string(size, directory):
+    """ the same output with string.Template: one placeholder per value """
+    path = os.path.join(directory, 'loopbacks.j0')
+    with open(path, 'w') as w:
+        for i in range(size):
+            w.write("interface Loopback $nb{i}\n  ip address $ip{i} 255.255.255.255\n".format(i=i))
+        w.write("end\n")
+    data = {}
+    for i in range(size):
+        data['nb{}'.format(i)] = i
+        data['ip{}'.format(i)] = '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255)
+    return 'string', path, data
+
+
+def acl_nested_tipyte(size, directory):
+    """ an access-list: nested loops over sources and ports with a condition """
+    path = os.path.join(directory, 'acl.j2')
+    with open(path, 'w') as w:
+        w.write("ip access-list extended {{ name }}\n"
+                "{% for src in sources %}"
+                "{% for port in ports %}"
+                "{% if port != 23 %}"
+                " permit tcp {{ src }} 0.0.0.255 any eq {{ port }}\n"
+                "{% else %}"
+                " deny tcp {{ src }} 0.0.0.255 any eq {{ port }}\n"
+                "{% endif %}"
+                "{% endfor %}"
+                "{% endfor %}"
+                "end\n")
+    ports = [ 22, 23, 80, 443, 8080 ]
+    data = { 'name': 'BENCH', 'ports': ports,
+             'sources': [ '10.{}.{}.0'.format(i >> 8 & 255, i & 255) for i in range(max(1, size // len(ports))) ] }
+    return 'tipyte', path, data
+
+
+def includes_tipyte(size, directory):
+    """ one include per interface """
+    path = os.path.join(directory, 'interfaces.j2')
+    with open(os.path.join(directory, 'interface.j2'), 'w') as w:
+        w.write("interface GigabitEthernet0/{{ intf['nb'] }}\n"
+                " description {{ intf['desc'] }}\n"
+                " no shutdown\n")
+    with open(path, 'w') as w:
+        w.write("{% for intf in interfaces %}{% include('interface.j2') %}{% endfor %}end\n")
+    data = { 'interfaces': [ { 'nb': i, 'desc': 'link {}'.format(i) } for i in range(size) ] }
+    return 'tipyte', path, data
+
+
+SCENARIOS = { 'loopbacks-tipyte': loopbacks_tipyte,
+              'loopbacks-string': loopbacks_string,
+              'acl-nested-tipyte': acl_nested_tipyte,
+              'includes-tipyte': includes_tipyte }
+
+
+def compile_template(engine, path):
+    """ compile the template from scratch, return the render function """
+    if engine=='string':
+        with open(path, 'r') as f:
+            return string.Template(f.read()).safe_substitute
+    tipyte.compile_template.cache_clear()
+    tipyte.resolve_include.cache_clear()
+    return tipyte.template_to_function(path, escaper=nothing)
+
+
+def measure(engine, path, data, repeat):
+    """ return the measures of one scenario: best of repeat runs for the times """
+    compile_times, render_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render = compile_template(engine, path)
+        compile_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        output = render(dict(data))
+        render_times.append(time.perf_counter() - start)
+    # memory is measured on a separate run, tracemalloc slows everything down
+    render = compile_template(engine, path)
+    copy = dict(data)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = render(copy)
+    # taken while the output is still referenced: the blocks the render allocated and still
+    # holds (its output, the caches it filled) are counted, not those of tracemalloc itself
+    after = tracemalloc.take_snapshot().filter_traces([ tracemalloc.Filter(False, tracemalloc.__file__) ])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    allocations = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    lines = output.count('\n')
+    return { 'compile_s': min(compile_times),
+             'render_s': min(render_times),
+             'lines_per_s': lines / min(render_times) if min(render_times) else 0.0,
+             'output_bytes': len(output),
+             'output_lines': lines,
+             'peak_bytes': peak,
+             'allocations': allocations }
+
+
+def run(scenarios, sizes, repeat):
+    """ run the scenarios, return the results document """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name in scenarios:
+            for size in sizes:
+                engine, path, data = SCENARIOS[name](size, directory)
+                result = measure(engine, path, data, repeat)
+                result.update({ 'scenario': name, 'engine': engine, 'size': size })
+                print ("{scenario:<20} {size:>7} compile {compile_s:8.4f}s render {render_s:8.4f}s "
+                       "{lines_per_s:12.0f} lines/s peak {peak_bytes:>11} B".format(**result))
+                results.append(result)
+    return { 'python': platform.python_version(),
+             'platform': platform.platform(),
+             'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+             'results': results }
+
+
+def compare(document, baseline, threshold=REGRESSION_THRESHOLD):
+    """ return the list of regressions of document against baseline """
+    reference = { (r['scenario'], r['size']): r for r in baseline['results'] }
+    regressions = []
+    for result in document['results']:
+        old = reference.get((result['scenario'], result['size']))
+        if old is None:
+            continue
+        for key in ('compile_s', 'render_s', 'peak_bytes'):
+            if old[key] and result[key] > old[key] * threshold:
+                regressions.append("{scenario} size {size}: {key} {old:.4g} -> {new:.4g}".format(
+                                    scenario=result['scenario'], size=result['size'], key=key,
+                                    old=old[key], new=result[key]))
+    return regressions
+
+
+if __name__ == "__main__":
+    def read_command_line ():
+        """ handle command line """
+        parser = optparse.OptionParser()
+        parser.add_option('-s', '--sizes',    help='comma separated sizes (default {})'.format(
+                                              ','.join(str(size) for size in SIZES)))
+        parser.add_option('-S', '--scenario', action='append',
+                                              help='scenario to run, may be repeated [{}]'.format(
+                                              ', '.join(sorted(SCENARIOS))))
+        parser.add_option('-r', '--repeat',   help='number of runs of each measure', type="int", default=3)
+        parser.add_option('-o', '--output',   help='save the results in this json file (optional)')
+        parser.add_option('-c', '--compare',  help='json results of a previous version (optional)')
+        parser.add_option('-t', '--threshold', help='regression ratio', type="float",
+                                               default=REGRESSION_THRESHOLD)
+        args,_ = parser.parse_args()
+        return args
+
+
+    args = read_command_line()
+    sizes = [ int(size) for size in args.sizes.split(',') ] if args.sizes else SIZES
+    document = run(args.scenario or sorted(SCENARIOS), sizes, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as w:
+            json.dump(document, w, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions = compare(document, json.load(f), args.threshold)
+        for regression in regressions:
+            print ("REGRESSION:", regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,98 @@
+# -----------------------------------------------------------------------------
+# write the configurations of a whole dry-run into a single archive
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# Creating tens of thousands of small files is slow on a network file
+# system: the configurations are appended to one tar (plain, gzip or xz)
+# or zip file instead, through a large write buffer, so a dry-run of the
+# whole estate costs a few big sequential writes. The members get fixed
+# dates, owners and modes and are added in the order they are given, so
+# the same configurations always give the same archive, byte for byte.
+# The archive is written next to its final path and renamed when complete.
+# ----------------------------------------------------------------------------
+
+import gzip
+import io
+import lzma
+import os
+import tarfile
+import zipfile
+
+# size of the write buffer of the archive file
+ARCHIVE_BUFFER = 4 << 20
+# date of every member: 1980-01-01 00:00 UTC, the oldest date a zip can hold
+MEMBER_MTIME = 315532800
+MEMBER_MODE = 0o644
+# archive formats by extension
+ARCHIVE_FORMATS = { '.tar': 'tar', '.tar.gz': 'gz', '.tgz': 'gz', '.tar.xz': 'xz', '.zip': 'zip' }
+
+
+def archive_format(path):
+    """ the format of the archive from the extension of path, None if it is not an archive """
+    for extension, kind in ARCHIVE_FORMATS.items():
+        if path.lower().endswith(extension):
+            return kind
+    return None
+
+
+class ConfigArchive:
+    """ an archive being written: add(name, text) appends a member, close() completes it.
+        As a context manager, the archive is only kept if the block succeeds """
+
+    def __init__(self, path, buffer_size=ARCHIVE_BUFFER):
+        self.kind = archive_format(path)
+        if self.kind is None:
+            raise ValueError("Unknown archive format {path}, expecting one of {ext}".format(
+                             path=path, ext=', '.join(ARCHIVE_FORMATS)))
+        self.path = path
+        self.temporary_path = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+        self.count = 0
+        self.raw = open(self.temporary_path, 'wb', buffering=buffer_size)
+        if self.kind == 'zip':
+            self.compressed = None
+            self.archive = zipfile.ZipFile(self.raw, 'w', compression=zipfile.ZIP_DEFLATED)
+        else:
+            # no name nor time in the gzip header, they would change at each run
+            self.compressed = ( gzip.GzipFile(filename='', mode='wb', fileobj=self.raw, mtime=0) if self.kind == 'gz'
+                                else lzma.LZMAFile(self.raw, 'wb') if self.kind == 'xz'
+                                else None )
+            self.archive = tarfile.open(fileobj=self.compressed or self.raw, mode='w',
+                                        format=tarfile.GNU_FORMAT)
+
+    def add(self, name, text):
+        """ append the member name holding text, utf-8 encoded """
+        data = text.encode('utf-8')
+        if self.kind == 'zip':
+            info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+            info.external_attr = (0o100000 | MEMBER_MODE) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = MEMBER_MTIME
+            info.mode = MEMBER_MODE
+            self.archive.addfile(info, io.BytesIO(data))
+        self.count += 1
+
+    def close(self, keep=True):
+        """ complete the archive and move it to its path, or remove it if keep is False """
+        if self.raw is None:
+            return
+        try:
+            self.archive.close()
+            if self.compressed is not None:
+                self.compressed.close()
+            self.raw.close()
+        finally:
+            self.raw = None
+            if keep:
+                os.replace(self.temporary_path, self.path)
+            elif os.path.exists(self.temporary_path):
+                os.remove(self.temporary_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, trace):
+        self.close(keep=exc_type is None)
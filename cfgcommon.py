@@ -0,0 +1,92 @@
+# -----------------------------------------------------------------------------
+# the helpers of CiscoCfg and EkinopsCfg which do not depend on the device model
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# Template resolution (string or tipyte engine, whole or streamed), the
+# in-memory files given to scp and the md5 which names the staged files.
+# The drivers keep their constants, their listing parsers and the scp/ssh
+# commands of their model.
+# ----------------------------------------------------------------------------
+
+import contextlib
+import hashlib
+import os
+import string
+import tempfile
+
+import cfgmetrics
+
+
+def resolve_template(tmpl_name, data, engine):
+   """ read the 'template' and resolve it with safe_substitute, return the configuration as a string """
+   if engine=="string":
+       with open(tmpl_name, 'r') as f:
+           src = string.Template(f.read())
+           result = src.safe_substitute(data)
+   elif engine=="tipyte":
+       import tipyte
+       render_inbox = tipyte.template_to_function(tmpl_name, escaper=tipyte.no_escape)
+       result = render_inbox(data)  # do not use kwargs syntax data=data
+   else:
+       raise AttributeError("Unknown template engine")
+   return result
+
+
+def render_template(tmpl_name, out_file, data, engine):
+   """ resolve the 'template' and write the result in out_file """
+   result = resolve_template(tmpl_name, data, engine)
+   # write result in a file
+   with open (out_file, 'w') as w:
+       w.write(result)
+   return result
+
+
+def render_stream(tmpl_name, stream, data, engine):
+   """ resolve the 'template' into the text stream, return the number of characters written.
+       tipyte writes the configuration by chunks while the template runs, so it is never held as a whole """
+   if engine=="tipyte":
+       import tipyte
+       render_inbox = tipyte.template_to_function(tmpl_name, escaper=tipyte.no_escape)
+       return render_inbox(data, _template_sink=stream)
+   result = resolve_template(tmpl_name, data, engine)
+   stream.write(result)
+   return len(result)
+
+
+def stream_template(tmpl_name, data, engine, dest):
+   """ return a function which resolves the 'template' into the text stream it is given,
+       timed as the render phase of dest """
+   def write(stream):
+       with cfgmetrics.phase('render', dest) as event:
+           event['bytes'] = render_stream(tmpl_name, stream, data, engine)
+   return write
+
+
+@contextlib.contextmanager
+def memory_file(content):
+    """ yield a path which reads content and the fds the subprocess must inherit,
+        content stays in memory (memfd) when the OS allows it.
+        content is a string or a function which writes into the text stream it is given """
+    write = content if callable(content) else lambda w: w.write(content)
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create(os.path.basename(__file__))
+        try:
+            with os.fdopen(os.dup(fd), 'w', encoding='utf-8') as w:
+                write(w)
+            yield '/dev/fd/{fd}'.format(fd=fd), (fd,)
+        finally:
+            os.close(fd)
+    else:
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8') as temp:
+            write(temp)
+            temp.flush()
+            yield temp.name, ()
+
+
+def file_digest(path):
+    """ md5 of the file (the hash shown by IOS verify /md5 or md5sum) """
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,144 @@
+# -----------------------------------------------------------------------------
+# compare a resolved template with the running-config of a cisco device
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# Both configurations are split into sections: a top level line (interface,
+# router, ip access-list, ...) and its indented lines. Only the sections and
+# lines of the template which are missing from the device are kept, except
+# for the order sensitive ones (access lists, route-maps, prefix lists,
+# class and policy maps) which are removed and sent again whole when they
+# differ. Lines are compared once their spaces are collapsed and the
+# interface names joined (interface Loopback 777 is interface Loopback777),
+# other abbreviations (int lo777, conf t ...) are not expanded and such
+# sections are sent at each run.
+# ----------------------------------------------------------------------------
+
+import collections
+import re
+
+# lines which only drive the cli and are never found in a running-config
+CLI_LINES = ( 'configure terminal', 'conf t', 'end', 'exit', '!' )
+# sections whose lines are evaluated in order: replaced whole when they differ
+ORDERED_SECTIONS = re.compile(r'^(ip access-list|ipv6 access-list|route-map|class-map|policy-map) ')
+# top level lines forming an ordered list with the lines of the same name, group is the name
+ORDERED_LINES = re.compile(r'^(?P<group>(ip|ipv6) prefix-list \S+|access-list \S+) ')
+# an interface name split from its number: interface Loopback 777
+INTERFACE_NAME = re.compile(r'^(interface [A-Za-z-]+) (\d)')
+
+
+def normalize(line):
+    """ the form of a configuration line found in a running-config: single spaces,
+        interface name joined to its number """
+    return INTERFACE_NAME.sub(r'\1\2', ' '.join(line.split()))
+
+
+def parse_sections(config):
+    """ return an ordered dictionnary { top level line: [ child paths ] }
+
+    A child path is the tuple of the sub-mode lines leading to a line and the
+    line itself, for instance ('address-family ipv4', 'neighbor 1.1.1.1 activate')
+    """
+    sections = collections.OrderedDict()
+    header = None
+    for line in config.splitlines():
+        text = line.strip()
+        if not text or text in CLI_LINES or text.startswith('!') or text == 'exit-address-family':
+            continue
+        indent = len(line) - len(line.lstrip())
+        if indent == 0:
+            header = normalize(text)
+            sections.setdefault(header, [])
+            parents = []            # stack of (indent, line) of the enclosing sub-modes
+        elif header is not None:
+            while parents and parents[-1][0] >= indent:
+                parents.pop()
+            text = normalize(text)
+            sections[header].append(tuple(p[1] for p in parents) + (text,))
+            parents.append((indent, text))
+    return sections
+
+
+def ordered_groups(sections):
+    """ return { group: [ top level lines ] } of the ORDERED_LINES of sections """
+    groups = collections.OrderedDict()
+    for header in sections:
+        match = ORDERED_LINES.match(header)
+        if match:
+            groups.setdefault(match.group('group'), []).append(header)
+    return groups
+
+
+def diff_sections(intent, running, negate=False):
+    """ return the sections of intent which differ from running, as a dictionnary
+
+    A section missing from running is kept whole, otherwise only its lines
+    missing from running are kept. An ORDERED_SECTIONS section or an
+    ORDERED_LINES list which differs is removed ('no <header>', without
+    lines) and sent whole. With negate, the lines found in running but not
+    in the intent are removed with 'no <line>'.
+    """
+    delta = collections.OrderedDict()
+    intent_groups, running_groups = ordered_groups(intent), ordered_groups(running)
+    for header, paths in intent.items():
+        match = ORDERED_LINES.match(header)
+        if match:
+            group = match.group('group')
+            lines = intent_groups.pop(group, None)        # the whole list, on its first line
+            if lines is not None and lines != running_groups.get(group):
+                if group in running_groups:
+                    delta['no ' + group] = []
+                for line in lines:
+                    delta[line] = list(intent[line])
+            continue
+        if ORDERED_SECTIONS.match(header):
+            if running.get(header) != paths:
+                if header in running:
+                    delta['no ' + header] = []
+                delta[header] = list(paths)
+            continue
+        if header not in running:
+            delta[header] = list(paths)
+            continue
+        current = set(running[header])
+        changes = [ path for path in paths if path not in current ]
+        if negate:
+            wanted = set(paths)
+            changes += [ path[:-1] + ('no ' + path[-1],) for path in running[header]
+                         if path not in wanted and not any(p[:len(path)] == path for p in wanted) ]
+        if changes:
+            delta[header] = changes
+    return delta
+
+
+def format_sections(sections):
+    """ return the configuration text of sections, ready to be copied into running-config """
+    lines = []
+    for header, paths in sections.items():
+        lines.append(header)
+        emitted = ()        # sub-modes already entered
+        for index, path in enumerate(paths):
+            parents = path[:-1]
+            common = 0
+            while common < min(len(emitted), len(parents)) and emitted[common] == parents[common]:
+                common += 1
+            for depth in range(len(emitted), common, -1):
+                lines.append(' ' * (depth + 1) + 'exit')
+            for depth in range(common, len(parents)):
+                lines.append(' ' * (depth + 1) + parents[depth])
+            lines.append(' ' * len(path) + path[-1])
+            # the line opens a sub-mode only if the next line is one of its children
+            following = paths[index + 1] if index + 1 < len(paths) else ()
+            emitted = path if following[:len(path)] == path and len(following) > len(path) else parents
+        for depth in range(len(emitted), 0, -1):
+            lines.append(' ' * (depth + 1) + 'exit')
+        if paths:
+            lines.append(' exit')
+    if lines:
+        lines.append('end')
+    return ''.join(line + '\n' for line in lines)
+
+
+def config_delta(intent, running, negate=False):
+    """ return the part of the intent configuration text not yet applied on running
+        (empty string when nothing has to be sent) """
+    return format_sections(diff_sections(parse_sections(intent), parse_sections(running), negate))
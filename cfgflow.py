@@ -0,0 +1,287 @@
+# -----------------------------------------------------------------------------
+# the sequence of ssh_cfg, shared by CiscoCfg, EkinopsCfg and aiotransport
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# A flow is a generator which yields the steps of the configuration of a
+# device as tuples ( name, args... ) and gets back the result of each step,
+# or its exception. It does the rest itself: rendering decisions, state_db,
+# incremental diff, staged file naming, metrics phases. run() does the steps
+# with the blocking functions of a driver (Blocking), run_async() with the
+# coroutines of aiotransport (aiotransport.Steps), so the sync and asyncio
+# versions of ssh_cfg follow the same sequence.
+#    call (function, *args)                    local blocking work (rendering, state_db, hashes)
+#    open_session (dest, username)             returns the control path
+#    close_session (dest, control_path, username)
+#    fetch_output (username, dest, cmd, ssh_options)
+#    list_staged (username, dest, ssh_options)
+#    scp_file (filename, username, dest, path, ssh_options, pass_fds)
+#    copy_running_config (filename, username, dest, ssh_options, pass_fds)
+#    scp_files (filenames, username, dest, path, ssh_options)
+#    load_file_delayed (filename, dest, username, wait, ssh_options, stale, activate_at)
+#    exec_file (username, dest, filename, ssh_options, stale)
+#    exec_batch (username, dest, filenames, tmpl_names, ssh_options, stale)
+#    sleep (seconds)
+#    defer (at, flow)                          run flow at the epoch time at, returns its future
+# ----------------------------------------------------------------------------
+
+import contextlib
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+import activation
+import cfgcommon
+import cfgmetrics
+import deadlines
+
+
+def run(flow, steps):
+    """ run flow, each step is done by the method of steps named after it, return the result of flow """
+    result, error = None, None
+    while True:
+        try:
+            step = flow.send(result) if error is None else flow.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = getattr(steps, step[0])(*step[1:]), None
+        except BaseException as e:      # the flow closes its session before it goes up
+            result, error = None, e
+
+
+async def run_async(flow, steps):
+    """ coroutine version of run, the methods of steps are coroutines """
+    result, error = None, None
+    while True:
+        try:
+            step = flow.send(result) if error is None else flow.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result, error = await getattr(steps, step[0])(*step[1:]), None
+        except BaseException as e:
+            result, error = None, e
+
+
+class Blocking:
+    """ do the steps with the functions of driver (CiscoCfg or EkinopsCfg) """
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def __getattr__(self, name):
+        """ the scp/ssh steps are the functions of the driver """
+        return getattr(self.driver, name)
+
+    def call(self, function, *args):
+        return function(*args)
+
+    def open_session(self, dest, username):
+        import sshmux
+        return sshmux.open_session(dest, username, self.driver.SSH_OPTIONS)
+
+    def close_session(self, dest, control_path, username):
+        import sshmux
+        sshmux.close_session(dest, control_path, username)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def defer(self, at, flow):
+        return activation.SCHEDULER.submit(at, run, flow, self)
+
+
+def write_file(path, config):
+    """ write the streamed configuration into path """
+    with open (path, 'w') as w:
+        config(w)
+
+
+def deferred_exec(step, dest, state_db, tmpl_key, digest):
+    """ the flow of a deferred activation: the exec step, on its own session, then its record """
+    yield step
+    if state_db:
+        import statestore
+        yield ('call', statestore.record_push, state_db, dest, tmpl_key, digest)
+    return True
+
+
+def config_flow(driver, dest, tmpl_name, out_file=None, data=None, engine='string', username='', delay=0,
+                dryrun=False, multiplex=False, incremental=False, state_db=None, force=False, control_path=None,
+                activate_at=None, deferred=False):
+    """ the flow of ssh_cfg for driver, the arguments are those of CiscoCfg.ssh_cfg and EkinopsCfg.ssh_cfg.
+        control_path is a master connection already opened by sshmux.open_session, it is
+        used instead of opening a new one and left open. With deferred, the ekinops exec is
+        not waited for: the defer step returns its future, which is returned """
+    cisco = driver.MODEL == 'cisco'
+    if incremental and not cisco:
+        raise ValueError("incremental is only supported by cisco devices, not " + driver.MODEL)
+    if not cisco and isinstance(tmpl_name, (list, tuple)):
+        return (yield from batch_flow(driver, dest, tmpl_name, out_file, data, engine, username, delay, dryrun,
+                                      multiplex, state_db, force, control_path, activate_at, deferred))
+    # cisco loads the configuration straight into the running-config unless it is delayed
+    staged = not cisco or delay!=0 or activate_at is not None
+    # tipyte resolves the template by chunks straight into the file which is sent (or displayed),
+    # incremental and state_db need the configuration as a whole string
+    streaming = engine=="tipyte" and not incremental and not state_db
+    digest = None
+    if streaming:
+        config = cfgcommon.stream_template (tmpl_name, data, engine, dest)  # rendered when the file is written
+        if out_file:
+            yield ('call', write_file, out_file, config)
+    else:
+        with cfgmetrics.phase('render', dest) as event:
+            if out_file:
+                config = yield ('call', cfgcommon.render_template, tmpl_name, out_file, data, engine)
+            else:
+                config = yield ('call', cfgcommon.resolve_template, tmpl_name, data, engine)
+            event['bytes'] = len(config)
+    if dryrun:
+        if out_file:
+            print ("template resolved into {out_file}".format(out_file=out_file))
+        elif streaming:
+            config(sys.stdout)
+        else:
+            print (config)
+        return True
+    if state_db:
+        import statestore
+        digest = statestore.config_hash(config)
+        pushed_at = None if force else (yield ('call', statestore.already_pushed, state_db, dest, tmpl_name, digest))
+        if pushed_at is not None:
+            print ("{dest}: same configuration already pushed on {date}, skipped".format(
+                                                       dest=dest, date=time.ctime(pushed_at)))
+            return False
+    own_session = multiplex and control_path is None
+    if own_session:
+        control_path = yield ('open_session', dest, username)
+    ssh_options = driver.SSH_OPTIONS
+    if control_path:
+        import sshmux
+        ssh_options += ' ' + sshmux.session_options(control_path)
+    try:
+        if incremental:
+            # only send the sections which differ from the running-config
+            import cfgdiff
+            with cfgmetrics.phase('fetch', dest) as event:
+                running = yield ('fetch_output', username, dest, driver.SHOW_RUNNING, ssh_options)
+                event['bytes'] = len(running)
+            config = cfgdiff.config_delta(config, running)
+            if not config:
+                print ("{dest}: configuration already applied, nothing to send".format(dest=dest))
+                if state_db:
+                    yield ('call', statestore.record_push, state_db, dest, tmpl_name, digest)
+                return False
+        # a streamed out_file already holds the configuration
+        upload = contextlib.nullcontext((out_file, ())) if streaming and out_file else cfgcommon.memory_file(config)
+        with contextlib.ExitStack() as stack:
+            # a streamed configuration is rendered as the file is written
+            path, fds = yield ('call', stack.enter_context, upload)
+            with cfgmetrics.phase('upload', dest) as event:
+                size = os.stat(path).st_size
+                if not staged:
+                    event['bytes'] = size
+                    yield ('copy_running_config', path, username, dest, ssh_options, fds)
+                else:
+                    # the staged file is named by its hash, it is not sent again if it is already there
+                    staged_file = driver.STAGED_FILE.format(id=(yield ('call', cfgcommon.file_digest, path)))
+                    stale = yield ('list_staged', username, dest, ssh_options)
+                    if stale.pop(staged_file, None) == size:
+                        print ("{dest}: {file} already staged, upload skipped".format(dest=dest, file=staged_file))
+                    else:
+                        event['bytes'] = size
+                        directory = driver.CISCO_FILESYSTEM if cisco else driver.EKINOPS_FILESYSTEM
+                        yield ('scp_file', path, username, dest, directory + staged_file, ssh_options, fds)
+        if cisco:
+            if staged:
+                # EEM loads the staged file into the running-config after the countdown
+                with cfgmetrics.phase('eem', dest):
+                    yield ('load_file_delayed', staged_file, dest, username, delay, ssh_options, stale, activate_at)
+        else:
+            wait = activation.countdown(activate_at, dest) if activate_at is not None else delay
+            if deferred:
+                return (yield ('defer', activate_at if activate_at is not None else time.time() + wait,
+                               deferred_exec(('exec_file', username, dest, staged_file, None, stale),
+                                             dest, state_db, tmpl_name, digest)))
+            with cfgmetrics.phase('wait', dest):
+                deadlines.postpone (wait)
+                yield ('sleep', wait)
+            yield ('exec_file', username, dest, staged_file, ssh_options, stale)
+    finally:
+        if own_session:
+            yield ('close_session', dest, control_path, username)
+    if state_db:
+        yield ('call', statestore.record_push, state_db, dest, tmpl_name, digest)
+    return True
+
+
+def batch_flow(driver, dest, tmpl_names, out_file=None, data=None, engine='string', username='', delay=0,
+               dryrun=False, multiplex=False, state_db=None, force=False, control_path=None,
+               activate_at=None, deferred=False):
+    """ the flow of EkinopsCfg.ssh_cfg_batch: one scp stages the missing scripts,
+        one ssh session runs them all in order """
+    tmpl_key = ','.join(tmpl_names)      # the batch as a whole in state_db
+    digest = None
+    with tempfile.TemporaryDirectory() as directory:
+        with cfgmetrics.phase('render', dest) as event:
+            scripts = yield ('call', driver.render_scripts, tmpl_names, data, engine, directory)
+            event['bytes'] = sum(size for _, _, size in scripts)
+        names = [ name for _, name, _ in scripts ]
+        if out_file or dryrun:
+            with contextlib.ExitStack() as stack:
+                outputs = [ stack.enter_context(open(out_file, 'w')) ] if out_file else []
+                if dryrun and not out_file:
+                    outputs.append(sys.stdout)
+                for tmpl_name, name, _ in scripts:
+                    with open(os.path.join(directory, name)) as f:
+                        script = f.read()
+                    for output in outputs:
+                        output.write(script)
+        if dryrun:
+            if out_file:
+                print ("templates resolved into {out_file}".format(out_file=out_file))
+            return True
+        if state_db:
+            import statestore
+            digest = hashlib.sha256(''.join(names).encode()).hexdigest()
+            pushed_at = None if force else (yield ('call', statestore.already_pushed, state_db, dest, tmpl_key, digest))
+            if pushed_at is not None:
+                print ("{dest}: same configuration already pushed on {date}, skipped".format(
+                                                           dest=dest, date=time.ctime(pushed_at)))
+                return False
+        own_session = multiplex and control_path is None
+        if own_session:
+            control_path = yield ('open_session', dest, username)
+        ssh_options = driver.SSH_OPTIONS
+        if control_path:
+            import sshmux
+            ssh_options += ' ' + sshmux.session_options(control_path)
+        try:
+            with cfgmetrics.phase('upload', dest) as event:
+                staged = yield ('list_staged', username, dest, ssh_options)
+                stale = [ name for name in staged if name not in names ]
+                missing = { name: size for _, name, size in scripts if staged.get(name) != size }
+                if len(missing) < len(scripts):
+                    print ("{dest}: {n} scripts already staged, upload skipped".format(
+                           dest=dest, n=len(scripts) - len(missing)))
+                if missing:
+                    event['bytes'] = sum(missing.values())
+                    yield ('scp_files', [ os.path.join(directory, name) for name in missing ], username, dest,
+                           driver.EKINOPS_FILESYSTEM, ssh_options)
+            wait = activation.countdown(activate_at, dest) if activate_at is not None else delay
+            if deferred:
+                return (yield ('defer', activate_at if activate_at is not None else time.time() + wait,
+                               deferred_exec(('exec_batch', username, dest, names, tmpl_names, None, stale),
+                                             dest, state_db, tmpl_key, digest)))
+            with cfgmetrics.phase('wait', dest):
+                deadlines.postpone (wait)
+                yield ('sleep', wait)
+            yield ('exec_batch', username, dest, names, tmpl_names, ssh_options, stale)
+        finally:
+            if own_session:
+                yield ('close_session', dest, control_path, username)
+    if state_db:
+        yield ('call', statestore.record_push, state_db, dest, tmpl_key, digest)
+    return True
@@ -0,0 +1,137 @@
+# -----------------------------------------------------------------------------
+# journal of the state of each device during a fleet run, resume after a crash
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# Each state transition of a device is appended to the journal as a json line:
+#    { "ts": epoch, "device": host, "state": rendered|staged|scheduled|executed
+#                                          |applied|skipped|failed|timeout, "error" }
+# The intermediate states come from the phases of ssh_cfg (cfgmetrics hook),
+# the last one from the result of the device. The records are written by a
+# single thread which makes them durable with one fsync per batch (group
+# commit), so thousands of devices cost a few fsyncs per second; a crash loses
+# at most the last JOURNAL_SYNC_INTERVAL seconds of records, whose devices are
+# then configured again. A run started with the same journal and --resume
+# skips the devices which were applied (or had nothing to apply).
+# ----------------------------------------------------------------------------
+
+import json
+import os
+import threading
+import time
+
+# seconds between two fsyncs of the journal
+JOURNAL_SYNC_INTERVAL = 0.2
+# state of a device once the phase of ssh_cfg has succeeded
+PHASE_STATES = { 'render': 'rendered', 'upload': 'staged', 'eem': 'scheduled', 'exec': 'executed' }
+# state of a device from its result in the fleet
+RESULT_STATES = { 'ok': 'applied', 'skipped': 'skipped', 'failed': 'failed', 'timeout': 'timeout' }
+# the states which end the work on a device
+FINISHED_STATES = ('applied', 'skipped')
+
+
+def read_journal(path):
+    """ return the last state of each device of the journal, a missing journal is empty.
+        A line cut by a crash is ignored """
+    states = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                states[record['device']] = record['state']
+    except FileNotFoundError:
+        pass
+    return states
+
+
+def unfinished(devices, path):
+    """ the devices of the inventory which were not finished according to the journal """
+    done = { device for device, state in read_journal(path).items() if state in FINISHED_STATES }
+    skipped = 0
+    for device in devices:
+        if device.get('host') in done:
+            skipped += 1
+            continue
+        yield device
+    print ("{n} devices already done in {path}, not configured again".format(n=skipped, path=path))
+
+
+class Journal:
+    """ append-only journal of a run: record() queues a state transition, a background
+        thread writes and syncs the queued records. Also a cfgmetrics hook """
+
+    def __init__(self, path, sync_interval=JOURNAL_SYNC_INTERVAL):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.condition = threading.Condition()
+        self.pending = []
+        self.closing = threading.Event()
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # complete a line cut by a crash, the next record must start on its own line
+        size = os.fstat(self.fd).st_size
+        if size:
+            with open(path, 'rb') as f:
+                f.seek(size - 1)
+                if f.read(1) != b'\n':
+                    os.write(self.fd, b'\n')
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def record(self, device, state, error=None):
+        """ queue the new state of device """
+        if device is None:
+            return
+        line = json.dumps({ 'ts': time.time(), 'device': device, 'state': state, 'error': error }) + '\n'
+        with self.condition:
+            self.pending.append(line.encode())
+            self.condition.notify()
+
+    def __call__(self, event):
+        """ cfgmetrics hook: the successful phases move the device to their state """
+        state = PHASE_STATES.get(event['phase'])
+        if state is not None and event['rc'] == 0:
+            self.record(event['device'], state)
+
+    def result(self, result):
+        """ record the final state of a device from its fleet result, return the result """
+        state = RESULT_STATES.get(result['status'])
+        if state is not None:
+            self.record(result['host'], state, result['stderr'] or None)
+        return result
+
+    def results(self, results):
+        """ record each result of the fleet as it goes through """
+        for result in results:
+            yield self.result(result)
+
+    def run(self):
+        """ the writer thread: one write and one fsync for all the records queued meanwhile """
+        while True:
+            with self.condition:
+                while not self.pending and not self.closing.is_set():
+                    self.condition.wait()
+                batch, self.pending = self.pending, []
+            if batch:
+                data = memoryview(b''.join(batch))
+                while data:
+                    data = data[os.write(self.fd, data):]
+                os.fsync(self.fd)
+            elif self.closing.is_set():
+                return
+            self.closing.wait(self.sync_interval)     # let the next records gather
+
+    def close(self):
+        """ write the records still queued and close the journal """
+        with self.condition:
+            self.closing.set()
+            self.condition.notify()
+        self.thread.join()
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, trace):
+        self.close()
@@ -0,0 +1,130 @@
+# -----------------------------------------------------------------------------
+# timing of the phases of ssh_cfg (render, upload, eem, exec...)
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# Each phase produces an event dictionnary:
+#    { "ts": start time (epoch), "device": dest, "phase": name,
+#      "duration_s": monotonic duration, "bytes": bytes sent or received,
+#      "rc": return code (0 on success), "error": message or null }
+# which is given to every registered hook. Hooks are provided to write the
+# events as json lines and to export totals as a Prometheus textfile.
+# ----------------------------------------------------------------------------
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+# the callbacks which receive the events
+HOOKS = []
+
+
+def add_hook(hook):
+    """ register a callback called with each event, return it """
+    HOOKS.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    """ unregister a callback """
+    HOOKS.remove(hook)
+
+
+def emit(event):
+    """ give the event to all the hooks """
+    for hook in list(HOOKS):
+        hook(event)
+
+
+@contextlib.contextmanager
+def phase(name, device):
+    """ time the enclosed block as the phase name of device, yield the event so
+        the block may fill event['bytes'] """
+    event = { 'ts': time.time(), 'device': device, 'phase': name, 'duration_s': 0.0,
+              'bytes': 0, 'rc': 0, 'error': None }
+    start = time.monotonic()
+    try:
+        yield event
+    except BaseException as e:
+        rc = getattr(e, 'returncode', None)
+        event['rc'] = rc if rc is not None else -1
+        event['error'] = str(e)
+        raise
+    finally:
+        event['duration_s'] = time.monotonic() - start
+        if HOOKS:
+            emit(event)
+
+
+class JsonLines:
+    """ hook appending each event as a json line to a file """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.stream = open(path, 'a')
+
+    def __call__(self, event):
+        line = json.dumps(event) + '\n'
+        with self.lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+
+class PrometheusTextfile:
+    """ hook aggregating the events per phase, write() saves them in the
+        Prometheus textfile collector format """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.totals = {}        # (phase, status) -> [ count, seconds, bytes ]
+
+    def __call__(self, event):
+        key = (event['phase'], 'ok' if event['rc'] == 0 else 'error')
+        with self.lock:
+            total = self.totals.setdefault(key, [ 0, 0.0, 0 ])
+            total[0] += 1
+            total[1] += event['duration_s']
+            total[2] += event['bytes']
+
+    def write(self):
+        """ write the textfile atomically, node_exporter may read it at any time """
+        metrics = [ ('ssh_cfg_phase_total', 'Number of ssh_cfg phases run.', '{:d}'),
+                    ('ssh_cfg_phase_seconds_total', 'Time spent in ssh_cfg phases.', '{:.6f}'),
+                    ('ssh_cfg_phase_bytes_total', 'Bytes transferred by ssh_cfg phases.', '{:d}') ]
+        lines = []
+        with self.lock:
+            totals = sorted(self.totals.items())
+        for index, (metric, help_text, value_format) in enumerate(metrics):
+            lines.append('# HELP {metric} {help}'.format(metric=metric, help=help_text))
+            lines.append('# TYPE {metric} counter'.format(metric=metric))
+            for (name, status), values in totals:
+                lines.append('{metric}{{phase="{name}",status="{status}"}} '.format(
+                             metric=metric, name=name, status=status) + value_format.format(values[index]))
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as w:
+            w.write('\n'.join(lines) + '\n')
+        os.replace(temporary, self.path)
+
+    def close(self):
+        self.write()
+
+
+@contextlib.contextmanager
+def recording(jsonl=None, prometheus=None):
+    """ register the json lines and/or Prometheus hooks for the enclosed block (command line helper) """
+    hooks = []
+    if jsonl:
+        hooks.append(add_hook(JsonLines(jsonl)))
+    if prometheus:
+        hooks.append(add_hook(PrometheusTextfile(prometheus)))
+    try:
+        yield
+    finally:
+        for hook in hooks:
+            remove_hook(hook)
+            hook.close()
@@ -0,0 +1,182 @@
+# -----------------------------------------------------------------------------
+# bound the time spent on a device: session deadlines and a device budget
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# The ssh ConnectTimeout bounds the TCP connection and the banner exchange,
+# the whole scp (transfer) or ssh command (exec) session is bounded by the
+# connect timeout plus the transfer or exec timeout. A device can also get a
+# budget shared by all its sessions, retries included; the wait before the
+# activation is not counted. The sessions run under setsid: one which
+# outlives its deadline is killed with its whole process group and raises
+# SessionTimeout, recorded as a timeout in the fleet results.
+# ----------------------------------------------------------------------------
+
+import asyncio
+import contextlib
+import contextvars
+import math
+import os
+import signal
+import subprocess
+import threading
+import time
+
+# seconds, None for no limit
+CONNECT_TIMEOUT = 30.0
+TRANSFER_TIMEOUT = 600.0
+EXEC_TIMEOUT = 600.0
+DEVICE_BUDGET = None
+# return code of a killed session, as timeout(1)
+TIMEOUT_RETURNCODE = 124
+
+# time.monotonic() at which the budget of the device being configured is spent
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+class SessionTimeout(OSError):
+    """ a session killed because it outlived its deadline """
+
+
+class BudgetExceeded(SessionTimeout):
+    """ the budget of the device is spent, it is not retried """
+
+
+def configure(connect=None, transfer=None, exec_=None, budget=None):
+    """ change the timeouts and the device budget, in seconds, 0 for no limit """
+    global CONNECT_TIMEOUT, TRANSFER_TIMEOUT, EXEC_TIMEOUT, DEVICE_BUDGET
+    if connect is not None:
+        CONNECT_TIMEOUT = connect or None
+    if transfer is not None:
+        TRANSFER_TIMEOUT = transfer or None
+    if exec_ is not None:
+        EXEC_TIMEOUT = exec_ or None
+    if budget is not None:
+        DEVICE_BUDGET = budget or None
+
+
+@contextlib.contextmanager
+def device_budget(seconds=None):
+    """ the sessions started within the block share a budget of seconds (default DEVICE_BUDGET) """
+    seconds = DEVICE_BUDGET if seconds is None else seconds
+    token = _deadline.set(time.monotonic() + seconds if seconds else None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def postpone(seconds):
+    """ the device waits seconds on purpose (activation delay), its budget is pushed back """
+    deadline = _deadline.get()
+    if deadline is not None and seconds > 0:
+        _deadline.set(deadline + seconds)
+
+
+def remaining():
+    """ seconds left in the budget of the device, None without budget """
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def budget_error(dest):
+    """ the error raised once the budget of dest is spent """
+    error = BudgetExceeded("Budget of the device {dest} spent, session not completed".format(dest=dest))
+    error.returncode = TIMEOUT_RETURNCODE
+    return error
+
+
+def session_timeout(phase, dest=None):
+    """ the seconds a session of phase (connect, transfer or exec) may last and True if the
+        budget of the device is the limit. Raise BudgetExceeded if the budget is already spent """
+    if phase == 'connect':
+        timeout = CONNECT_TIMEOUT
+    else:
+        limit = { 'transfer': TRANSFER_TIMEOUT, 'exec': EXEC_TIMEOUT }[phase]
+        timeout = None if limit is None else limit + (CONNECT_TIMEOUT or 0.0)
+    left = remaining()
+    if left is None or (timeout is not None and timeout <= left):
+        return timeout, False
+    if left <= 0:
+        raise budget_error(dest)
+    return left, True
+
+
+def command(os_cmd, dest=None):
+    """ the scp/ssh command line with its ConnectTimeout option. Raise BudgetExceeded
+        if the budget of the device is spent, so the session is not started """
+    session_timeout('connect', dest)
+    if CONNECT_TIMEOUT is None:
+        return os_cmd
+    for n, word in enumerate(os_cmd):
+        if word in ('ssh', 'scp'):
+            return ( os_cmd[:n+1] + [ '-o', 'ConnectTimeout={s}'.format(s=math.ceil(CONNECT_TIMEOUT)) ]
+                     + os_cmd[n+1:] )
+    return os_cmd
+
+
+def kill_group(p):
+    """ kill the session and everything it started: setsid made it the leader of a process group """
+    try:
+        pgid = os.getpgid(p.pid)
+        if pgid != os.getpgrp():
+            os.killpg(pgid, signal.SIGKILL)
+        else:                   # setsid did not run yet
+            p.kill()
+    except ProcessLookupError:
+        pass
+
+
+def expired(phase, dest, timeout, by_budget):
+    """ the error raised for a session killed after timeout seconds """
+    if by_budget:
+        return budget_error(dest)
+    error = SessionTimeout("{phase} session to {dest} timed out after {s:.0f}s, killed".format(
+                           phase=phase, dest=dest, s=timeout))
+    error.returncode = TIMEOUT_RETURNCODE
+    return error
+
+
+def communicate(p, input=None, phase='exec', dest=None):
+    """ p.communicate(input) within the deadline of the session, the process group is killed
+        and SessionTimeout raised when it is over """
+    timeout, by_budget = session_timeout(phase, dest)
+    try:
+        return p.communicate(input, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_group(p)
+        p.communicate()
+        raise expired(phase, dest, timeout, by_budget)
+
+
+async def communicate_async(p, input=None, phase='exec', dest=None):
+    """ coroutine version of communicate for an asyncio subprocess """
+    timeout, by_budget = session_timeout(phase, dest)
+    try:
+        return await asyncio.wait_for(p.communicate(input), timeout)
+    except asyncio.TimeoutError:
+        kill_group(p)
+        await p.wait()
+        raise expired(phase, dest, timeout, by_budget)
+
+
+@contextlib.contextmanager
+def watchdog(p, phase='exec', dest=None):
+    """ kill the process group of p if the block outlives the deadline of the session, then raise
+        SessionTimeout. For the interactive sessions, subprocess or asyncio, whose output is read
+        in the block: the kill ends their output """
+    timeout, by_budget = session_timeout(phase, dest)
+    fired = threading.Event()
+    def expire():
+        fired.set()
+        kill_group(p)
+    timer = threading.Timer(timeout, expire) if timeout is not None else None
+    if timer is not None:
+        timer.daemon = True
+        timer.start()
+    try:
+        yield
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if fired.is_set():
+        raise expired(phase, dest, timeout, by_budget)
@@ -9,3 +9,7 @@ DEVICE=172.16.63.149
 #   using data from loopbacks.json and delayed by 60 seconds
 python ../EkinopsCfg.py -a $DEVICE -u admin -t oalb.j2 -d @loopbacks.json -E tipyte -w 5 -o oa.cfg
 
+
+# run two scripts in order within a single ssh session, the second one is not run
+#   if the output of the first one shows an error
+python ../EkinopsCfg.py -a $DEVICE -u admin -t oalb.j2 -t oalb.j2 -d @loopbacks.json -E tipyte
@@ -12,3 +12,14 @@ python ../CiscoCfg.py -a $DEVICE -u cisco -t loopback.j0 -d '{ "loop_nb": 777, "
 #   using data from loopbacks.json and delayed by 60 seconds
 python ../CiscoCfg.py -a $DEVICE -u cisco -t loopbacks.j2 -d @loopbacks.json -E tipyte -w 60
 
+
+# configure every device listed in inventory.json, 16 devices at a time
+python ../FleetCfg.py -i inventory.json -m cisco -t loopback.j0 -j 16
+
+# pre-compile the tipyte templates into templates.tpk, then use the pack instead of the template files
+python ../PackTemplates.py -t .
+python ../CiscoCfg.py -K templates.tpk -a $DEVICE -u cisco -t loopbacks.j2 -d @loopbacks.json -E tipyte
+
+# keep templates compiled and ssh connections warm in a daemon, then send it jobs
+python ../CfgDaemon.py --serve &
+python ../CfgDaemon.py -a $DEVICE -u cisco -t loopbacks.j2 -d @loopbacks.json -E tipyte
@@ -0,0 +1,87 @@
+# -----------------------------------------------------------------------------
+# read huge json inputs one record at a time
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# Two layouts are accepted, the file is read by chunks so the memory used
+# depends on the size of a record, not on the size of the file:
+#    one json array of objects          [ { "host": ... }, { "host": ... } ]
+#    json lines (NDJSON)                { "host": ... }
+#                                       { "host": ... }
+# ----------------------------------------------------------------------------
+
+import contextlib
+import json
+import re
+import sys
+
+# size of the reads, grown while a record does not fit
+CHUNK_SIZE = 1 << 16
+# extensions of the json lines files
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+# blanks between two records, commas between the items of the array
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_records(stream, chunk_size=CHUNK_SIZE):
+    """ yield the json objects of stream, either the items of a top-level array
+        or a sequence of objects (one per line for NDJSON) """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = '', 0, False
+    in_array = None                 # unknown until the first character is read
+    while True:
+        pos = _SEPARATORS.match(buffer, pos).end()
+        if pos == len(buffer):
+            if eof:
+                break
+            buffer, pos = stream.read(chunk_size), 0
+            eof = not buffer
+            continue
+        if in_array is None:
+            in_array = buffer[pos]=='['
+            pos += in_array
+            continue
+        if in_array and buffer[pos]==']':
+            return
+        try:
+            record, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # keep the unparsed tail and read more, at least as much as the tail so
+            # a record larger than chunk_size is still parsed in linear time
+            chunk = stream.read(max(chunk_size, len(buffer) - pos))
+            buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+            continue
+        if not isinstance(record, dict):
+            raise ValueError("expecting json objects, got {}".format(type(record).__name__))
+        yield record
+    if in_array:
+        raise ValueError("unterminated json array")
+
+
+def is_record_file(path):
+    """ True if the file holds several records: json lines, a top-level json array or the standard input """
+    if path == '-' or path.endswith(NDJSON_EXTENSIONS):
+        return True            # the standard input can not be read twice
+    with open(path, 'r') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            head = chunk.lstrip()
+            if head:
+                return head.startswith('[')
+    return False
+
+
+@contextlib.contextmanager
+def open_input(path):
+    """ open path for reading, '-' is the standard input """
+    if path == '-':
+        yield sys.stdin
+    else:
+        with open(path, 'r') as f:
+            yield f
+
+
+def read_records(path, chunk_size=CHUNK_SIZE):
+    """ yield the json objects of the file path ('-' for the standard input) """
+    with open_input(path) as f:
+        yield from iter_records(f, chunk_size)
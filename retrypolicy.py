@@ -0,0 +1,232 @@
+# -----------------------------------------------------------------------------
+# retry of the scp/ssh sessions which fail for a transient reason
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# The stderr of a failed session is classified: connection refused or timed
+# out, connection reset, AAA server not answering are retried after a jittered
+# exponential backoff, a wrong password or a failing command are not.
+# Devices which keep failing get their circuit opened: their sessions fail at
+# once until a cooldown is over, then one session is tried again.
+# The exec of a script is only retried when it failed before the login.
+# A device whose budget (deadlines) would be spent by the backoff is not retried.
+# New logins (sessions not going through a sshmux master connection) can be
+# limited to a global rate so a large rollout does not overload the AAA servers.
+# ----------------------------------------------------------------------------
+
+import asyncio
+import functools
+import inspect
+import random
+import re
+import threading
+import time
+
+import deadlines
+
+# number of retries after the first attempt
+RETRIES = 2
+# backoff: a random delay between 0 and min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt) seconds
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+# number of failures in a row which open the circuit of a device, and for how many seconds
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60.0
+# the failures which are worth a retry, matched against the error message
+TRANSIENT_ERRORS = [ ('refused', re.compile(r'Connection refused', re.I)),
+                     ('timeout', re.compile(r'timed out|Operation timed out|Connection timeout', re.I)),
+                     ('reset',   re.compile(r'Connection reset|Connection closed|closed by remote host'
+                                            r'|Broken pipe|kex_exchange_identification', re.I)),
+                     ('aaa',     re.compile(r'Authorization failed|server timeout|TACACS|RADIUS', re.I)) ]
+# the failures which are not: retrying a wrong password may lock the account
+PERMANENT_ERRORS = [ ('auth',    re.compile(r'Permission denied|Authentication failed|Too many authentication', re.I)),
+                     ('dns',     re.compile(r'Could not resolve hostname|Name or service not known', re.I)),
+                     ('budget',  re.compile(r'Budget of the device .* spent', re.I)) ]
+# the failures which happen before the login: nothing was run on the device yet
+BEFORE_LOGIN_ERRORS = re.compile(r'Connection refused|connect to host .* timed out|during banner exchange'
+                                 r'|No route to host|Network is unreachable|kex_exchange_identification', re.I)
+
+
+def classify(error):
+    """ return the kind of failure of error: refused, timeout, reset, aaa (retried),
+        auth, dns, budget, circuit or other (not retried) """
+    if isinstance(error, CircuitOpenError):
+        return 'circuit'
+    message = str(error)
+    for kind, pattern in PERMANENT_ERRORS + TRANSIENT_ERRORS:
+        if pattern.search(message):
+            return kind
+    return 'other'
+
+
+def is_transient(kind):
+    """ True if a failure of this kind is retried """
+    return kind in dict(TRANSIENT_ERRORS)
+
+
+def before_login(error):
+    """ True if error stopped the session before the login, so the command did not run """
+    return not isinstance(error, CircuitOpenError) and bool(BEFORE_LOGIN_ERRORS.search(str(error)))
+
+
+def backoff_delay(attempt):
+    """ the seconds to wait before retry number attempt (from 0), full jitter """
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class CircuitOpenError(OSError):
+    """ raised instead of starting a session to a device whose circuit is open """
+
+
+class CircuitBreaker:
+    """ consecutive transient failures per device, the circuit opens after threshold of them """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.devices = {}      # dest -> [ failures in a row, time the circuit was opened or None ]
+
+    def check(self, dest):
+        """ raise CircuitOpenError if dest must not be tried now. Once the cooldown
+            is over, a single session is let through (half open) """
+        with self.lock:
+            state = self.devices.get(dest)
+            if state is None or state[1] is None:
+                return
+            remaining = state[1] + self.cooldown - time.monotonic()
+            if remaining <= 0:
+                state[1] = time.monotonic()      # the next ones wait for this trial
+                return
+        error = CircuitOpenError("Circuit open for {dest} after {n} failures, next try in {s:.0f}s".format(
+                                 dest=dest, n=state[0], s=remaining))
+        error.returncode = 255
+        raise error
+
+    def success(self, dest):
+        """ close the circuit of dest """
+        with self.lock:
+            self.devices.pop(dest, None)
+
+    def failure(self, dest):
+        """ count a transient failure of dest, return True if its circuit is open """
+        with self.lock:
+            state = self.devices.setdefault(dest, [ 0, None ])
+            state[0] += 1
+            if state[0] >= self.threshold:
+                state[1] = time.monotonic()
+            return state[1] is not None
+
+
+class LoginRateLimiter:
+    """ at most rate logins per second for the whole process, burst of them at once """
+
+    def __init__(self, rate=0.0, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.next_login = 0.0  # theoretical time of the next login (GCRA)
+
+    def reserve(self):
+        """ book a login, return the seconds to wait before doing it """
+        if self.rate <= 0:
+            return 0.0
+        interval = 1.0 / self.rate
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_login - (self.burst - 1) * interval)
+            self.next_login = max(self.next_login, now) + interval
+        return start - now
+
+    def acquire(self):
+        """ wait for a login slot """
+        time.sleep(self.reserve())
+
+    async def acquire_async(self):
+        """ coroutine version of acquire """
+        await asyncio.sleep(self.reserve())
+
+
+# shared by all the sessions of the process
+BREAKER = CircuitBreaker()
+LOGIN_LIMITER = LoginRateLimiter()
+
+
+def configure(retries=None, login_rate=None, login_burst=None):
+    """ change the retry count and the login rate (logins per second, 0 for no limit) """
+    global RETRIES
+    if retries is not None:
+        RETRIES = retries
+    if login_rate is not None:
+        LOGIN_LIMITER.rate = login_rate
+        LOGIN_LIMITER.burst = login_burst or max(1, int(login_rate))
+
+
+def needs_login(ssh_options):
+    """ False if the session goes through a sshmux master connection """
+    return 'ControlMaster=no' not in (ssh_options or '')
+
+
+def retried(function, retry_if=None):
+    """ decorator of the functions (or coroutines) starting a scp/ssh session: their
+        dest and ssh_options arguments select the circuit and the login limit, the
+        OSError they raise for a transient failure (or for which retry_if(error) is
+        True) makes them run again """
+    signature = inspect.signature(function)
+
+    def session(args, kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        return arguments.arguments['dest'], needs_login(arguments.arguments.get('ssh_options'))
+
+    def failed(dest, error, attempt):
+        """ return the seconds to wait before the next attempt, raise error if there is none """
+        kind = classify(error)
+        if not (is_transient(kind) if retry_if is None else retry_if(error)):
+            raise error
+        if BREAKER.failure(dest) or attempt >= RETRIES:
+            raise error
+        delay = backoff_delay(attempt)
+        left = deadlines.remaining()
+        if left is not None and left <= delay:      # no time left in the device budget for a retry
+            raise error
+        print ("{dest}: {kind} failure, retry {n}/{max} in {delay:.1f}s".format(
+               dest=dest, kind=kind, n=attempt + 1, max=RETRIES, delay=delay))
+        return delay
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            dest, login = session(args, kwargs)
+            for attempt in range(RETRIES + 1):
+                BREAKER.check(dest)
+                if login:
+                    await LOGIN_LIMITER.acquire_async()
+                try:
+                    result = await function(*args, **kwargs)
+                except OSError as e:
+                    await asyncio.sleep(failed(dest, e, attempt))
+                else:
+                    BREAKER.success(dest)
+                    return result
+    else:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            dest, login = session(args, kwargs)
+            for attempt in range(RETRIES + 1):
+                BREAKER.check(dest)
+                if login:
+                    LOGIN_LIMITER.acquire()
+                try:
+                    result = function(*args, **kwargs)
+                except OSError as e:
+                    time.sleep(failed(dest, e, attempt))
+                else:
+                    BREAKER.success(dest)
+                    return result
+    return wrapper
+
+
+def retried_before_login(function):
+    """ retried for the sessions which must not run twice (exec of a script): a session
+        which failed once logged in may have run part of its command, it is not retried """
+    return retried(function, before_login)
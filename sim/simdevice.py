@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# fake setsid / scp / ssh commands emulating Cisco and Ekinops devices
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# Put sim/bin in front of the PATH and CiscoCfg, EkinopsCfg and FleetCfg
+# talk to simulated devices instead of real routers. Each device is a
+# directory $SIM_ROOT/<host> which holds:
+#    running-config       the configuration copied to running-config
+#    bootflash/           the files copied to bootflash:/
+#    BSA/scripts/         the scripts copied to /BSA/scripts/ (Ekinops)
+#    profile.json         optional, overwrites the settings below for this device
+#    sessions.log         one line per login: scp or ssh and the command run
+#
+# Commands: show running-config, exec, dir bootflash:/ (IOS listing),
+# ls -l <dir> (Ekinops listing), rm <paths>, delete /force <path> and
+# echo <text>. Without command, ssh reads the commands on its standard input
+# and answers each line at once (interactive session). A script line starting
+# with "invalid" makes exec print "% Invalid input detected".
+# A copied EEM applet loads its staged file and runs its delete actions.
+#
+# Settings (environment variables, or keys of profile.json in lowercase
+# without the SIM_ prefix):
+#    SIM_ROOT          directory of the devices (default /tmp/simdevices)
+#    SIM_LATENCY       seconds spent in the ssh handshake (default 0)
+#    SIM_BANDWIDTH     bytes per second of the transfers, 0 for unlimited (default 0)
+#    SIM_FAILURE_RATE  probability a session fails (default 0)
+#    SIM_HANG_RATE     probability a session hangs in the handshake (default 0),
+#                      -o ConnectTimeout=n makes it fail after n seconds instead
+#    SIM_STALL_RATE    probability a session stalls once logged in (default 0)
+#    SIM_RESET_RATE    probability an scp is reset once logged in (default 0), a copy
+#                      to running-config has then applied the first half of its lines
+#    SIM_HANG_SECONDS  duration of a hang or a stall (default 3600)
+# ----------------------------------------------------------------------------
+
+import json
+import os
+import random
+import sys
+import time
+
+# options of ssh/scp which take a value
+OPTIONS_WITH_VALUE = ('-o', '-O', '-p', '-P', '-i', '-l', '-F', '-c', '-S', '-E', '-J')
+# errors returned by a failing session, as printed by OpenSSH or by the device
+FAILURES = [ 'ssh: connect to host {host} port 22: Connection refused',
+             'ssh: connect to host {host} port 22: Connection timed out',
+             'Permission denied, please try again.',
+             '% Authorization failed.' ]
+DEFAULTS = { 'root': '/tmp/simdevices', 'latency': 0.0, 'bandwidth': 0.0,
+             'failure_rate': 0.0, 'hang_rate': 0.0, 'stall_rate': 0.0, 'reset_rate': 0.0,
+             'hang_seconds': 3600.0 }
+
+
+def settings(host):
+    """ return the settings of the device: defaults, environment then profile.json """
+    conf = dict(DEFAULTS)
+    for key in conf:
+        value = os.environ.get('SIM_' + key.upper())
+        if value:
+            conf[key] = value if key=='root' else float(value)
+    profile = os.path.join(conf['root'], host, 'profile.json')
+    if os.path.exists(profile):
+        with open(profile) as f:
+            conf.update(json.load(f))
+    return conf
+
+
+def positional(argv):
+    """ return the arguments of an ssh/scp command line which are not options """
+    args, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in OPTIONS_WITH_VALUE:
+            skip = True
+        elif arg.startswith('-') and not args:
+            continue
+        else:
+            args.append(arg)
+    return args
+
+
+def connect_timeout(argv):
+    """ the seconds of the -o ConnectTimeout=n option, None without it """
+    for option, value in zip(argv, argv[1:]):
+        if option == '-o' and value.lower().startswith('connecttimeout='):
+            return float(value.split('=', 1)[1])
+    return None
+
+
+def device_dir(conf, host):
+    """ return the directory of the device, create it on first use """
+    path = os.path.join(conf['root'], host)
+    for sub in ('bootflash', os.path.join('BSA', 'scripts')):
+        os.makedirs(os.path.join(path, sub), exist_ok=True)
+    return path
+
+
+def remote_path(directory, path):
+    """ map a path of the device to a local file """
+    if path == 'running-config':
+        return os.path.join(directory, 'running-config')
+    if path.startswith('bootflash:'):
+        return os.path.join(directory, 'bootflash', path[len('bootflash:'):].lstrip('/'))
+    return os.path.join(directory, path.lstrip('/'))
+
+
+def connect(conf, host, session='', timeout=None):
+    """ emulate the handshake: latency, failures, hangs (bounded by timeout) and stalls. Log the session """
+    os.makedirs(os.path.join(conf['root'], host), exist_ok=True)
+    with open(os.path.join(conf['root'], host, 'sessions.log'), 'a') as log:
+        log.write(session + '\n')
+    time.sleep(conf['latency'])
+    draw = random.random()
+    if draw < conf['hang_rate']:
+        if timeout is not None and timeout < conf['hang_seconds']:
+            time.sleep(timeout)
+            sys.stderr.write('Connection timed out during banner exchange\n')
+            sys.exit(255)
+        time.sleep(conf['hang_seconds'])
+    elif draw < conf['hang_rate'] + conf['failure_rate']:
+        sys.stderr.write(random.choice(FAILURES).format(host=host) + '\n')
+        sys.exit(255)
+    elif draw < conf['hang_rate'] + conf['failure_rate'] + conf['stall_rate']:
+        time.sleep(conf['hang_seconds'])
+
+
+def transfer(conf, size):
+    """ emulate the time needed to send size bytes """
+    if conf['bandwidth']:
+        time.sleep(size / conf['bandwidth'])
+
+
+def reset(conf, directory, path, content):
+    """ emulate a session reset by the device in the middle of the transfer of content to path """
+    if random.random() >= conf['reset_rate']:
+        return
+    if path == 'running-config':
+        lines = content.splitlines(True)
+        apply_config(directory, b''.join(lines[:len(lines)//2]))
+    sys.stderr.write('Connection reset by peer\r\nlost connection\n')
+    sys.exit(255)
+
+
+def apply_config(directory, content):
+    """ merge content into the running-config of the device """
+    with open(os.path.join(directory, 'running-config'), 'ab') as w:
+        w.write(content)
+
+
+def listing(directory, path, line_format):
+    """ the files of a directory of the device, one line_format line each """
+    local = remote_path(directory, path)
+    lines = ''
+    for n, name in enumerate(sorted(os.listdir(local)), 1):
+        lines += line_format.format(n=n, size=os.path.getsize(os.path.join(local, name)), name=name)
+    return lines.encode()
+
+
+def delete(directory, path):
+    """ remove a file of the device, ignore missing ones """
+    try:
+        os.remove(remote_path(directory, path))
+    except FileNotFoundError:
+        pass
+
+
+def split_host(target):
+    """ [user@]host[:path] -> host, path """
+    target = target.split('@', 1)[-1]
+    host, _, path = target.partition(':')
+    return host, path
+
+
+def scp(argv):
+    """ scp [options] local_file... [user@]host:path, path is a directory when it ends with / """
+    args = positional(argv)
+    sources, target = args[:-1], args[-1]
+    host, path = split_host(target)
+    conf = settings(host)
+    connect(conf, host, 'scp ' + path, connect_timeout(argv))
+    directory = device_dir(conf, host)
+    if path.endswith('/'):
+        for source in sources:
+            with open(source, 'rb') as f:
+                content = f.read()
+            transfer(conf, len(content))
+            with open(os.path.join(remote_path(directory, path), os.path.basename(source)), 'wb') as w:
+                w.write(content)
+        return 0
+    with open(sources[0], 'rb') as f:
+        content = f.read()
+    transfer(conf, len(content))
+    reset(conf, directory, path, content)
+    local = remote_path(directory, path)
+    if path == 'running-config':
+        apply_config(directory, content)
+        # a copied EEM applet loads its staged file, the countdown is not emulated
+        if b'event manager applet' in content:
+            for line in content.decode(errors='replace').splitlines():
+                if 'copy bootflash:/' in line:
+                    staged = line.split('copy bootflash:/')[1].split()[0]
+                    with open(os.path.join(directory, 'bootflash', staged), 'rb') as f:
+                        apply_config(directory, f.read())
+                elif 'delete /force ' in line:
+                    delete(directory, line.split('delete /force ')[1].split()[0].strip('"'))
+    else:
+        with open(local, 'wb') as w:
+            w.write(content)
+    sys.stdin.read()        # the copy confirmation sent by CiscoCfg
+    return 0
+
+
+def ssh(argv):
+    """ ssh [options] [user@]host [command] """
+    if '-O' in argv:        # control of a master connection (sshmux)
+        return 0
+    args = positional(argv)
+    host, _ = split_host(args[0])
+    conf = settings(host)
+    connect(conf, host, 'ssh ' + ' '.join(args[1:]), connect_timeout(argv))
+    if '-N' in argv:        # master connection started in background
+        return 0
+    directory = device_dir(conf, host)
+    if len(args) > 1:
+        output = b''.join(run(directory, line) for line in ' '.join(args[1:]).splitlines())
+        transfer(conf, len(output))
+        sys.stdout.buffer.write(output)
+        return 0
+    for line in sys.stdin:
+        if line.strip() == 'exit':
+            break
+        output = run(directory, line)
+        transfer(conf, len(output))
+        sys.stdout.buffer.write(output)
+        sys.stdout.flush()
+    return 0
+
+
+def run(directory, line):
+    """ run a command line on the device, return its output """
+    output = b''
+    words = line.split()
+    if words[:2] == ['show', 'running-config']:
+        path = os.path.join(directory, 'running-config')
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                output += f.read()
+    elif words[:1] == ['dir']:
+        output += listing(directory, words[1],
+                          '  {n:3d}  -rw-  {size:10d}  Mar 1 2022 10:00:00 +00:00  {name}\n')
+    elif words[:2] == ['ls', '-l']:
+        output += listing(directory, words[2],
+                          '-rw-r--r--  1 root root  {size:8d} Mar  1 10:00 {name}\n')
+    elif words[:1] == ['rm']:
+        for path in words[1:]:
+            delete(directory, path)
+    elif words[:2] == ['delete', '/force']:
+        delete(directory, words[2])
+    elif words[:1] == ['exec']:
+        with open(remote_path(directory, words[-1]), 'rb') as f:
+            script = f.read()
+        apply_config(directory, script)
+        if '-echo' in words:
+            output += script
+        for script_line in script.splitlines():
+            if script_line.startswith(b'invalid'):
+                output += b'% Invalid input detected\n'
+    elif words[:1] == ['echo']:
+        output += ' '.join(words[1:]).encode() + b'\n'
+    return output
+
+
+def setsid(argv):
+    """ setsid [-w] program args: program runs in a new session and process group """
+    while argv and argv[0].startswith('-'):
+        argv = argv[1:]
+    try:
+        os.setsid()
+    except PermissionError:     # already a process group leader
+        pass
+    os.execvp(argv[0], argv)
+
+
+if __name__ == "__main__":
+    command = os.path.basename(sys.argv[0])
+    if command == 'setsid':
+        setsid(sys.argv[1:])
+    elif command == 'scp':
+        sys.exit(scp(sys.argv[1:]))
+    else:
+        sys.exit(ssh(sys.argv[1:]))
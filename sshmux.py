@@ -0,0 +1,82 @@
+# -----------------------------------------------------------------------------
+# keep one ssh master connection per device (OpenSSH ControlMaster)
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# All the scp/ssh sessions of a run go through the master connection, so the
+# TCP/SSH key exchange and the AAA login are done only once per device.
+# ----------------------------------------------------------------------------
+
+import contextlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+import cfgmetrics
+import deadlines
+import retrypolicy
+
+# disable prompt for new ssh connections (setsid may not behave correctly)
+SSH_OPTIONS = '-o StrictHostKeyChecking=no'
+SETSID_OPTIONS = '-w'
+# options given to the scp/ssh commands which reuse the master connection
+MUX_OPTIONS = '-o ControlMaster=no -o ControlPath={path}'
+
+
+@retrypolicy.retried
+def open_session(dest, username='', ssh_options=SSH_OPTIONS):
+    """ start the master connection in background, return the path of its control socket """
+    control_dir = tempfile.mkdtemp(prefix='sshmux-')
+    control_path = os.path.join(control_dir, 'master')
+    os_cmd = ( [ 'setsid', ]		# <-- first magic to skip ssh from asking password
+               + SETSID_OPTIONS.split() + [ 'ssh', ]
+               + ssh_options.split() + [
+                 '-o', 'ControlMaster=yes',
+                 '-o', 'ControlPersist=yes',
+                 '-o', 'ControlPath=' + control_path,
+                 '-N', '-f',
+                 '{username}{at}{dest}'.format(username=username, at='@' if username!='' else '', dest=dest),
+               ] )
+    print ("starting master connection with cmd: ", os_cmd)
+    with cfgmetrics.phase('connect', dest):
+        p = subprocess.Popen(deadlines.command(os_cmd, dest), shell=False, stdin=subprocess.DEVNULL,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            out, err = deadlines.communicate(p, None, 'connect', dest)
+        except OSError:
+            shutil.rmtree(control_dir, ignore_errors=True)
+            raise
+        if p.returncode!=0:
+           shutil.rmtree(control_dir, ignore_errors=True)
+           print ("Error: subprocess return:\n{err}".format(err=err))
+           error = OSError("Error during master connection: " + err.decode(errors="replace").strip())
+           error.returncode = p.returncode
+           raise error
+    return control_path
+
+
+def close_session(dest, control_path, username=''):
+    """ ask the master connection to exit and remove its control socket """
+    os_cmd = [ 'ssh', '-o', 'ControlPath=' + control_path, '-O', 'exit',
+               '{username}{at}{dest}'.format(username=username, at='@' if username!='' else '', dest=dest) ]
+    subprocess.call(os_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    shutil.rmtree(os.path.dirname(control_path), ignore_errors=True)
+
+
+def session_options(control_path):
+    """ the ssh options which send a scp/ssh command through the master connection """
+    return MUX_OPTIONS.format(path=control_path)
+
+
+@contextlib.contextmanager
+def ssh_session(dest, username='', ssh_options=SSH_OPTIONS):
+    """ open a master connection to dest, yield the options to reuse it and close it at exit
+
+    >>> with ssh_session('10.0.0.1', 'cisco') as mux_options:
+    ...     scp_file(filename, 'cisco', '10.0.0.1', path, ssh_options=SSH_OPTIONS + ' ' + mux_options)
+    """
+    control_path = open_session(dest, username, ssh_options)
+    try:
+        yield session_options(control_path)
+    finally:
+        close_session(dest, control_path, username)
@@ -0,0 +1,70 @@
+# -----------------------------------------------------------------------------
+# remember the configurations already pushed to the devices
+# by PJO - March 2022                    https://github.com/PJO2/cisco_ssh_cfg
+#
+# A sqlite database records, for each device and template, the hash of the
+# last configuration successfully sent and when it was sent, so a new run
+# can skip the devices which would receive the same configuration again.
+# ----------------------------------------------------------------------------
+
+import hashlib
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pushes (
+    device    TEXT NOT NULL,
+    template  TEXT NOT NULL,
+    hash      TEXT NOT NULL,
+    pushed_at REAL NOT NULL,
+    PRIMARY KEY (device, template)
+)
+"""
+
+
+def config_hash(config):
+    """ return the hash of a resolved configuration """
+    if isinstance(config, str):
+        config = config.encode()
+    return hashlib.sha256(config).hexdigest()
+
+
+def open_db(state_db):
+    """ open (and create if needed) the database, one connection per caller since
+        the fleet configures devices from several threads """
+    directory = os.path.dirname(state_db)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    db = sqlite3.connect(state_db, timeout=60)
+    db.execute(SCHEMA)
+    return db
+
+
+def last_push(state_db, device, tmpl_name):
+    """ return (hash, pushed_at) of the last configuration sent to the device with the template, or None """
+    db = open_db(state_db)
+    try:
+        return db.execute("SELECT hash, pushed_at FROM pushes WHERE device=? AND template=?",
+                          (device, os.path.abspath(tmpl_name))).fetchone()
+    finally:
+        db.close()
+
+
+def already_pushed(state_db, device, tmpl_name, digest):
+    """ return the time the same configuration was pushed to device, or None if it was not """
+    last = last_push(state_db, device, tmpl_name)
+    if last is not None and last[0]==digest:
+        return last[1]
+    return None
+
+
+def record_push(state_db, device, tmpl_name, digest):
+    """ store the hash of the configuration successfully sent to the device """
+    db = open_db(state_db)
+    try:
+        with db:
+            db.execute("INSERT OR REPLACE INTO pushes (device, template, hash, pushed_at) VALUES (?, ?, ?, ?)",
+                       (device, os.path.abspath(tmpl_name), digest, time.time()))
+    finally:
+        db.close()
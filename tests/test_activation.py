@@ -0,0 +1,63 @@
+import concurrent.futures
+import datetime
+import threading
+import time
+
+import pytest
+
+import activation
+import FleetCfg
+
+
+def test_parse_time():
+    assert activation.parse_time('1700000000') == 1700000000.0
+    assert activation.parse_time('2030-01-02T03:04:05') == datetime.datetime(2030, 1, 2, 3, 4, 5).timestamp()
+    at = activation.parse_time('00:00')
+    assert time.time() < at <= time.time() + 24 * 3600
+    with pytest.raises(ValueError):
+        activation.parse_time('tomorrow')
+
+
+def test_countdown():
+    assert activation.countdown(time.time() + 10.2) == 11
+    with pytest.raises(OSError):
+        activation.countdown(time.time() - 1)
+
+
+def test_deferred_execs_run_at_their_time_in_order():
+    scheduler = activation.DeferredExec(workers=1)
+    start = time.time()
+    ran = []
+    late = scheduler.submit(start + 0.4, lambda: ran.append(('late', time.time())) or 'late')
+    early = scheduler.submit(start + 0.2, lambda: ran.append(('early', time.time())) or 'early')
+    assert early.result(5) == 'early'
+    assert late.result(5) == 'late'
+    assert [ name for name, _ in ran ] == [ 'early', 'late' ]
+    assert ran[0][1] >= start + 0.2
+    assert ran[1][1] >= start + 0.4
+
+
+def test_deferred_exec_failure_goes_to_its_future():
+    scheduler = activation.DeferredExec()
+    def fail():
+        raise OSError("Error during remote ssh command")
+    future = scheduler.submit(time.time(), fail)
+    with pytest.raises(OSError):
+        future.result(5)
+
+
+def test_deferred_execs_do_not_hold_each_other():
+    scheduler = activation.DeferredExec(workers=4)
+    barrier = threading.Barrier(4, timeout=5)
+    futures = [ scheduler.submit(time.time() + 0.1, barrier.wait) for _ in range(4) ]
+    concurrent.futures.wait(futures, timeout=5)
+    assert all(future.exception() is None for future in futures)
+
+
+def test_activated_duration_includes_the_exec():
+    result = { 'host': 'e1', 'status': 'staged', 'duration': 0.1, 'stderr': '', 'start': time.time() - 30 }
+    FleetCfg.activated(result)
+    assert result['status'] == 'ok'
+    assert result['duration'] >= 30
+    assert 'start' not in result
+    assert FleetCfg.activated(dict(result, start=time.time()), OSError("exec failed"))['status'] == 'failed'
@@ -0,0 +1,58 @@
+import os
+import tarfile
+import time
+import zipfile
+
+import pytest
+
+import cfgarchive
+
+CONFIGS = [ ("r{n}.cfg".format(n=n), "hostname r{n}\ninterface Loopback{n}\n".format(n=n)) for n in range(20) ]
+
+
+def write_archive(path):
+    with cfgarchive.ConfigArchive(str(path)) as archive:
+        for name, text in CONFIGS:
+            archive.add(name, text)
+    with open(str(path), 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('extension', [ '.tar', '.tar.gz', '.tgz', '.tar.xz', '.zip' ])
+def test_same_configurations_same_bytes(tmp_path, monkeypatch, extension):
+    first = write_archive(tmp_path / ('first' + extension))
+    # another run: later, from another process, with another umask
+    monkeypatch.setattr(time, 'time', lambda: 2000000000.0)
+    monkeypatch.setattr(os, 'getpid', lambda: 4242)
+    old_umask = os.umask(0o077)
+    try:
+        second = write_archive(tmp_path / ('second' + extension))
+    finally:
+        os.umask(old_umask)
+    assert first == second
+
+
+def test_members_in_order(tmp_path):
+    write_archive(tmp_path / 'fleet.tar.gz')
+    with tarfile.open(str(tmp_path / 'fleet.tar.gz')) as archive:
+        assert archive.getnames() == [ name for name, _ in CONFIGS ]
+        assert archive.extractfile('r3.cfg').read().decode() == CONFIGS[3][1]
+        assert { member.mtime for member in archive } == { cfgarchive.MEMBER_MTIME }
+    write_archive(tmp_path / 'fleet.zip')
+    with zipfile.ZipFile(str(tmp_path / 'fleet.zip')) as archive:
+        assert archive.namelist() == [ name for name, _ in CONFIGS ]
+        assert archive.read('r3.cfg').decode() == CONFIGS[3][1]
+
+
+def test_failed_run_leaves_no_archive(tmp_path):
+    path = tmp_path / 'fleet.tar'
+    with pytest.raises(RuntimeError):
+        with cfgarchive.ConfigArchive(str(path)) as archive:
+            archive.add('r1.cfg', 'hostname r1\n')
+            raise RuntimeError("render failed")
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        cfgarchive.ConfigArchive(str(tmp_path / 'fleet.rar'))
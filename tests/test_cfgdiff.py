@@ -0,0 +1,95 @@
+import cfgdiff
+
+RUNNING = """!
+interface Loopback777
+ ip address 10.0.0.1 255.255.255.255
+ip access-list extended EDGE
+ deny ip any any
+ permit tcp any any eq 22
+ip prefix-list PL seq 5 permit 10.0.0.0/8
+router bgp 65000
+ address-family ipv4
+  neighbor 2.2.2.2 activate
+ exit-address-family
+end
+"""
+
+
+def test_applied_configuration_sends_nothing():
+    assert cfgdiff.config_delta(RUNNING, RUNNING) == ''
+
+
+def test_missing_section_is_sent_whole():
+    intent = "interface Loopback1\n ip address 10.0.0.2 255.255.255.255\n"
+    assert cfgdiff.config_delta(intent, RUNNING) == (
+        "interface Loopback1\n"
+        " ip address 10.0.0.2 255.255.255.255\n"
+        " exit\n"
+        "end\n")
+
+
+def test_only_missing_lines_are_sent():
+    intent = "interface Loopback777\n ip address 10.0.0.1 255.255.255.255\n description lab\n"
+    assert cfgdiff.config_delta(intent, RUNNING) == "interface Loopback777\n description lab\n exit\nend\n"
+
+
+def test_interface_name_and_spaces_are_normalized():
+    intent = "conf t\ninterface Loopback 777\n ip  address 10.0.0.1   255.255.255.255\nend\n"
+    assert cfgdiff.config_delta(intent, RUNNING) == ''
+
+
+def test_reordered_access_list_is_replaced_whole():
+    intent = "ip access-list extended EDGE\n permit tcp any any eq 22\n deny ip any any\n"
+    assert cfgdiff.config_delta(intent, RUNNING) == (
+        "no ip access-list extended EDGE\n"
+        "ip access-list extended EDGE\n"
+        " permit tcp any any eq 22\n"
+        " deny ip any any\n"
+        " exit\n"
+        "end\n")
+
+
+def test_same_access_list_is_not_sent():
+    intent = "ip access-list extended EDGE\n deny ip any any\n permit tcp any any eq 22\n"
+    assert cfgdiff.config_delta(intent, RUNNING) == ''
+
+
+def test_new_access_list_is_not_removed_first():
+    intent = "route-map RM permit 10\n match ip address EDGE\n"
+    assert cfgdiff.config_delta(intent, RUNNING).splitlines()[0] == "route-map RM permit 10"
+
+
+def test_prefix_list_is_replaced_as_a_group():
+    intent = ("ip prefix-list PL seq 5 permit 10.0.0.0/8\n"
+              "ip prefix-list PL seq 10 permit 192.168.0.0/16\n")
+    assert cfgdiff.config_delta(intent, RUNNING) == (
+        "no ip prefix-list PL\n"
+        "ip prefix-list PL seq 5 permit 10.0.0.0/8\n"
+        "ip prefix-list PL seq 10 permit 192.168.0.0/16\n"
+        "end\n")
+
+
+def test_sub_mode_lines_keep_their_parents():
+    intent = "router bgp 65000\n address-family ipv4\n  neighbor 1.1.1.1 activate\n exit-address-family\n"
+    assert cfgdiff.config_delta(intent, RUNNING) == (
+        "router bgp 65000\n"
+        " address-family ipv4\n"
+        "  neighbor 1.1.1.1 activate\n"
+        "  exit\n"
+        " exit\n"
+        "end\n")
+
+
+def test_negate_removes_the_lines_not_in_the_intent():
+    intent = "router bgp 65000\n address-family ipv4\n  neighbor 1.1.1.1 activate\n"
+    delta = cfgdiff.diff_sections(cfgdiff.parse_sections(intent), cfgdiff.parse_sections(RUNNING), negate=True)
+    assert delta == { "router bgp 65000": [ ("address-family ipv4", "neighbor 1.1.1.1 activate"),
+                                            ("address-family ipv4", "no neighbor 2.2.2.2 activate") ] }
+
+
+def test_parse_sections_skips_the_cli_lines():
+    sections = cfgdiff.parse_sections(RUNNING)
+    assert list(sections) == [ "interface Loopback777", "ip access-list extended EDGE",
+                               "ip prefix-list PL seq 5 permit 10.0.0.0/8", "router bgp 65000" ]
+    assert sections["router bgp 65000"] == [ ("address-family ipv4",),
+                                             ("address-family ipv4", "neighbor 2.2.2.2 activate") ]
@@ -0,0 +1,206 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+import cfgflow
+import CiscoCfg
+import EkinopsCfg
+
+CONFIG = "interface Loopback7\n ip address 10.0.0.7 255.255.255.255\n"
+
+
+class Recorder:
+    """ steps of a flow done by hand: each step is recorded, the device answers are canned """
+
+    def __init__(self, staged=None, running=''):
+        self.steps = []
+        self.staged = dict(staged or {})
+        self.running = running
+        self.sent = {}
+
+    def call(self, function, *args):
+        self.steps.append(('call', function.__name__))
+        return function(*args)
+
+    def open_session(self, dest, username):
+        self.steps.append(('open_session',))
+        return '/tmp/cfgflow-test/master'
+
+    def close_session(self, dest, control_path, username):
+        self.steps.append(('close_session',))
+
+    def fetch_output(self, username, dest, cmd, ssh_options):
+        self.steps.append(('fetch_output', cmd))
+        return self.running
+
+    def list_staged(self, username, dest, ssh_options):
+        self.steps.append(('list_staged',))
+        return dict(self.staged)
+
+    def scp_file(self, filename, username, dest, path, ssh_options, pass_fds):
+        with open(filename) as f:
+            self.sent[path] = f.read()
+        self.steps.append(('scp_file', path, ssh_options))
+
+    def copy_running_config(self, filename, username, dest, ssh_options, pass_fds):
+        self.scp_file(filename, username, dest, 'running-config', ssh_options, pass_fds)
+
+    def scp_files(self, filenames, username, dest, path, ssh_options):
+        self.steps.append(('scp_files', sorted(os.path.basename(name) for name in filenames)))
+
+    def load_file_delayed(self, filename, dest, username, wait, ssh_options, stale, activate_at):
+        self.steps.append(('load_file_delayed', filename, wait, sorted(stale)))
+
+    def exec_file(self, username, dest, filename, ssh_options, stale):
+        self.steps.append(('exec_file', filename, ssh_options, sorted(stale)))
+
+    def exec_batch(self, username, dest, filenames, tmpl_names, ssh_options, stale):
+        self.steps.append(('exec_batch', filenames, ssh_options, sorted(stale)))
+
+    def sleep(self, seconds):
+        self.steps.append(('sleep', seconds))
+
+    def defer(self, at, flow):
+        self.steps.append(('defer',))
+        return cfgflow.run(flow, self)
+
+
+class AsyncRecorder:
+    """ the Recorder steps as coroutines, for run_async """
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        step = getattr(self.recorder, name)
+        async def coroutine(*args):
+            if name == 'defer':
+                self.recorder.steps.append(('defer',))
+                return await cfgflow.run_async(args[1], self)
+            return step(*args)
+        return coroutine
+
+
+@pytest.fixture
+def template(tmp_path):
+    path = tmp_path / 'lo.txt'
+    path.write_text("interface Loopback$n\n ip address 10.0.0.$n 255.255.255.255\n")
+    return str(path)
+
+
+def staged_name(driver, config=CONFIG):
+    return driver.STAGED_FILE.format(id=hashlib.md5(config.encode()).hexdigest())
+
+
+def test_cisco_straight_to_running_config(template):
+    steps = Recorder()
+    assert cfgflow.run(cfgflow.config_flow(CiscoCfg, 'r1', template, data={'n': 7}), steps) is True
+    assert steps.steps == [ ('call', 'resolve_template'), ('call', 'enter_context'),
+                            ('scp_file', 'running-config', CiscoCfg.SSH_OPTIONS) ]
+    assert steps.sent == { 'running-config': CONFIG }
+
+
+def test_cisco_delayed_is_staged_then_loaded_by_eem(template):
+    stale = CiscoCfg.STAGED_FILE.format(id='0' * 32)
+    steps = Recorder(staged={ stale: 10 })
+    cfgflow.run(cfgflow.config_flow(CiscoCfg, 'r1', template, data={'n': 7}, delay=30), steps)
+    name = staged_name(CiscoCfg)
+    assert steps.steps[2:] == [ ('call', 'file_digest'), ('list_staged',),
+                                ('scp_file', 'bootflash:/' + name, CiscoCfg.SSH_OPTIONS),
+                                ('load_file_delayed', name, 30, [ stale ]) ]
+
+
+def test_file_already_staged_is_not_sent(template):
+    steps = Recorder(staged={ staged_name(CiscoCfg): len(CONFIG) })
+    cfgflow.run(cfgflow.config_flow(CiscoCfg, 'r1', template, data={'n': 7}, delay=30), steps)
+    assert [ step[0] for step in steps.steps ] == [ 'call', 'call', 'call', 'list_staged', 'load_file_delayed' ]
+
+
+def test_multiplex_session_wraps_the_transfers(template):
+    steps = Recorder()
+    cfgflow.run(cfgflow.config_flow(CiscoCfg, 'r1', template, data={'n': 7}, multiplex=True), steps)
+    assert steps.steps[1] == ('open_session',)
+    assert 'ControlPath=/tmp/cfgflow-test/master' in steps.steps[3][2]
+    assert steps.steps[-1] == ('close_session',)
+
+
+def test_session_closed_when_a_step_fails(template):
+    class Failing(Recorder):
+        def scp_file(self, *args):
+            raise OSError("Error during file transfer: Connection reset by peer")
+    steps = Failing()
+    with pytest.raises(OSError):
+        cfgflow.run(cfgflow.config_flow(CiscoCfg, 'r1', template, data={'n': 7}, multiplex=True), steps)
+    assert steps.steps[-1] == ('close_session',)
+
+
+def test_incremental_sends_the_delta(template):
+    steps = Recorder(running="interface Loopback7\n description lab\n")
+    cfgflow.run(cfgflow.config_flow(CiscoCfg, 'r1', template, data={'n': 7}, incremental=True), steps)
+    assert steps.steps[1] == ('fetch_output', CiscoCfg.SHOW_RUNNING)
+    assert steps.sent['running-config'] == "interface Loopback7\n ip address 10.0.0.7 255.255.255.255\n exit\nend\n"
+
+
+def test_incremental_with_nothing_to_send(template):
+    steps = Recorder(running=CONFIG)
+    assert cfgflow.run(cfgflow.config_flow(CiscoCfg, 'r1', template, data={'n': 7}, incremental=True),
+                       steps) is False
+    assert [ step[0] for step in steps.steps ] == [ 'call', 'fetch_output' ]
+
+
+def test_incremental_is_cisco_only(template):
+    with pytest.raises(ValueError):
+        cfgflow.run(cfgflow.config_flow(EkinopsCfg, 'e1', template, data={'n': 7}, incremental=True), Recorder())
+
+
+def test_ekinops_stage_wait_exec(template):
+    stale = EkinopsCfg.STAGED_FILE.format(id='0' * 32)
+    steps = Recorder(staged={ stale: 10 })
+    cfgflow.run(cfgflow.config_flow(EkinopsCfg, 'e1', template, data={'n': 7}, delay=5), steps)
+    name = staged_name(EkinopsCfg)
+    assert steps.steps[2:] == [ ('call', 'file_digest'), ('list_staged',),
+                                ('scp_file', '/BSA/scripts/' + name, EkinopsCfg.SSH_OPTIONS),
+                                ('sleep', 5), ('exec_file', name, EkinopsCfg.SSH_OPTIONS, [ stale ]) ]
+
+
+def test_ekinops_deferred_exec_on_its_own_session(template):
+    steps = Recorder()
+    assert cfgflow.run(cfgflow.config_flow(EkinopsCfg, 'e1', template, data={'n': 7}, delay=5, multiplex=True,
+                                           deferred=True), steps) is True
+    assert [ step[0] for step in steps.steps ] == [ 'call', 'open_session', 'call', 'call', 'list_staged',
+                                                     'scp_file', 'defer', 'exec_file', 'close_session' ]
+    assert steps.steps[7][2] is None        # not through the master connection
+
+
+def test_ekinops_batch_sends_the_missing_scripts(tmp_path):
+    names = []
+    for step in (1, 2):
+        path = tmp_path / 'step{n}.txt'.format(n=step)
+        path.write_text("echo step{n}\n".format(n=step))
+        names.append(str(path))
+    first = staged_name(EkinopsCfg, "echo step1\n")
+    second = staged_name(EkinopsCfg, "echo step2\n")
+    steps = Recorder(staged={ first: len("echo step1\n") })
+    cfgflow.run(cfgflow.config_flow(EkinopsCfg, 'e1', names, data={}), steps)
+    assert steps.steps == [ ('call', 'render_scripts'), ('list_staged',), ('scp_files', [ second ]),
+                            ('sleep', 0), ('exec_batch', [ first, second ], EkinopsCfg.SSH_OPTIONS, []) ]
+
+
+def test_dryrun_sends_nothing(template, capsys):
+    steps = Recorder()
+    cfgflow.run(cfgflow.config_flow(CiscoCfg, 'r1', template, data={'n': 7}, dryrun=True), steps)
+    assert steps.steps == [ ('call', 'resolve_template') ]
+    assert capsys.readouterr().out == CONFIG + "\n"
+
+
+@pytest.mark.parametrize('driver, kwargs', [ (CiscoCfg, { 'delay': 30, 'multiplex': True }),
+                                             (CiscoCfg, { 'incremental': True }),
+                                             (EkinopsCfg, { 'delay': 5, 'deferred': True }) ])
+def test_async_runs_the_same_steps(template, driver, kwargs):
+    sync, coroutines = Recorder(), Recorder()
+    cfgflow.run(cfgflow.config_flow(driver, 'r1', template, data={'n': 7}, **kwargs), sync)
+    asyncio.run(cfgflow.run_async(cfgflow.config_flow(driver, 'r1', template, data={'n': 7}, **kwargs),
+                                  AsyncRecorder(coroutines)))
+    assert coroutines.steps == sync.steps
@@ -0,0 +1,56 @@
+import json
+import os
+
+import cfgjournal
+
+
+def test_states_of_a_run(tmp_path):
+    path = str(tmp_path / 'run.journal')
+    with cfgjournal.Journal(path) as journal:
+        journal({ 'device': 'r1', 'phase': 'render', 'rc': 0 })
+        journal({ 'device': 'r1', 'phase': 'upload', 'rc': 0 })
+        journal({ 'device': 'r2', 'phase': 'upload', 'rc': 255 })      # failed phases are not a state
+        journal({ 'device': 'r2', 'phase': 'fetch', 'rc': 0 })         # nor the other phases
+        journal.result({ 'host': 'r1', 'status': 'ok', 'stderr': '' })
+        journal.result({ 'host': 'r2', 'status': 'failed', 'stderr': 'Connection refused' })
+    assert cfgjournal.read_journal(path) == { 'r1': 'applied', 'r2': 'failed' }
+    with open(path) as f:
+        records = [ json.loads(line) for line in f ]
+    assert [ record['state'] for record in records ] == [ 'rendered', 'staged', 'applied', 'failed' ]
+    assert records[-1]['error'] == 'Connection refused'
+
+
+def test_group_commit(tmp_path, monkeypatch):
+    syncs = []
+    fsync = os.fsync
+    def counting_fsync(fd):
+        syncs.append(fd)
+        fsync(fd)
+    monkeypatch.setattr(os, 'fsync', counting_fsync)
+    path = str(tmp_path / 'run.journal')
+    with cfgjournal.Journal(path, sync_interval=0.5) as journal:
+        for n in range(10000):
+            journal.record('r{n}'.format(n=n), 'staged')
+    assert len(cfgjournal.read_journal(path)) == 10000
+    assert 1 <= len(syncs) <= 5
+
+
+def test_resume_after_a_crash(tmp_path, capsys):
+    path = str(tmp_path / 'run.journal')
+    with cfgjournal.Journal(path) as journal:
+        for host, status in (('r1', 'ok'), ('r2', 'failed'), ('r3', 'skipped'), ('r4', 'timeout')):
+            journal.result({ 'host': host, 'status': status, 'stderr': '' })
+        journal.record('r5', 'staged')
+    with open(path, 'a') as f:
+        f.write('{"ts": 1, "device": "r6", "sta')          # cut by the crash
+    devices = [ { 'host': 'r{n}'.format(n=n) } for n in range(1, 8) ]
+    assert [ device['host'] for device in cfgjournal.unfinished(devices, path) ] == [ 'r2', 'r4', 'r5', 'r6', 'r7' ]
+    assert "2 devices already done" in capsys.readouterr().out
+    # the next run appends its records on a line of their own
+    with cfgjournal.Journal(path) as journal:
+        journal.result({ 'host': 'r6', 'status': 'ok', 'stderr': '' })
+    assert cfgjournal.read_journal(path)['r6'] == 'applied'
+
+
+def test_missing_journal_is_empty(tmp_path):
+    assert cfgjournal.read_journal(str(tmp_path / 'none.journal')) == {}
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import subprocess
+import time
+
+import pytest
+
+import deadlines
+
+# a session which outlives its deadline: its background child keeps the output open
+STALLED_SESSION = 'sleep 30 & echo $! > {pidfile}; wait'
+
+
+@pytest.fixture(autouse=True)
+def timeouts(monkeypatch):
+    monkeypatch.setattr(deadlines, 'CONNECT_TIMEOUT', 0.2)
+    monkeypatch.setattr(deadlines, 'TRANSFER_TIMEOUT', 0.3)
+    monkeypatch.setattr(deadlines, 'EXEC_TIMEOUT', 0.3)
+    monkeypatch.setattr(deadlines, 'DEVICE_BUDGET', None)
+
+
+def alive(pid):
+    """ True if pid still runs 1s later, a zombie waiting for its parent does not:
+        the SIGKILL of its group may not be delivered yet when the session ends """
+    for _ in range(100):
+        try:
+            with open('/proc/{pid}/stat'.format(pid=pid)) as f:
+                if f.read().split(')')[-1].split()[0] == 'Z':
+                    return False
+        except FileNotFoundError:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def stalled_session(tmp_path):
+    pidfile = str(tmp_path / 'child.pid')
+    p = subprocess.Popen([ 'sh', '-c', STALLED_SESSION.format(pidfile=pidfile) ], stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, start_new_session=True)      # as under setsid
+    return p, pidfile
+
+
+def child_pid(pidfile):
+    for _ in range(100):
+        if os.path.exists(pidfile) and open(pidfile).read().strip():
+            return int(open(pidfile).read())
+        time.sleep(0.01)
+    raise AssertionError("the session did not start its child")
+
+
+def test_session_timeouts():
+    assert deadlines.session_timeout('connect') == (0.2, False)
+    assert deadlines.session_timeout('transfer') == (pytest.approx(0.5), False)
+    deadlines.configure(connect=0, exec_=0)
+    assert deadlines.session_timeout('exec') == (None, False)
+    assert deadlines.command([ 'setsid', '-w', 'ssh', 'r1', 'dir' ]) == [ 'setsid', '-w', 'ssh', 'r1', 'dir' ]
+
+
+def test_connect_timeout_option():
+    deadlines.configure(connect=2.5)
+    assert deadlines.command([ 'setsid', '-w', 'scp', 'a', 'r1:b' ]) == [
+        'setsid', '-w', 'scp', '-o', 'ConnectTimeout=3', 'a', 'r1:b' ]
+
+
+def test_budget_shared_by_the_sessions():
+    with deadlines.device_budget(0.4):
+        timeout, by_budget = deadlines.session_timeout('exec')
+        assert by_budget and timeout <= 0.4
+        deadlines.postpone(10)          # the activation wait is not counted
+        assert deadlines.remaining() > 10
+    assert deadlines.remaining() is None
+
+
+def test_spent_budget_starts_no_session():
+    with deadlines.device_budget(0.01):
+        time.sleep(0.02)
+        with pytest.raises(deadlines.BudgetExceeded) as error:
+            deadlines.command([ 'setsid', 'ssh', 'r1', 'dir' ], 'r1')
+    assert error.value.returncode == deadlines.TIMEOUT_RETURNCODE
+
+
+def test_communicate_kills_the_process_group(tmp_path):
+    p, pidfile = stalled_session(tmp_path)
+    start = time.monotonic()
+    with pytest.raises(deadlines.SessionTimeout) as error:
+        deadlines.communicate(p, None, 'exec', 'r1')
+    assert time.monotonic() - start < 5
+    assert not isinstance(error.value, deadlines.BudgetExceeded)
+    assert error.value.returncode == deadlines.TIMEOUT_RETURNCODE
+    assert not alive(child_pid(pidfile))
+
+
+def test_budget_kills_the_session(tmp_path):
+    deadlines.configure(exec_=0)
+    p, pidfile = stalled_session(tmp_path)
+    with deadlines.device_budget(0.3), pytest.raises(deadlines.BudgetExceeded):
+        deadlines.communicate(p, None, 'exec', 'r1')
+    assert not alive(child_pid(pidfile))
+
+
+def test_watchdog_of_an_interactive_session(tmp_path):
+    p, pidfile = stalled_session(tmp_path)
+    with pytest.raises(deadlines.SessionTimeout):
+        with deadlines.watchdog(p, 'exec', 'r1'):
+            p.stdout.read()             # ends when the process group is killed
+    p.wait()
+    assert not alive(child_pid(pidfile))
+
+
+def test_session_within_its_deadline(tmp_path):
+    p = subprocess.Popen([ 'echo', 'done' ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    assert deadlines.communicate(p, None, 'exec', 'r1')[0] == b'done\n'
+
+
+def test_communicate_async_kills_the_process_group(tmp_path):
+    pidfile = str(tmp_path / 'child.pid')
+    async def session():
+        p = await asyncio.create_subprocess_exec('sh', '-c', STALLED_SESSION.format(pidfile=pidfile),
+                                                 stdout=asyncio.subprocess.PIPE, start_new_session=True)
+        await deadlines.communicate_async(p, None, 'exec', 'r1')
+    with pytest.raises(deadlines.SessionTimeout):
+        asyncio.run(session())
+    assert not alive(child_pid(pidfile))
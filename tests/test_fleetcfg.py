@@ -0,0 +1,41 @@
+import pytest
+
+import FleetCfg
+
+
+@pytest.fixture
+def templates(tmp_path):
+    loopback = tmp_path / 'lo.j0'
+    loopback.write_text("interface Loopback$n\n")
+    hostname = tmp_path / 'hostname.j0'
+    hostname.write_text("hostname $name\n")
+    return str(loopback), str(hostname)
+
+
+def render(tmpl_name, devices):
+    return dict(FleetCfg.render_batch(tmpl_name, devices, processes=1, chunk_size=2))
+
+
+def test_templates_of_the_records_without_default(templates):
+    loopback, hostname = templates
+    outputs = render(None, [ { 'host': 'r1', 'template': loopback, 'data': { 'n': 1 } },
+                             { 'host': 'r2', 'template': hostname, 'data': { 'name': 'r2' } },
+                             { 'host': 'r3', 'template': loopback, 'data': { 'n': 3 } } ])
+    assert outputs == { 'r1': "interface Loopback1\n", 'r2': "hostname r2\n", 'r3': "interface Loopback3\n" }
+
+
+def test_default_template_and_list_of_templates(templates):
+    loopback, hostname = templates
+    outputs = render(loopback, [ { 'host': 'r1', 'data': { 'n': 1 } },
+                                 { 'host': 'e1', 'template': [ loopback, hostname ], 'data': { 'n': 2, 'name': 'e1' } } ])
+    assert outputs == { 'r1': "interface Loopback1\n", 'e1': "interface Loopback2\nhostname e1\n" }
+
+
+def test_device_without_template_fails_alone(templates, tmp_path):
+    loopback, _ = templates
+    outputs = render(None, [ { 'host': 'r1', 'data': { 'n': 1 } },
+                             { 'host': 'r2', 'template': str(tmp_path / 'missing.j0') },
+                             { 'host': 'r3', 'template': loopback, 'data': { 'n': 3 } } ])
+    assert isinstance(outputs['r1'], ValueError)
+    assert isinstance(outputs['r2'], FileNotFoundError)
+    assert outputs['r3'] == "interface Loopback3\n"
@@ -0,0 +1,72 @@
+import io
+
+import pytest
+
+import jsonstream
+
+RECORDS = [ { "host": "r{n}".format(n=n), "data": { "loop_nb": n } } for n in range(5) ]
+
+
+def test_json_array():
+    stream = io.StringIO('[ {"host": "r0", "data": {"loop_nb": 0}},\n  {"host": "r1", "data": {"loop_nb": 1}} ]')
+    assert list(jsonstream.iter_records(stream)) == RECORDS[:2]
+
+
+def test_json_lines():
+    stream = io.StringIO('{"host": "r0", "data": {"loop_nb": 0}}\n\n{"host": "r1", "data": {"loop_nb": 1}}\n')
+    assert list(jsonstream.iter_records(stream)) == RECORDS[:2]
+
+
+@pytest.mark.parametrize('text', [ '[{"host": "r0", "data": {"loop_nb": 0}}, {"host": "r1", "data": {"loop_nb": 1}}, '
+                                   '{"host": "r2", "data": {"loop_nb": 2}}, {"host": "r3", "data": {"loop_nb": 3}}, '
+                                   '{"host": "r4", "data": {"loop_nb": 4}}]',
+                                   '{"host": "r0", "data": {"loop_nb": 0}}\n{"host": "r1", "data": {"loop_nb": 1}}\n'
+                                   '{"host": "r2", "data": {"loop_nb": 2}}\n{"host": "r3", "data": {"loop_nb": 3}}\n'
+                                   '{"host": "r4", "data": {"loop_nb": 4}}\n' ])
+def test_records_split_across_chunks(text):
+    for chunk_size in (1, 3, 7, 64):
+        assert list(jsonstream.iter_records(io.StringIO(text), chunk_size)) == RECORDS
+
+
+def test_record_larger_than_the_chunk():
+    record = { "host": "big", "data": { "lines": [ "x" * 100 ] * 100 } }
+    stream = io.StringIO('[{"host": "big", "data": {"lines": [' + ', '.join([ '"' + "x" * 100 + '"' ] * 100) + ']}}]')
+    assert list(jsonstream.iter_records(stream, 16)) == [ record ]
+
+
+def test_empty_inputs():
+    assert list(jsonstream.iter_records(io.StringIO(''))) == []
+    assert list(jsonstream.iter_records(io.StringIO(' [ ] '))) == []
+
+
+def test_not_an_object():
+    with pytest.raises(ValueError):
+        list(jsonstream.iter_records(io.StringIO('[1, 2]')))
+
+
+def test_unterminated_array():
+    with pytest.raises(ValueError):
+        list(jsonstream.iter_records(io.StringIO('[{"host": "r0"}, ')))
+
+
+def test_invalid_json():
+    with pytest.raises(ValueError):
+        list(jsonstream.iter_records(io.StringIO('{"host": "r0"}\n{"host": }\n')))
+
+
+def test_is_record_file(tmp_path):
+    (tmp_path / 'list.json').write_text('\n  [{"host": "r0"}]')
+    (tmp_path / 'object.json').write_text('{"loop_nb": 1}')
+    (tmp_path / 'lines.jsonl').write_text('{"host": "r0"}\n')
+    assert jsonstream.is_record_file(str(tmp_path / 'list.json'))
+    assert not jsonstream.is_record_file(str(tmp_path / 'object.json'))
+    assert jsonstream.is_record_file(str(tmp_path / 'lines.jsonl'))
+    assert jsonstream.is_record_file('-')
+
+
+def test_read_records_from_file_and_stdin(tmp_path, monkeypatch):
+    path = tmp_path / 'inventory.ndjson'
+    path.write_text('{"host": "r0", "data": {"loop_nb": 0}}\n{"host": "r1", "data": {"loop_nb": 1}}\n')
+    assert list(jsonstream.read_records(str(path))) == RECORDS[:2]
+    monkeypatch.setattr('sys.stdin', io.StringIO(path.read_text()))
+    assert list(jsonstream.read_records('-')) == RECORDS[:2]
@@ -0,0 +1,107 @@
+import asyncio
+import os
+
+import pytest
+
+import aiotransport
+import CiscoCfg
+import deadlines
+import retrypolicy
+
+
+@pytest.mark.parametrize('message, kind', [
+    ("ssh: connect to host r1 port 22: Connection refused", 'refused'),
+    ("ssh: connect to host r1 port 22: Connection timed out", 'timeout'),
+    ("Connection timed out during banner exchange", 'timeout'),
+    ("Connection reset by peer", 'reset'),
+    ("Connection closed by remote host", 'reset'),
+    ("kex_exchange_identification: read: Connection reset by peer", 'reset'),
+    ("% Authorization failed.", 'aaa'),
+    ("Permission denied, please try again.", 'auth'),
+    ("ssh: Could not resolve hostname r1: Name or service not known", 'dns'),
+    ("Invalid input detected", 'other'),
+])
+def test_classify(message, kind):
+    assert retrypolicy.classify(OSError(message)) == kind
+
+
+def test_permanent_errors_win():
+    # a wrong password is not retried even if the session was then closed
+    error = OSError("Permission denied (publickey,password).\r\nConnection closed by 10.0.0.1 port 22")
+    assert retrypolicy.classify(error) == 'auth'
+    assert not retrypolicy.is_transient(retrypolicy.classify(error))
+
+
+def test_budget_is_not_retried():
+    kind = retrypolicy.classify(deadlines.budget_error('r1'))
+    assert kind == 'budget'
+    assert not retrypolicy.is_transient(kind)
+
+
+def test_open_circuit():
+    breaker = retrypolicy.CircuitBreaker(threshold=1, cooldown=60)
+    breaker.failure('r1')
+    with pytest.raises(retrypolicy.CircuitOpenError) as error:
+        breaker.check('r1')
+    assert retrypolicy.classify(error.value) == 'circuit'
+    assert not retrypolicy.before_login(error.value)
+
+
+@pytest.mark.parametrize('kind', [ 'refused', 'timeout', 'reset', 'aaa' ])
+def test_transient(kind):
+    assert retrypolicy.is_transient(kind)
+
+
+@pytest.mark.parametrize('message, expected', [
+    ("ssh: connect to host r1 port 22: Connection refused", True),
+    ("ssh: connect to host r1 port 22: Connection timed out", True),
+    ("Connection timed out during banner exchange", True),
+    ("ssh: connect to host r1 port 22: No route to host", True),
+    ("exec session to r1 timed out after 630s, killed", False),
+    ("Connection reset by peer", False),
+    ("% Authorization failed.", False),
+])
+def test_before_login(message, expected):
+    assert retrypolicy.before_login(OSError(message)) is expected
+
+
+@pytest.fixture
+def simdevice(tmp_path, monkeypatch):
+    """ the sim/bin commands in front of the PATH, every scp is reset once logged in """
+    sim = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sim', 'bin')
+    monkeypatch.setenv('PATH', sim + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('SIM_ROOT', str(tmp_path))
+    monkeypatch.setenv('SIM_RESET_RATE', '1')
+    monkeypatch.setattr(retrypolicy, 'BACKOFF_BASE', 0.0)
+    monkeypatch.setattr(retrypolicy, 'BREAKER', retrypolicy.CircuitBreaker())
+    config = tmp_path / 'config.txt'
+    config.write_text("interface Loopback1\n ip address 10.0.0.1 255.255.255.255\n")
+    return tmp_path, str(config)
+
+
+def sessions(root, host):
+    with open(os.path.join(str(root), host, 'sessions.log')) as f:
+        return f.read().splitlines()
+
+
+def test_copy_to_running_config_reset_after_login_is_not_repeated(simdevice):
+    root, config = simdevice
+    with pytest.raises(OSError, match='reset'):
+        CiscoCfg.copy_running_config(config, '', 'r1')
+    assert sessions(root, 'r1') == [ 'scp running-config' ]
+    # the first half of the lines only was applied, it is not applied a second time
+    assert (root / 'r1' / 'running-config').read_text() == "interface Loopback1\n"
+
+
+def test_async_copy_to_running_config_reset_after_login_is_not_repeated(simdevice):
+    root, config = simdevice
+    with pytest.raises(OSError, match='reset'):
+        asyncio.run(aiotransport.copy_running_config(config, '', 'r1'))
+    assert sessions(root, 'r1') == [ 'scp running-config' ]
+
+
+def test_upload_to_bootflash_reset_after_login_is_retried(simdevice):
+    root, config = simdevice
+    with pytest.raises(OSError, match='reset'):
+        CiscoCfg.scp_file(config, '', 'r1', 'bootflash:/CiscoCfg.cfg')
+    assert sessions(root, 'r1') == [ 'scp bootflash:/CiscoCfg.cfg' ] * (retrypolicy.RETRIES + 1)
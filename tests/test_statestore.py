@@ -0,0 +1,78 @@
+import pytest
+
+import cfgflow
+import CiscoCfg
+import statestore
+
+
+class Device:
+    """ steps of a flow pushing straight to the running-config: the copies are counted """
+
+    def __init__(self, fail=False):
+        self.copies = 0
+        self.fail = fail
+        self.calls = []
+
+    def call(self, function, *args):
+        self.calls.append(function.__name__)
+        return function(*args)
+
+    def copy_running_config(self, *args):
+        if self.fail:
+            raise OSError("Error during file transfer: Connection reset by peer")
+        self.copies += 1
+
+
+@pytest.fixture
+def template(tmp_path):
+    path = tmp_path / 'lo.txt'
+    path.write_text("interface Loopback$n\n")
+    return str(path)
+
+
+def push(template, state_db, n=7, force=False, device=None):
+    device = device or Device()
+    result = cfgflow.run(cfgflow.config_flow(CiscoCfg, 'r1', template, data={'n': n}, state_db=state_db,
+                                             force=force), device)
+    return result, device.copies
+
+
+def test_record_and_lookup(tmp_path, template):
+    state_db = str(tmp_path / 'state' / 'pushes.db')
+    digest = statestore.config_hash("interface Loopback7\n")
+    assert digest == statestore.config_hash(b"interface Loopback7\n")
+    assert statestore.already_pushed(state_db, 'r1', template, digest) is None
+    statestore.record_push(state_db, 'r1', template, digest)
+    assert statestore.already_pushed(state_db, 'r1', template, digest) is not None
+    assert statestore.already_pushed(state_db, 'r1', template, statestore.config_hash("other")) is None
+    assert statestore.already_pushed(state_db, 'r2', template, digest) is None
+
+
+def test_same_configuration_is_skipped(tmp_path, template):
+    state_db = str(tmp_path / 'pushes.db')
+    assert push(template, state_db) == (True, 1)
+    assert push(template, state_db) == (False, 0)
+    # a new configuration is sent, then skipped in turn
+    assert push(template, state_db, n=8) == (True, 1)
+    assert push(template, state_db, n=8) == (False, 0)
+
+
+def test_force_sends_again(tmp_path, template):
+    state_db = str(tmp_path / 'pushes.db')
+    push(template, state_db)
+    assert push(template, state_db, force=True) == (True, 1)
+
+
+def test_state_db_is_used_through_call_steps(tmp_path, template):
+    # the sqlite accesses are steps, run_async does them out of the event loop
+    state_db = str(tmp_path / 'pushes.db')
+    device = Device()
+    push(template, state_db, device=device)
+    assert device.calls == [ 'resolve_template', 'already_pushed', 'enter_context', 'record_push' ]
+
+
+def test_failed_push_is_not_recorded(tmp_path, template):
+    state_db = str(tmp_path / 'pushes.db')
+    with pytest.raises(OSError):
+        push(template, state_db, device=Device(fail=True))
+    assert push(template, state_db) == (True, 1)
@@ -0,0 +1,189 @@
+import os
+
+import pytest
+
+import tipyte
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    """ no on-disk cache, no memo and no pack left by another test """
+    monkeypatch.setattr(tipyte, 'TEMPLATE_CACHE_DIR', '')
+    monkeypatch.setattr(tipyte, 'TEMPLATE_MEMO', None)
+    monkeypatch.setattr(tipyte, 'TEMPLATE_PACK_ENTRIES', {})
+    for cache in (tipyte.compile_template, tipyte.resolve_include, tipyte.template_dependencies):
+        cache.cache_clear()
+    yield
+    for cache in (tipyte.compile_template, tipyte.resolve_include, tipyte.template_dependencies):
+        cache.cache_clear()
+
+
+def write(directory, name, text):
+    path = os.path.join(str(directory), name)
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+def render(path, **data):
+    return tipyte.template_to_function(path, escaper=tipyte.no_escape)(data)
+
+
+def test_memo_reuses_the_output_of_the_same_values(tmp_path):
+    path = write(tmp_path, 'ntp.j2', "ntp server {{ ntp }}\n")
+    memo = tipyte.enable_render_memo()
+    # host is not read by the template, it does not change the output
+    assert render(path, ntp='10.0.0.1', host='r1') == "ntp server 10.0.0.1\n"
+    assert render(path, ntp='10.0.0.1', host='r2') == "ntp server 10.0.0.1\n"
+    assert (memo.hits, memo.misses) == (1, 1)
+    assert render(path, ntp='10.0.0.2', host='r3') == "ntp server 10.0.0.2\n"
+    assert (memo.hits, memo.misses) == (1, 2)
+
+
+def test_memo_keeps_the_assignments(tmp_path):
+    path = write(tmp_path, 'mask.j2', "{% mask = '255.255.255.255' %}mask {{ mask }}\n")
+    tipyte.enable_render_memo()
+    for host in ('r1', 'r2'):
+        data = { 'host': host }
+        assert tipyte.template_to_function(path, escaper=tipyte.no_escape)(data) == "mask 255.255.255.255\n"
+        assert data['mask'] == '255.255.255.255'
+    assert tipyte.TEMPLATE_MEMO.hits == 1
+
+
+def test_memo_of_the_includes(tmp_path):
+    write(tmp_path, 'common.j2', "logging host {{ syslog }}\n")
+    path = write(tmp_path, 'device.j2', "hostname {{ host }}\n{% include('common.j2') %}")
+    memo = tipyte.enable_render_memo()
+    assert render(path, host='r1', syslog='10.0.0.9') == "hostname r1\nlogging host 10.0.0.9\n"
+    assert render(path, host='r2', syslog='10.0.0.9') == "hostname r2\nlogging host 10.0.0.9\n"
+    # device.j2 twice, the include once
+    assert (memo.hits, memo.misses) == (1, 3)
+
+
+def test_memo_bounds(tmp_path):
+    path = write(tmp_path, 'lo.j2', "interface Loopback{{ n }}\n")
+    memo = tipyte.RenderMemo(maxsize=2, max_output=1000)
+    function = tipyte.template_to_function(path, escaper=tipyte.no_escape)
+    for n in (1, 2, 3, 1):
+        function({ 'n': n }, _template_memo=memo)
+    assert len(memo.entries) == 2
+    assert memo.hits == 0
+    memo.clear()
+    assert (len(memo.entries), memo.misses) == (0, 0)
+
+
+def test_pack_replaces_the_template_files(tmp_path):
+    source = tmp_path / 'templates'
+    source.mkdir()
+    write(source, 'banner.txt', "Authorized access only\n")
+    write(source, 'lo.j2', "interface Loopback{{ n }}\n")
+    write(source, 'device.j2', "hostname {{ host }}\n{% include('lo.j2') %}{% raw_include('banner.txt') %}")
+    pack_path = str(tmp_path / 'templates.tpk')
+    pack = tipyte.build_template_pack(str(source), pack_path)
+    assert sorted(pack['templates']) == [ 'device.j2', 'lo.j2' ]
+    assert pack['includes']['device.j2'] == [ 'lo.j2', 'banner.txt' ]
+    # the templates are not read from the disk once the pack is loaded
+    target = tmp_path / 'elsewhere'
+    tipyte.load_template_pack(pack_path, str(target))
+    assert render(str(target / 'device.j2'), host='r1', n=7) == (
+        "hostname r1\ninterface Loopback7\nAuthorized access only\n")
+
+
+def test_pack_of_another_version(tmp_path):
+    write(tmp_path, 'lo.j2', "interface Loopback{{ n }}\n")
+    pack_path = str(tmp_path / 'templates.tpk')
+    tipyte.build_template_pack(str(tmp_path), pack_path)
+    with open(pack_path, 'r+b') as f:
+        f.write(b'\0' * 16)
+    with pytest.raises(ValueError):
+        tipyte.load_template_pack(pack_path)
+
+
+def test_disk_cache_reused_by_a_new_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(tipyte, 'TEMPLATE_CACHE_DIR', str(tmp_path / 'cache'))
+    path = write(tmp_path, 'lo.j2', "interface Loopback{{ n }}\n")
+    tipyte.compile_template(path)
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 1
+    # a new process: nothing in memory, the template is not transpiled again
+    tipyte.compile_template.cache_clear()
+    def transpile(path, template_source):
+        raise AssertionError("transpiled again")
+    monkeypatch.setattr(tipyte, 'transpile_template', transpile)
+    assert render(path, n=1) == "interface Loopback1\n"
+
+
+def test_disk_cache_invalidated_by_a_new_content(tmp_path, monkeypatch):
+    monkeypatch.setattr(tipyte, 'TEMPLATE_CACHE_DIR', str(tmp_path / 'cache'))
+    path = write(tmp_path, 'lo.j2', "interface Loopback{{ n }}\n")
+    tipyte.compile_template(path)
+    assert tipyte.load_cached_template(path) is not None
+    # same content with a new mtime: the hash shows the entry is still valid
+    os.utime(path, (0, 0))
+    assert tipyte.load_cached_template(path) is not None
+    write(tmp_path, 'lo.j2', "interface Loopback{{ n }}\n description lab\n")
+    assert tipyte.load_cached_template(path) is None
+    tipyte.compile_template.cache_clear()
+    assert render(path, n=1) == "interface Loopback1\n description lab\n"
+
+
+def test_disk_cache_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(tipyte, 'TEMPLATE_CACHE_DIR', str(tmp_path / 'cache'))
+    kept = write(tmp_path, 'kept.j2', "kept\n")
+    removed = write(tmp_path, 'removed.j2', "removed\n")
+    tipyte.compile_template(kept)
+    tipyte.compile_template(removed)
+    os.remove(removed)
+    tipyte.evict_cached_templates()
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 1
+    assert tipyte.load_cached_template(kept) is not None
+    tipyte.evict_cached_templates(max_age=-1)
+    assert os.listdir(str(tmp_path / 'cache')) == []
+
+
+def test_include_resolved_once(tmp_path):
+    write(tmp_path, 'lo.j2', "interface Loopback{{ n }}\n")
+    path = write(tmp_path, 'device.j2', "{% for n in loops %}{% include('lo.j2') %}{% endfor %}")
+    assert render(path, loops=[ 1, 2, 3 ]) == "interface Loopback1\ninterface Loopback2\ninterface Loopback3\n"
+    assert render(path, loops=[ 4 ]) == "interface Loopback4\n"
+    # one function for the include, reused by the loop and by the next render
+    assert tipyte.resolve_include.cache_info().misses == 1
+
+
+def test_include_escaper(tmp_path):
+    write(tmp_path, 'name.j2', "{{ name }}")
+    path = write(tmp_path, 'page.j2', "<b>{% include('name.j2') %}</b>")
+    assert tipyte.template_to_function(path)({ 'name': 'a&b' }) == "<b>a&amp;b</b>"
+    assert render(path, name='a&b') == "<b>a&b</b>"
+
+
+class Sink:
+    """ a text stream recording each write """
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, text):
+        self.writes.append(text)
+
+
+def test_streamed_output_is_written_by_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(tipyte, 'TEMPLATE_CHUNK_SIZE', 100)
+    write(tmp_path, 'lo.j2', "interface Loopback{{ n }}\n")
+    path = write(tmp_path, 'device.j2', "hostname {{ host }}\n{% for n in range(50) %}{% include('lo.j2') %}{% endfor %}")
+    function = tipyte.template_to_function(path, escaper=tipyte.no_escape)
+    expected = function({ 'host': 'r1' })
+    sink = Sink()
+    assert function({ 'host': 'r1' }, _template_sink=sink) == len(expected)
+    assert ''.join(sink.writes) == expected
+    assert len(sink.writes) > 1
+    assert max(len(chunk) for chunk in sink.writes) < 2 * 100
+
+
+def test_streamed_output_with_a_memo(tmp_path):
+    path = write(tmp_path, 'ntp.j2', "ntp server {{ ntp }}\n")
+    tipyte.enable_render_memo()
+    function = tipyte.template_to_function(path, escaper=tipyte.no_escape)
+    for _ in range(2):
+        sink = Sink()
+        assert function({ 'ntp': '10.0.0.1' }, _template_sink=sink) == len("ntp server 10.0.0.1\n")
+        assert sink.writes == [ "ntp server 10.0.0.1\n" ]
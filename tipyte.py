@@ -1,10 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import ast
+import builtins
 import collections
+import hashlib
+import marshal
 import os
 import re
+import symtable
 import sys
+import threading
+import time
 import traceback
+import types
+
+if sys.version_info >= (3, 4):
+    from importlib.util import MAGIC_NUMBER
+else:
+    import imp
+    MAGIC_NUMBER = imp.get_magic()
 
 if sys.version_info >= (3, 2):
     from functools import lru_cache
@@ -25,12 +39,28 @@ else:
         """
         return _html_escape(text, HTML_ESCAPE_TABLE)
 
+
+def no_escape(text):
+    """
+    Return text as is: the escaper of the templates which are not HTML (device
+    configurations). A single function, so the includes resolved with it are
+    shared by all the renders.
+    """
+    return text
+
 __all__ = [
     "OPEN_TAGS", "CLOSE_TAGS", "CAPTURE_BLOCKS", "CAPTURE_EXPRESSION",
     "CAPTURE_REGEX", "END_BLOCK_EXPRESSION_REGEX", "BLOCK_EXPRESSION_REGEX",
     "TEMPLATE_PATH_PREFIX", "WHITESPACE_BYTES", "SCRIPT_PATH",
+    "TEMPLATE_CACHE_DIR", "TEMPLATE_CACHE_MAX_AGE", "TEMPLATE_SPAN_MAPS",
+    "TEMPLATE_CHUNK_SIZE", "StreamOutput", "TEMPLATE_PACK_ENTRIES",
+    "INCLUDE_REGEX", "build_template_pack", "load_template_pack",
     "compile_template", "template_traceback", "template_to_function",
-    "html_escape"
+    "transpile_template", "load_cached_template", "store_cached_template",
+    "evict_cached_templates", "resolve_include", "html_escape",
+    "TEMPLATE_DEPENDENCIES", "TEMPLATE_MEMO", "TEMPLATE_MEMO_SIZE",
+    "TEMPLATE_MEMO_MAX_OUTPUT", "template_dependencies", "RenderMemo",
+    "enable_render_memo", "included_files", "no_escape"
 ]
 
 OPEN_TAGS = [
@@ -58,37 +88,495 @@ BLOCK_EXPRESSION_REGEX = re.compile(
     "(for|while|(el)?if|with)\s|(try|else|finally)\s*:?|except(\s*:|\s)"
 )
 
+INCLUDE_REGEX = re.compile(
+    br"""\b(raw_)?include\(\s*(['"])(.+?)\2\s*(,\s*raw\s*=\s*True)?"""
+)
 TEMPLATE_PATH_PREFIX = "/._/python-templates/"
 WHITESPACE_BYTES = frozenset(b" \t\n\r\x0b\x0c") | {32, 8, 9, 10, 11, 12, 13}
 
 SCRIPT_PATH = os.path.abspath(__file__)
 
+# Compiled templates are cached in this directory, set the TIPYTE_CACHE_DIR
+# environment variable to an empty string to disable the on-disk cache.
+TEMPLATE_CACHE_DIR = os.environ.get(
+    "TIPYTE_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "tipyte"),
+)
+TEMPLATE_CACHE_MAX_AGE = 30 * 24 * 3600
+
+# Number of characters buffered before they are written to the sink of a
+# streaming render (see StreamOutput).
+TEMPLATE_CHUNK_SIZE = 64 * 1024
+
+# Maps the lines of the transpiled templates to the lines of the templates
+# (see template_traceback), filled by template_to_function.
+TEMPLATE_SPAN_MAPS = dict()
+
+# Templates loaded from packs (see load_template_pack): absolute path of the
+# template -> code object, or contents of a file included raw.
+TEMPLATE_PACK_ENTRIES = dict()
+# Variables read, templates included and variables assigned by each template,
+# filled when the code object of a template runs (see template_dependencies).
+TEMPLATE_DEPENDENCIES = dict()
+# Memo of the rendered outputs used by every template function when it is not
+# None (see enable_render_memo), and its default bounds.
+TEMPLATE_MEMO = None
+TEMPLATE_MEMO_SIZE = 1024
+TEMPLATE_MEMO_MAX_OUTPUT = 1024 * 1024
+# Names which give a template access to variables it does not name.
+DYNAMIC_NAMES = frozenset(("globals", "locals", "vars", "eval", "exec"))
+# Functions a template uses without reading them from its variables.
+TEMPLATE_HELPERS = frozenset(("include", "raw_include", "defined"))
+# Value of the variables a template reads which are not defined.
+_MISSING = object()
+
+
+def _cache_entry_path(path):
+    """
+    Return the location of the on-disk cache entry of the template at `path`
+    or `None` when the on-disk cache is disabled.
+    """
+    if not TEMPLATE_CACHE_DIR:
+        return None
+    digest = hashlib.sha1(path.encode("utf-8")).hexdigest()
+    return os.path.join(TEMPLATE_CACHE_DIR, digest + ".tpyc")
+
+
+def _cache_header(path, stat, source_hash):
+    """
+    Build the header stored in front of a cached code object. The entry is
+    only valid for the same interpreter, transpiler, template path and
+    template contents.
+    """
+    script_stat = os.stat(SCRIPT_PATH)
+    return (
+        MAGIC_NUMBER, script_stat.st_mtime, script_stat.st_size, path,
+        stat.st_mtime, stat.st_size, source_hash,
+    )
+
+
+def load_cached_template(path):
+    """
+    Return the code object of the template at `path` from the on-disk cache,
+    or `None` if there is no valid entry. When the modification time or size
+    of the template changed, its contents are hashed, and the entry is only
+    reused if the hash did not change.
+    """
+    entry_path = _cache_entry_path(path)
+    if entry_path is None:
+        return None
+    try:
+        stat = os.stat(path)
+        with open(entry_path, "rb") as iostream:
+            header = marshal.load(iostream)
+            expected = _cache_header(path, stat, header[-1])
+            if header != expected:
+                # Only the timestamps or the size are stale: check the content.
+                with open(path, "rb") as template:
+                    source_hash = hashlib.sha256(template.read()).hexdigest()
+                if header[:4] != expected[:4] or header[-1] != source_hash:
+                    return None
+            code = marshal.load(iostream)
+    except (OSError, IOError, EOFError, ValueError, TypeError, IndexError):
+        return None
+    os.utime(entry_path, None)  # Entries used recently are not evicted.
+    return code
+
+
+def store_cached_template(path, template_source, code):
+    """
+    Write the code object of the template at `path` into the on-disk cache,
+    then evict the stale entries. Failures are silently ignored: the cache is
+    only an optimization.
+    """
+    entry_path = _cache_entry_path(path)
+    if entry_path is None:
+        return
+    source_hash = hashlib.sha256(template_source).hexdigest()
+    try:
+        if not os.path.isdir(TEMPLATE_CACHE_DIR):
+            os.makedirs(TEMPLATE_CACHE_DIR)
+        header = _cache_header(path, os.stat(path), source_hash)
+        temporary_path = "%s.%d.tmp" % (entry_path, os.getpid())
+        with open(temporary_path, "wb") as iostream:
+            marshal.dump(header, iostream)
+            marshal.dump(code, iostream)
+        os.rename(temporary_path, entry_path)
+    except (OSError, IOError, ValueError):
+        return
+    evict_cached_templates()
+
+
+def evict_cached_templates(max_age=None):
+    """
+    Remove the entries of the on-disk cache whose template no longer exists or
+    which have not been used for `max_age` seconds (defaults to
+    TEMPLATE_CACHE_MAX_AGE).
+    """
+    if not TEMPLATE_CACHE_DIR or not os.path.isdir(TEMPLATE_CACHE_DIR):
+        return
+    if max_age is None:
+        max_age = TEMPLATE_CACHE_MAX_AGE
+    now = time.time()
+    for name in os.listdir(TEMPLATE_CACHE_DIR):
+        entry_path = os.path.join(TEMPLATE_CACHE_DIR, name)
+        try:
+            if now - os.stat(entry_path).st_mtime > max_age:
+                os.remove(entry_path)
+                continue
+            with open(entry_path, "rb") as iostream:
+                template_path = marshal.load(iostream)[3]
+            if not os.path.exists(template_path):
+                os.remove(entry_path)
+        except (OSError, IOError, EOFError, ValueError, TypeError, IndexError):
+            continue
+
+
+def _pack_header():
+    """
+    Build the header stored in front of a template pack. The pack is only
+    valid for the same interpreter and transpiler.
+    """
+    with open(SCRIPT_PATH, "rb") as iostream:
+        script_hash = hashlib.sha256(iostream.read()).hexdigest()
+    return ("tipyte-pack", MAGIC_NUMBER, script_hash)
+
+
+def _relocate_code(code, filename):
+    """
+    Return `code`, and the code objects it defines, with `filename` as file
+    name.
+    """
+    constants = tuple(
+        _relocate_code(constant, filename)
+        if isinstance(constant, types.CodeType) else constant
+        for constant in code.co_consts
+    )
+    return code.replace(co_filename=filename, co_consts=constants)
+
+
+def build_template_pack(directory, pack_path, extensions=(".j2",)):
+    """
+    Transpile the templates of `directory` whose name ends with one of
+    `extensions`, and the templates they include, into the file `pack_path`.
+    The pack holds the code objects of the templates, the contents of the
+    files included raw and the include graph, all named by their path
+    relative to `directory`. Only includes of literal paths are followed,
+    the others are still read from the disk. Return the pack as a dictionary:
+
+    >>> build_template_pack("templates", "templates.tpk")["includes"]
+    {'base.html': ['menu.html'], 'menu.html': []}
+    """
+    directory = os.path.abspath(directory)
+    pending = sorted(
+        os.path.relpath(os.path.join(root, name), directory)
+        for root, _, names in os.walk(directory)
+        for name in names if name.endswith(tuple(extensions))
+    )
+    pack = {"templates": dict(), "raw": dict(), "includes": dict()}
+    while pending:
+        name = pending.pop()
+        if name in pack["templates"]:
+            continue
+        with open(os.path.join(directory, name), "rb") as iostream:
+            template_source = iostream.read()
+        pack["templates"][name] = transpile_template(name, template_source)
+        pack["includes"][name] = list()
+        for match in INCLUDE_REGEX.finditer(template_source):
+            included = os.path.normpath(os.path.join(
+                os.path.dirname(name), match.group(3).decode("utf-8")
+            ))
+            if not os.path.isfile(os.path.join(directory, included)):
+                continue
+            if match.group(1) or match.group(4):
+                with open(os.path.join(directory, included)) as iostream:
+                    pack["raw"][included] = iostream.read()
+            else:
+                pending.append(included)
+            if included not in pack["includes"][name]:
+                pack["includes"][name].append(included)
+
+    temporary_path = "%s.%d.tmp" % (pack_path, os.getpid())
+    with open(temporary_path, "wb") as iostream:
+        marshal.dump(_pack_header(), iostream)
+        marshal.dump(pack, iostream)
+    os.rename(temporary_path, pack_path)
+    return pack
+
+
+def load_template_pack(pack_path, directory=None):
+    """
+    Load the pack written by build_template_pack. Its templates are then used
+    by compile_template and by include instead of the files of `directory`
+    (defaults to the directory of the pack), which do not need to exist, so
+    nothing is transpiled at run time. Raise a ValueError if the pack was
+    built by another version of Python or of the transpiler, return the pack
+    as a dictionary.
+    """
+    if directory is None:
+        directory = os.path.dirname(pack_path)
+    directory = os.path.abspath(directory)
+    with open(pack_path, "rb") as iostream:
+        try:
+            valid = marshal.load(iostream) == _pack_header()
+            pack = marshal.load(iostream) if valid else None
+        except (EOFError, ValueError, TypeError):
+            valid = False
+    if not valid:
+        raise ValueError(
+            "%s was built by another version of Python or tipyte, build it "
+            "again." % (pack_path,)
+        )
+
+    for name, code in pack["templates"].items():
+        path = os.path.normpath(os.path.join(directory, name))
+        TEMPLATE_PACK_ENTRIES[path] = _relocate_code(
+            code, TEMPLATE_PATH_PREFIX + path
+        )
+    for name, contents in pack["raw"].items():
+        path = os.path.normpath(os.path.join(directory, name))
+        TEMPLATE_PACK_ENTRIES[path] = contents
+    # Templates compiled from the disk before the pack was loaded.
+    if hasattr(compile_template, "cache_clear"):
+        compile_template.cache_clear()
+        resolve_include.cache_clear()
+        template_dependencies.cache_clear()
+    return pack
+
 
 @lru_cache()
 def compile_template(path):
     """
     Convert template located at `path` to Python code object. On Python
     versions 3.2 and up, calls to this function are cached with
-    functools.lru_cache.
+    functools.lru_cache. Code objects are also kept in an on-disk cache
+    located in TEMPLATE_CACHE_DIR, so a new process does not need to
+    transpile templates that did not change. Templates of a loaded pack
+    (see load_template_pack) are neither read nor transpiled.
+    """
+    code = TEMPLATE_PACK_ENTRIES.get(path)
+    if isinstance(code, types.CodeType):
+        return code
+    code = load_cached_template(path)
+    if code is None:
+        with open(path, "rb") as iostream:
+            template_source = iostream.read()
+        code = transpile_template(path, template_source)
+        store_cached_template(path, template_source, code)
+    return code
+
+
+@lru_cache()
+def template_dependencies(path):
+    """
+    Return the variables read by the template at `path` and by the templates
+    it includes, as a sorted tuple of paths made of a variable name and the
+    literal subscripts applied to it, and the names of the variables they
+    assign, which are read as well when they are already defined. Return
+    `None` when the variables read cannot be known, for instance when a
+    template is included by a computed path:
+
+    >>> template_dependencies("router.j2")
+    ((('hostname',), ('intf',), ('qos', 'policy'), ('vlans',)), ('intf',))
+    """
+    paths, names = set(), set()
+    pending, seen = [os.path.abspath(path)], set()
+    while pending:
+        path = pending.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        # Running the code object registers the dependencies of the template
+        # it was compiled from.
+        exec(compile_template(path), {
+            "_template_span_map": TEMPLATE_SPAN_MAPS,
+            "_template_dependencies": TEMPLATE_DEPENDENCIES,
+            "_template_path": path,
+        })
+        read, includes, assigned = TEMPLATE_DEPENDENCIES[path]
+        if read is None:
+            return None
+        paths.update(read)
+        names.update(assigned)
+        directory = os.path.dirname(path)
+        pending.extend(
+            os.path.abspath(os.path.join(directory, included))
+            for included in includes
+        )
+    return _prune_paths(paths), tuple(sorted(names))
+
+
+def included_files(path):
+    """
+    Return the absolute paths of the template at `path` and of the files it
+    includes, directly or not, so a change of any of them can be noticed.
+    Only includes of literal paths are followed, as by build_template_pack:
+
+    >>> included_files("router.j2")
+    ['/srv/templates/router.j2', '/srv/templates/interfaces.j2']
+    """
+    files, pending = list(), [(os.path.abspath(path), False)]
+    while pending:
+        path, raw = pending.pop()
+        if path in files:
+            continue
+        files.append(path)
+        if raw or not os.path.isfile(path):
+            continue
+        with open(path, "rb") as iostream:
+            template_source = iostream.read()
+        for match in INCLUDE_REGEX.finditer(template_source):
+            included = os.path.normpath(os.path.join(
+                os.path.dirname(path), match.group(3).decode("utf-8")
+            ))
+            pending.append((included, bool(match.group(1) or match.group(4))))
+    return files
+
+
+def _constant(node):
+    """
+    Return the value of `node` if it is a literal string or integer, else
+    `None`.
+    """
+    if isinstance(node, ast.Constant) and isinstance(node.value, (str, int)):
+        return node.value
+    return None
+
+
+def _analyse_dependencies(function_source, assigned):
+    """
+    Return the variables read by the template function in `function_source`
+    as a sorted tuple of paths: a path is a variable name followed by the
+    literal subscripts applied to it, ("qos", "policy") for qos["policy"], a
+    variable used otherwise is the path of its name alone. The variables in
+    `assigned` may be read before the template assigns them, so they are
+    paths as well. Also return the literal paths of the templates included.
+    The paths are `None` when they cannot be known: include or defined called
+    with a computed argument, globals, locals, vars, eval or exec used.
+    """
+    tree = ast.parse(function_source)
+    parents = dict()
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+
+    paths = set((name,) for name in assigned)
+    includes = list()
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Name) or not isinstance(node.ctx, ast.Load):
+            continue
+        name = node.id
+        if name in DYNAMIC_NAMES:
+            return None, ()
+        if name.startswith("_template_"):
+            continue
+        parent = parents.get(node)
+        if name in TEMPLATE_HELPERS:
+            if not isinstance(parent, ast.Call) or parent.func is not node:
+                return None, ()
+            argument = _constant(parent.args[0]) if parent.args else None
+            if not isinstance(argument, str):
+                return None, ()
+            if name == "defined":
+                paths.add((argument,))
+            elif name == "include":
+                raw = [keyword.value for keyword in parent.keywords
+                       if keyword.arg == "raw"] + parent.args[1:2]
+                if raw and not isinstance(raw[0], ast.Constant):
+                    return None, ()
+                if not (raw and raw[0].value) and argument not in includes:
+                    includes.append(argument)
+            continue
+
+        path = [name]
+        while (isinstance(parent, ast.Subscript) and parent.value is node and
+               isinstance(parent.ctx, ast.Load)):
+            key = _constant(parent.slice)
+            if key is None:
+                break
+            path.append(key)
+            node, parent = parent, parents.get(parent)
+        paths.add(tuple(path))
+
+    return _prune_paths(paths), tuple(includes)
+
+
+def _prune_paths(paths):
     """
-    with open(path, "rb") as iostream:
-        template_source = iostream.read()
+    Return the sorted tuple of `paths` without the paths whose value is part
+    of the value of another one.
+    """
+    paths = set(paths)
+    return tuple(sorted(
+        (path for path in paths
+         if not any(path[:n] in paths for n in range(1, len(path)))),
+        key=repr,
+    ))
+
 
+def transpile_template(path, template_source):
+    """
+    Convert `template_source`, the contents of the template located at
+    `path`, to Python code object.
+
+    The code object defines the function `_template_function` which renders
+    the template: adjacent literals and output blocks are sent to the output
+    by a single `extend` call, and the variables assigned by the template are
+    local variables of the function. They are read from the symbols
+    dictionary when the function starts and copied back into it when it
+    returns, the other variables are globals looked up in the dictionary.
+    A template calling `include` keeps all its variables in the dictionary
+    so the included templates see them. The variables the function reads
+    are registered in TEMPLATE_DEPENDENCIES when the code object runs.
+    """
     block_counts = collections.defaultdict(int)
-    depth = 0
+    depth = 1
+    uses_include = False
     span_map = dict()
-    python_source = [
-        # As the template is parsed, a dictionary is generated that maps lines
-        # of the transpiled source to lines of the template and byte offsets
-        # where interpolated blocks start.
-        "<Reserved for template offset table.>",
-    ]
-
-    def add_line(text):
+    python_source = list()
+    # Output pieces waiting to be written by one call: (code, span or None)
+    pending = list()
+    # Position in python_source where each open block starts
+    block_starts = list()
+
+    def add_line(text, span=None):
         """
-        Helper function for adding lines to generated Python script.
+        Helper function for adding lines to generated Python script, `span`
+        maps the line to the block of the template which produced it.
         """
-        python_source.append(" " * depth + text)
+        python_source.append(" " * (4 * depth) + text)
+        if span is not None:
+            span_map[len(python_source)] = span
+
+    def add_literal(text):
+        """
+        Queue literal text for output, merged with the previous literal.
+        """
+        if not text:
+            return
+        if pending and pending[-1][1] is None:
+            pending[-1] = (pending[-1][0] + text, None)
+        else:
+            pending.append((text, None))
+
+    def flush_output():
+        """
+        Emit the code writing the queued output pieces, one piece per line so
+        errors in output blocks are still mapped to their template line.
+        """
+        pieces = [
+            (repr(code) if span is None else code, span)
+            for code, span in pending
+        ]
+        del pending[:]
+        if len(pieces) == 1:
+            code, span = pieces[0]
+            add_line("_template_append(" + code + ")", span)
+        elif pieces:
+            add_line("_template_extend((")
+            for code, span in pieces:
+                add_line("    " + code + ",", span)
+            add_line("))")
 
     # This could be made more efficient by complicating the regular expressions
     # and using named capture groups to avoid needlessly modifying strings and
@@ -98,7 +586,7 @@ def compile_template(path):
         before, raw_block, after, tail = match.groups()
         if raw_block:
             first_bracket_offset = 0
-            last_bracket_position = None
+            last_bracket_offset = len(raw_block) - 1
             if (raw_block[0] in WHITESPACE_BYTES or
               raw_block[-1] in WHITESPACE_BYTES):
                 first_bracket_offset = raw_block.index(b"{")
@@ -107,35 +595,48 @@ def compile_template(path):
             else:
                 block = raw_block
 
+            # Incremental counting of line numbers would probably be more
+            # efficient, but bytes.count is implemented in C, and I don't see
+            # this becoming a bottleneck any time soon considering all string
+            # manipulation done by the transpiler.
+            block_start = match.start(2) + first_bracket_offset
+            width = last_bracket_offset + 1 - first_bracket_offset
+            lineno = template_source.count(b"\n", None, block_start) + 1
+            span = (lineno, block_start, width)
+
+            add_literal(before.decode("utf-8"))
+
             # Comment block
-            if block[:1] == b"#":
-                add_line("_template_output.extend((%r, %r))" % (before, after))
+            if block[1:2] == b"#":
+                add_literal(after.decode("utf-8"))
                 continue
 
-            # Executable block
-            if before:
-                before = before.decode("utf-8")
-                add_line("_template_output.append(" + repr(before) + ")")
-
             contents = block[3:-3].replace(b"\n", b" ").strip().decode("utf-8")
+            uses_include = uses_include or "include" in contents
 
             # Statement block
             if block[1:2] == b"%":
+                flush_output()
                 if BLOCK_EXPRESSION_REGEX.match(contents):
                     if not contents.endswith(":"):
                         contents += ":"
                     if contents.startswith(("elif", "else", "except", "finally")):
+                        if block_starts and block_starts.pop() == len(python_source):
+                            add_line("pass")
                         depth -= 1
                     else:
                         block_name = contents.split()[0]
                         block_counts[block_name] += 1
-                    add_line(contents)
+                    add_line(contents, span)
+                    block_starts.append(len(python_source))
                     depth += 1
                 elif END_BLOCK_EXPRESSION_REGEX.match(contents):
+                    if block_starts and block_starts.pop() == len(python_source):
+                        add_line("pass")
                     block_counts[contents[3:]] -= 1
                     depth -= 1
                 else:
-                    add_line(contents)
+                    add_line(contents, span)
 
             # Output block
             else:
@@ -152,31 +653,19 @@ def compile_template(path):
                 #       File "<stdin>", line 1, in <module>
                 #     TypeError: 'x' is an invalid keyword argument for ...
                 #
-                contents = "str((" + contents + "))"
+                contents = "_template_str((" + contents + "))"
                 if block[1:2] == b"{":
-                    contents = "_template_escaper(" + contents + ")"
-                add_line("_template_output.append(" + contents + ")")
+                    contents = "_template_escape(" + contents + ")"
+                pending.append((contents, span))
 
-            if after:
-                after = after.decode("utf-8")
-                add_line("_template_output.append(" + repr(after) + ")")
-
-            # Incremental counting of line numbers would probably be more
-            # efficient, but bytes.count is implemented in C, and I don't see
-            # this becoming a bottleneck any time soon considering all string
-            # manipulation done by the transpiler.
-            block_start, block_end = match.span(2)
-            block_start += first_bracket_offset
-            block_end = last_bracket_position or block_end
-            width = block_end - block_start
-            lineno = template_source.count(b"\n", None, block_start) + 1
-            span_map[len(python_source)] = (lineno, block_start, width)
+            add_literal(after.decode("utf-8"))
 
         else:
-            tail = tail.decode("utf-8")
-            add_line("_template_output.append(" + repr(tail) + ")")
+            add_literal(tail.decode("utf-8"))
+
+    flush_output()
 
-    if depth:
+    if depth != 1:
         messages = list()
         text = "the number of %ss is %s than the number of %ss by %d"
         for block, count in block_counts.items():
@@ -189,13 +678,72 @@ def compile_template(path):
         all_messages = ", and ".join(messages).replace("t", "T", 1) + "."
         raise SyntaxError(all_messages)
 
-    python_source[0] = "_template_span_map[%r] = %r"  % (path, span_map)
-    script = "\n".join(python_source)
-
+    # Line of the generated script where python_source starts, minus one
+    offset = 1
     try:
+        # The names the template assigns are found from a first draft of the
+        # function.
+        body = python_source or [" " * 4 + "pass"]
+        draft = "def _template_function():\n" + "\n".join(body)
+        table = symtable.symtable(draft, TEMPLATE_PATH_PREFIX + path, "exec")
+        function_table = table.lookup("_template_function").get_namespace()
+        names = tuple(sorted(
+            name for name in function_table.get_locals()
+            if not name.startswith("_template_")
+        ))
+        dependencies = _analyse_dependencies(draft, names) + (names,)
+
+        header = [
+            None,   # <Reserved for template offset table.>
+            "def _template_function():",
+        ]
+        for helper, value in (
+            ("_template_append", "_template_output.append"),
+            ("_template_extend", "_template_output.extend"),
+            ("_template_escape", "_template_escaper"),
+            ("_template_str", "str"),
+        ):
+            if helper + "(" in draft:
+                header.append("    %s = %s" % (helper, value))
+        footer = list()
+        if names and uses_include:
+            # Included templates read the variables in the symbols dictionary,
+            # so they are not made local.
+            header.append("    global " + ", ".join(names))
+        elif names:
+            # The variables are loaded from the symbols dictionary and saved
+            # back into it when the template returns.
+            header.append("    _template_symbols = globals()")
+            for name in names:
+                header.append(
+                    "    if %r in _template_symbols: %s = _template_symbols[%r]"
+                    % (name, name, name)
+                )
+            header.append("    try:")
+            body = ["    " + line for line in body]
+            footer = [
+                "    finally:",
+                "        _template_locals = locals()",
+                "        for _template_name in %r:" % (names,),
+                "            if _template_name in _template_locals:",
+                "                _template_symbols[_template_name] = "
+                "_template_locals[_template_name]",
+            ]
+
+        offset = len(header)
+        script_span_map = dict(
+            (lineno + offset, span) for lineno, span in span_map.items()
+        )
+        header[0] = (
+            "_template_span_map[_template_path] = %r; "
+            "_template_dependencies[_template_path] = %r"
+            % (script_span_map, dependencies)
+        )
+        script = "\n".join(header + body + footer)
         return compile(script, TEMPLATE_PATH_PREFIX + path, "exec")
+
     except SyntaxError as error:
-        e_lineno = error.lineno
+        e_lineno = (error.lineno or 0) - offset
         error.filename = path
         error.offset = -1
         while e_lineno > 0:
@@ -204,7 +752,7 @@ def compile_template(path):
             # that's actually in the map is found.
             if e_lineno in span_map:
                 error.lineno, true_offset, _ = span_map[e_lineno]
-                nl = template_source.index(b"\n", true_offset)
+                nl = template_source.find(b"\n", true_offset)
                 nl = None if nl < 0 else nl
                 error.text = template_source[true_offset:nl].decode("utf-8")
                 break
@@ -215,11 +763,14 @@ def compile_template(path):
         raise
 
 
-def template_to_function(path, escaper=html_escape):
+def template_to_function(path, escaper=html_escape, compiled_template=None):
     """
     Convert template into a callable function. By default, the template output
     will be made HTML-safe, but the content escape method can be changed by
-    setting the `escaper` argument.
+    setting the `escaper` argument. When the code object returned by
+    compile_template for this template is already available, for instance
+    after being marshalled to another process, it can be given as
+    `compiled_template` to skip the compilation.
 
     The resulting function action can be called using two different conventions
     to pass state into the template. One way to pass state into the function is
@@ -253,12 +804,35 @@ def template_to_function(path, escaper=html_escape):
     system, no user-defined variable names may start with "_template_". If an
     error is raised during template execution, the dictionary may contain
     internal variables starting with this prefix.
+
+    Large outputs can be streamed instead of returned as one string: when a
+    file-like object is given as `_template_sink`, the output is written to it
+    by chunks of about TEMPLATE_CHUNK_SIZE characters while the template runs,
+    and the function returns the number of characters written:
+
+    >>> with open("inbox.txt", "w") as iostream:
+    ...     render_inbox(variables, _template_sink=iostream)
+
+    A RenderMemo given as `_template_memo`, or TEMPLATE_MEMO when it is set,
+    returns the output of a previous call which read the same values, and
+    keeps the outputs of the included templates the same way.
     """
     abspath = os.path.abspath(path)
-    compiled_template = compile_template(abspath)
+    if compiled_template is None:
+        compiled_template = compile_template(abspath)
     template_directory = os.path.dirname(abspath)
+    # The module code only defines the template function and its span map, it
+    # is run once here and each call builds the function on the symbols.
+    namespace = {
+        "_template_span_map": TEMPLATE_SPAN_MAPS,
+        "_template_dependencies": TEMPLATE_DEPENDENCIES,
+        "_template_path": abspath,
+    }
+    exec(compiled_template, namespace)
+    function_code = namespace["_template_function"].__code__
 
-    def function(_template_symbol_dictionary=None, **symbols):
+    def function(_template_symbol_dictionary=None, _template_sink=None,
+                 _template_memo=None, **symbols):
         if _template_symbol_dictionary is not None and symbols:
             raise ValueError(
                 "Cannot specify _template_symbol_dictionary when using "
@@ -273,6 +847,15 @@ def template_to_function(path, escaper=html_escape):
             is_include_call = True
 
         else:
+            memo = TEMPLATE_MEMO if _template_memo is None else _template_memo
+            if memo is not None:
+                memo_key, output = memo.lookup(function, symbols)
+                if output is not None and _template_sink is None:
+                    return output
+                elif output is not None:
+                    _template_sink.write(output)
+                    return len(output)
+
             def include(path, raw=False, escaper=None):
                 """
                 Incorporate `path` into template output. If `raw` is `False`,
@@ -285,19 +868,29 @@ def template_to_function(path, escaper=html_escape):
                 directory of the calling template. Note that this function does
                 not return the included data.
                 """
-                path = os.path.join(template_directory, path)
                 if raw:
                     if escaper:
                         raise ValueError("Cannot set escaper when raw=False.")
-                    with open(path) as iostream:
-                        contents = iostream.read()
+                    full_path = os.path.join(template_directory, path)
+                    contents = TEMPLATE_PACK_ENTRIES.get(
+                        os.path.abspath(full_path)
+                    )
+                    if not isinstance(contents, str):
+                        with open(full_path) as iostream:
+                            contents = iostream.read()
                     symbols["_template_output"].append(contents)
                 else:
                     my_escaper = symbols["_template_escaper"]
                     if escaper is None:
                         escaper = my_escaper
                     try:
-                        template_to_function(path, escaper=escaper)(symbols)
+                        included = resolve_include(
+                            template_directory, path, escaper
+                        )
+                        if symbols["_template_memo"] is None:
+                            included(symbols)
+                        else:
+                            symbols["_template_memo"].include(included, symbols)
                     finally:
                         symbols["_template_escaper"] = my_escaper
 
@@ -316,33 +909,231 @@ def template_to_function(path, escaper=html_escape):
                 Return boolean value indicating whether or not a variable is
                 defined. The `name` is given as a string.
                 """
-                return name in symbols
+                # the variables assigned by the template are local variables
+                # of the calling template function
+                return name in symbols or name in sys._getframe(1).f_locals
 
             is_include_call = False
             symbols.update({
-                "_template_output": list(),
-                "_template_span_map": dict(),
+                "_template_output": (
+                    list() if _template_sink is None
+                    else StreamOutput(_template_sink)
+                ),
+                "_template_functions": dict(),
+                "_template_memo": memo,
                 "defined": defined,
                 "include": include,
                 "raw_include": raw_include,
             })
 
         try:
-            exec(compiled_template, symbols)
+            # An include called in a loop reuses the function built on the
+            # symbols by its first call.
+            template_function = symbols["_template_functions"].get(function)
+            if template_function is None:
+                # Python < 3.10 does not give the builtins to a function
+                # whose globals have none.
+                symbols.setdefault("__builtins__", builtins)
+                template_function = types.FunctionType(function_code, symbols)
+                symbols["_template_functions"][function] = template_function
+            template_function()
+            if is_include_call:
+                # The caller joins the output, doing it here for every include
+                # would make the rendering quadratic.
+                return None
+            if _template_sink is not None:
+                symbols["_template_output"].flush()
+                return symbols["_template_output"].written
             output = "".join(symbols["_template_output"])
-            if not is_include_call:
-                del symbols["_template_span_map"]
+            if memo is not None:
+                memo.store(memo_key, function, output, symbols)
             return output
         finally:
             if not is_include_call:
                 del symbols["_template_output"]
+                del symbols["_template_functions"]
+                del symbols["_template_memo"]
                 del symbols["defined"]
                 del symbols["include"]
                 del symbols["raw_include"]
 
+    function.template_path = abspath
+    function.compiled_template = compiled_template
+    function.escaper = escaper
     return function
 
 
+class StreamOutput(object):
+    """
+    Replacement of the output list of a template which writes the output to
+    the file-like object `stream` by chunks of about `chunk_size` characters,
+    so the whole output is never held in memory.
+    """
+
+    def __init__(self, stream, chunk_size=None):
+        self.stream = stream
+        self.chunk_size = chunk_size or TEMPLATE_CHUNK_SIZE
+        self.chunks = list()
+        self.size = 0
+        self.written = 0
+
+    def append(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def extend(self, texts):
+        self.chunks.extend(texts)
+        self.size += sum(map(len, texts))
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered output to the stream.
+        """
+        if self.chunks:
+            chunk = "".join(self.chunks)
+            self.stream.write(chunk)
+            self.written += len(chunk)
+            del self.chunks[:]
+            self.size = 0
+
+
+class RenderMemo(object):
+    """
+    Outputs of the templates already rendered, reused when a template is
+    rendered again with the same values of the variables it reads (see
+    template_dependencies): a block shared by many devices is rendered once.
+    The outputs of the included templates are memoized as well. At most
+    `maxsize` outputs of at most `max_output` characters are kept, the least
+    recently used are dropped. The variables a template assigns are kept with
+    its output and assigned again when it is reused; they are shared, not
+    copied. A template whose output depends on anything else than its
+    variables (time, files, counters) must not be rendered with a memo.
+    """
+
+    def __init__(self, maxsize=None, max_output=None):
+        self.maxsize = maxsize or TEMPLATE_MEMO_SIZE
+        self.max_output = max_output or TEMPLATE_MEMO_MAX_OUTPUT
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, function, symbols):
+        """
+        Return the key of the output of the template `function` rendered with
+        `symbols`, or `None` if the variables it reads are not known.
+        """
+        dependencies = template_dependencies(function.template_path)
+        if dependencies is None:
+            return None
+        values = list()
+        for path in dependencies[0]:
+            value = symbols.get(path[0], _MISSING)
+            for subscript in path[1:]:
+                try:
+                    value = value[subscript]
+                except (LookupError, TypeError):
+                    value = _MISSING
+                    break
+            values.append(value)
+        try:
+            digest = hashlib.sha1(repr(values).encode("utf-8")).digest()
+        except Exception:
+            return None
+        escaper = function.escaper
+        if getattr(escaper, "__closure__", True) is None:
+            # The same escaper defined again by each call of a function.
+            escaper = escaper.__code__
+        return function.compiled_template, escaper, digest
+
+    def lookup(self, function, symbols):
+        """
+        Return the key of the output of `function` and the output, or `None`
+        if it was not rendered yet. The variables assigned by the template are
+        set in `symbols` when the output is found.
+        """
+        key = self.key(function, symbols)
+        if key is None:
+            return None, None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return key, None
+            self.hits += 1
+            self.entries.move_to_end(key)
+        output, assignments = entry
+        symbols.update(assignments)
+        return key, output
+
+    def store(self, key, function, output, symbols):
+        """
+        Keep the `output` of `function` and the variables it assigned.
+        """
+        if key is None or len(output) > self.max_output:
+            return
+        names = template_dependencies(function.template_path)[1]
+        assignments = dict(
+            (name, symbols[name]) for name in names if name in symbols
+        )
+        with self.lock:
+            self.entries[key] = (output, assignments)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def include(self, function, symbols):
+        """
+        Add the output of the included template `function` to the output of
+        the calling template, rendering it only if it is not memoized.
+        """
+        key, output = self.lookup(function, symbols)
+        if output is None:
+            caller_output = symbols["_template_output"]
+            symbols["_template_output"] = list()
+            try:
+                function(symbols)
+                output = "".join(symbols["_template_output"])
+            finally:
+                symbols["_template_output"] = caller_output
+            self.store(key, function, output, symbols)
+        symbols["_template_output"].append(output)
+
+    def clear(self):
+        """
+        Forget all the outputs, for instance after templates changed.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def enable_render_memo(maxsize=None, max_output=None):
+    """
+    Memoize the outputs of every template function in a RenderMemo shared by
+    the process, TEMPLATE_MEMO, and return it.
+    """
+    global TEMPLATE_MEMO
+    TEMPLATE_MEMO = RenderMemo(maxsize, max_output)
+    return TEMPLATE_MEMO
+
+
+@lru_cache(maxsize=1024)
+def resolve_include(template_directory, path, escaper):
+    """
+    Return the function rendering the template included as `path` from a
+    template located in `template_directory`. The functions are registered
+    per (directory, path, escaper), so an include called in a loop neither
+    resolves the path nor builds a new function again.
+    """
+    return template_to_function(os.path.join(template_directory, path), escaper)
+
+
 def template_traceback(templates_only=False):
     """
     An exception raised inside of a template will produce a traceback that can
@@ -418,15 +1209,17 @@ def template_traceback(templates_only=False):
 
         if path.startswith(TEMPLATE_PATH_PREFIX):
             path = path[len(TEMPLATE_PATH_PREFIX):]
-            span_map = trace.tb_frame.f_locals["_template_span_map"][path]
+            span_map = TEMPLATE_SPAN_MAPS[path]
+            call = "<module>"
             text = None
 
             try:
+                # The line is mapped even if the template is not on the disk
+                # (templates loaded from a pack).
+                lineno, start, width = span_map[lineno]
                 with open(path) as iostream:
-                    real_lineno, start, width = span_map[lineno]
                     iostream.seek(start)
                     text = iostream.read(width).replace("\n", " ").strip()
-                    lineno = real_lineno
             except Exception:
                 pass
 